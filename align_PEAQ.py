@@ -0,0 +1,101 @@
+import numpy as np
+
+
+'''
+Time alignment of a (reference, test) pair before scoring.
+
+The PEAQ model compares the signals frame by frame and assumes they are sample
+aligned; a codec delay of a few ms already shows up as noise. delay() estimates
+the lag of the test coarse to fine:
+
+  coarse: both signals are decimated by q (mean of q samples) and cross-correlated
+          with one FFT, O(N/q log N/q), over lags up to max_delay seconds (phase
+          transform weighting, robust to tonal content)
+  fine:   the full rate correlation at the lags within 2q of the coarse peak,
+          over the loudest window of the reference
+
+shift() then cuts both signals to their overlap with slices (views of the
+inputs, nothing is copied), which also reconciles different lengths:
+
+    ref, test, d = align(ref, test)         # test[n + d] ~ ref[n]
+'''
+
+FS = 48000
+
+
+def _mono(x):
+    # Mixdown of (..., N) for the estimate, all channels / batch items share one delay
+    x = x.detach().cpu().numpy() if hasattr(x, 'detach') else np.asarray(x)
+    return x.reshape(-1, x.shape[-1]).mean(0) if x.ndim > 1 else x
+
+
+def _decimate(x, q):
+    # Mean of q samples, a view reshaped (the tail shorter than q is left out)
+    n = len(x) // q * q
+    return x[:n].reshape(-1, q).mean(-1)
+
+
+def _coarse(r, t, max_lag):
+    # Lag l in [-max_lag, max_lag] maximizing the correlation of r[n] and t[n + l], with the
+    # cross spectrum whitened (PHAT) so that tonal, periodic content doesn't give near-equal
+    # peaks a period apart
+    nfft = 1 << int(np.ceil(np.log2(len(r) + len(t))))
+    C = np.conj(np.fft.rfft(r, nfft)) * np.fft.rfft(t, nfft)
+    C /= np.maximum(np.abs(C), 1e-12 * np.amax(np.abs(C), initial=1e-300))
+    c = np.fft.irfft(C, nfft)
+    pos = min(max_lag, len(t) - 1)
+    neg = min(max_lag, len(r) - 1)
+    lags = np.concatenate([np.arange(-neg, 0), np.arange(pos + 1)])
+    c = np.concatenate([c[nfft - neg:], c[:pos + 1]])
+    return int(lags[np.argmax(c)])
+
+
+def delay(ref, test, Fs=FS, max_delay=1., decimate=8, window=1 << 15):
+    # Estimated delay d of test against ref in samples, test[n + d] ~ ref[n] (d < 0: test leads)
+    # Fs        - sampling rate of the signals
+    # max_delay - largest delay searched, in seconds
+    # decimate  - decimation factor q of the coarse search (the fine search covers +-2q)
+    # window    - samples of the reference used by the fine search
+    r, t = _mono(ref), _mono(test)
+    q = max(int(decimate), 1)
+    max_lag = int(max_delay * Fs)
+    if len(r) < 2 * q or len(t) < 2 * q:
+        lag = 0
+    else:
+        lag = q * _coarse(_decimate(r, q), _decimate(t, q), max(max_lag // q, 1))
+
+    # Fine: reference window [s, s + W) against test windows starting at s + l for the lags l
+    lags = np.arange(max(lag - 2 * q, -max_lag), min(lag + 2 * q, max_lag) + 1)
+    lo = max(0, -lags[0])
+    hi = min(len(r), len(t) - lags[-1])
+    W = min(window, hi - lo)
+    if W <= 0:
+        return lag
+    # Loudest window of the reference within [lo, hi), on block energies
+    energy = np.cumsum(np.concatenate([[0.], _decimate(r[lo:hi] ** 2, q)]))
+    k = max(W // q, 1)
+    if len(energy) > k:
+        s = lo + q * int(np.argmax(energy[k:] - energy[:-k]))
+    else:
+        s = lo
+    s = min(s, hi - W)
+    c = np.correlate(t[s + lags[0]:s + lags[-1] + W], r[s:s + W], 'valid')
+    return int(lags[np.argmax(c)])
+
+
+def shift(ref, test, d):
+    # Overlap of ref and test delayed by d, cut to the same length; slices of the inputs
+    # (numpy arrays or tensors, (..., N))
+    if d > 0:
+        test = test[..., d:]
+    elif d < 0:
+        ref = ref[..., -d:]
+    n = min(ref.shape[-1], test.shape[-1])
+    return ref[..., :n], test[..., :n]
+
+
+def align(ref, test, Fs=FS, **kwargs):
+    # (ref, test, delay): the aligned overlap of the signals and the estimated delay
+    d = delay(ref, test, Fs, **kwargs)
+    ref, test = shift(ref, test, d)
+    return ref, test, d
@@ -0,0 +1,121 @@
+import numpy as np
+
+import export_PEAQ
+import numpy_PEAQ
+
+
+'''
+Approximate PEAQ scores from a sample of the frames, for quick triage of long material.
+
+The signals are cut into blocks of frames and only a stratified random sample of the
+blocks is scored: the first block (the start of the signals, where the 0.5 s delay of
+the modulation averages and the loudness threshold of the noise loudness apply) and
+one block at a random position in each of the equal parts of the rest. Every sampled
+block is preceded by warm-up frames that are scored and discarded, so the recursive
+states (time spreading, level adaptation, modulation patterns) have settled by the
+first frame of the block. The per-frame MOVs of the sampled blocks, in time order,
+are averaged by PEAQ.avg_get as if they were the whole signal, and the confidence
+interval of the ODG is a bootstrap over the sampled blocks.
+
+    result = approximate(ref, test, budget=0.1)
+    result['ODG'], result['ODG_ci'], result['fraction']
+
+budget is the fraction of the frames to score, warm-up included; it sets the number
+of blocks and so both the run time and the width of the interval. budget >= 1 scores
+every frame exactly (and gives an interval of zero width); with fewer than three
+blocks the interval is unknown (NaN).
+'''
+
+AMAX = 32768
+FS = 48000
+
+
+def _score(make_peaq, ref, test):
+    # Per-frame MOVs of one excerpt as numpy arrays
+    peaq = make_peaq()
+    peaq.process(ref, test)
+    frames = {}
+    for name in export_PEAQ.FRAME_MOVS:
+        x = getattr(peaq, name)
+        frames[name] = np.asarray(x.detach().cpu() if hasattr(x, 'detach') else x, dtype=np.float64)
+    return frames
+
+
+def average(frames, Fs=FS):
+    # Averaged MOVs and ODG (export_PEAQ.AVG_MOVS) of per-frame MOVs, by PEAQ.avg_get
+    peaq = numpy_PEAQ.PEAQ(AMAX, Fs=Fs)
+    for name, x in frames.items():
+        setattr(peaq, name, x)
+    peaq.Np = len(frames['EHS'])
+    peaq.avg_get()
+    return dict((name, float(getattr(peaq, name))) for name in export_PEAQ.AVG_MOVS)
+
+
+def starts(Np, budget, block=64, warmup=24, seed=0):
+    # First frames of the sampled blocks: 0, then one block per stratum of the remaining
+    # frames, as many as the budget (budget * Np frames, warm-up included) allows.
+    # None if the budget covers the signal (no sampling).
+    Np = int(Np)
+    K = 1 + max(int((budget * Np - block) // (block + warmup)), 0)
+    if budget >= 1 or block >= Np or K * block + (K - 1) * warmup >= Np:
+        return None
+    rng = np.random.RandomState(seed)
+    edges = np.linspace(block, Np, K).astype(np.int64)
+    return np.concatenate([[0], [rng.randint(lo, hi - block + 1) for lo, hi in zip(edges[:-1], edges[1:])]]).astype(np.int64)
+
+
+def approximate(ref, test, budget=0.1, Fs=FS, block=64, warmup=24, bootstrap=200, confidence=0.95, seed=0,
+                make_peaq=None):
+    # ref, test  - signals on the 16-bit scale at Fs (mono)
+    # budget     - fraction of the frames scored, warm-up included (the speed/accuracy trade-off)
+    # block      - frames per sampled block (64 frames = 1.4 s)
+    # warmup     - frames scored and discarded before each block (24 frames = 0.5 s)
+    # bootstrap  - resamples of the blocks for the confidence interval
+    # make_peaq  - evaluator factory (default numpy_PEAQ.PEAQ), anything with process() and
+    #              the per-frame MOV attributes
+    # Returns the averaged MOVs and ODG (export_PEAQ.AVG_MOVS), ODG_ci = (low, high) (NaN with
+    # fewer than three blocks), fraction = frames scored / frames, blocks = first frames of
+    # the sampled blocks
+    if make_peaq is None:
+        make_peaq = lambda: numpy_PEAQ.PEAQ(AMAX, Fs=Fs)
+    Nadv = 1024
+    Np = len(ref) // Nadv
+    first = starts(Np, budget, block, warmup, seed)
+    sampled = first is not None
+    if not sampled:
+        # All frames in one pass, exact
+        first, block = np.zeros(1, dtype=np.int64), Np
+
+    blocks = []
+    scored = 0
+    for s in first:
+        w = min(warmup, s)
+        n = min(block, Np - s)
+        samples = slice((s - w) * Nadv, min((s + n + 1) * Nadv, len(ref)))
+        r, t = ref[samples], test[samples]
+        # The test is cut or zero padded to the reference, as in process()
+        t = np.pad(t, (0, len(r) - len(t)))
+        frames = _score(make_peaq, r, t)
+        scored += w + n
+        blocks.append(dict((name, x[w:w + n]) for name, x in frames.items()))
+
+    def concat(chosen):
+        return dict((name, np.concatenate([blocks[i][name] for i in chosen])) for name in export_PEAQ.FRAME_MOVS)
+
+    result = average(concat(range(len(blocks))), Fs)
+    # Bootstrap over the blocks after the first, kept in time order
+    rng = np.random.RandomState(seed + 1)
+    if sampled and len(blocks) > 2:
+        odg = [average(concat([0] + sorted(rng.randint(1, len(blocks), len(blocks) - 1))), Fs)['ODG']
+               for _ in range(bootstrap)]
+        alpha = (1 - confidence) / 2
+        result['ODG_ci'] = tuple(float(x) for x in np.quantile(odg, [alpha, 1 - alpha]))
+    elif sampled:
+        # Fewer than two sampled blocks after the first, nothing to resample
+        result['ODG_ci'] = (np.nan, np.nan)
+    else:
+        result['ODG_ci'] = (result['ODG'], result['ODG'])
+    result['fraction'] = scored / max(Np, 1)
+    result['blocks'] = first.tolist()
+    result['frames'] = Np
+    return result
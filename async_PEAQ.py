@@ -0,0 +1,176 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+
+import numpy as np
+
+import align_PEAQ
+import audio_PEAQ
+
+
+'''
+asyncio API for PEAQ scoring.
+
+File decoding and the model run on a bounded thread pool (torch releases the GIL
+inside its kernels), so the event loop stays free and decoding of one pair
+overlaps with scoring of another. The model is evaluated in blocks of frames;
+cancelling the awaiting task stops the computation at the next block boundary.
+
+    scorer = AsyncScorer(workers=2)
+    result = await scorer.score('ref.wav', 'test.wav')
+    async for result in scorer.score_stream(pairs):
+        ...
+    scorer.queue_depth        # requests admitted and not yet finished
+'''
+
+AMAX = 32768
+FS = 48000
+MOVS = ['avgBWRef', 'avgBWTest', 'totalNMRB', 'WinModDiff1B', 'ADBB', 'EHSB',
+        'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB', 'MFPDB', 'relDistFramesB', 'ODG', 'DI']
+
+
+class AsyncScorer(object):
+    # workers     - threads decoding and scoring
+    # max_pending - requests admitted at once, further score() calls wait (backpressure)
+    # block       - frames per model block, the granularity of cancellation
+    # threads     - torch intra-op threads (None leaves the torch default)
+    # align       - score the aligned overlap of each pair, results have the test delay in
+    #               samples as 'delay' (align_PEAQ)
+    def __init__(self, workers=2, max_pending=8, block=64, dtype=None, threads=None, align=False):
+        import torch
+        import torch_PEAQ
+        if threads is not None:
+            torch.set_num_threads(threads)
+        self.model = torch_PEAQ.PEAQModule(AMAX, Fs=FS, dtype=torch.float64 if dtype is None else dtype)
+        self.block = block
+        self.align = align
+        self.max_pending = max_pending
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='peaq')
+        self._slots = None
+        self._admitted = 0
+        self._waiting = 0
+        self.counts = {'scored': 0, 'cancelled': 0, 'errors': 0}
+
+    @property
+    def queue_depth(self):
+        # Requests admitted plus those waiting for admission
+        return self._admitted + self._waiting
+
+    def _load(self, x):
+        # Samples and sampling rate, WAVs at other rates than FS are resampled while scoring
+        if isinstance(x, (str, os.PathLike)):
+            return audio_PEAQ.load(x)
+        return np.asarray(x, dtype=np.float64), FS
+
+    def _evaluate(self, ref, test, cancel):
+        # Runs on the pool: decode, then score block by block
+        import torch
+        (ref, rate), (test, test_rate) = self._load(ref), self._load(test)
+        if rate != test_rate:
+            raise ValueError(f'reference at {rate} Hz and test at {test_rate} Hz')
+        if cancel.is_set():
+            raise concurrent.futures.CancelledError()
+        if ref.shape[:-1] != test.shape[:-1]:
+            raise ValueError('reference and test have different numbers of channels')
+        delay = None
+        if self.align:
+            ref, test, delay = align_PEAQ.align(ref, test, rate)
+        outs = []
+        with torch.no_grad():
+            for out in self.model.blocks(ref, test, self.block, rate, ref.ndim > 1):
+                if cancel.is_set():
+                    raise concurrent.futures.CancelledError()
+                outs.append(out)
+            out = self.model.concat(outs)
+            out.update(self.model.average(out, ref.ndim > 1))
+        result = dict((mov, float(out[mov])) for mov in MOVS)
+        result['frames'] = int(out['EHS'].shape[-1])
+        if delay is not None:
+            result['delay'] = delay
+        return result
+
+    async def score(self, ref, test):
+        # ref/test: WAV paths or arrays on the 16-bit scale, mono or (channels, samples)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        except asyncio.CancelledError:
+            self.counts['cancelled'] += 1
+            raise
+        finally:
+            self._waiting -= 1
+        self._admitted += 1
+        cancel = threading.Event()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, self._evaluate, ref, test, cancel)
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Stop the worker at its next block boundary and release the slot once it has
+                cancel.set()
+                self.counts['cancelled'] += 1
+                try:
+                    await future
+                except BaseException:
+                    pass
+                raise
+            except Exception:
+                self.counts['errors'] += 1
+                raise
+            self.counts['scored'] += 1
+            return result
+        finally:
+            self._admitted -= 1
+            self._slots.release()
+
+    async def score_stream(self, pairs, window=None):
+        # Scores (ref, test) pairs from an iterable or async iterable, yielding results
+        # in input order with at most window (default max_pending) requests in flight.
+        # Pairs are only pulled from the source when there is room.
+        window = self.max_pending if window is None else window
+        tasks = []
+        try:
+            async for ref, test in _aiter(pairs):
+                tasks.append(asyncio.ensure_future(self.score(ref, test)))
+                if len(tasks) >= window:
+                    yield await tasks.pop(0)
+            while tasks:
+                yield await tasks.pop(0)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+async def _aiter(pairs):
+    if hasattr(pairs, '__aiter__'):
+        async for pair in pairs:
+            yield pair
+    else:
+        for pair in pairs:
+            yield pair
+
+
+_default = None
+
+
+def _scorer():
+    global _default
+    if _default is None:
+        _default = AsyncScorer()
+    return _default
+
+
+async def score(ref, test):
+    # score() on a shared default AsyncScorer
+    return await _scorer().score(ref, test)
+
+
+async def score_stream(pairs, window=None):
+    async for result in _scorer().score_stream(pairs, window):
+        yield result
@@ -0,0 +1,87 @@
+import struct
+
+import numpy as np
+
+
+'''
+Minimal WAV reader that only needs numpy, so scoring jobs don't have to import
+torch/torchaudio just to read the input files.
+Samples are returned on the 16-bit scale the models expect (Amax = 32768).
+'''
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def load(name):
+    # (audio, rate), mono signals squeezed to 1-D, as torchaudio.load(normalize=False) on the 16-bit scale
+    with open(name, 'rb') as f:
+        data = f.read()
+    return decode(data)
+
+
+def decode(data):
+    if data[0:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE file')
+
+    fmt = None
+    pcm = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk, size = struct.unpack('<4sI', data[pos:pos+8])
+        body = data[pos+8:pos+8+size]
+        if chunk == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', body[:16])
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                # Sub-format GUID starts with the actual format tag
+                fmt = (struct.unpack('<H', body[24:26])[0],) + fmt[1:]
+        elif chunk == b'data':
+            pcm = body
+        pos += 8 + size + (size & 1)
+
+    if fmt is None or pcm is None:
+        raise ValueError('WAVE file without fmt or data chunk')
+
+    tag, channels, rate, _, _, bits = fmt
+    audio = _samples(pcm, tag, bits)
+    audio = audio[:len(audio) - len(audio) % channels].reshape(-1, channels).T
+    return np.squeeze(audio), rate
+
+
+# Raw PCM sample formats: name -> (format tag, bits)
+PCM_FORMATS = {'u8': (WAVE_FORMAT_PCM, 8),
+               's16': (WAVE_FORMAT_PCM, 16),
+               's24': (WAVE_FORMAT_PCM, 24),
+               's32': (WAVE_FORMAT_PCM, 32),
+               'f32': (WAVE_FORMAT_IEEE_FLOAT, 32),
+               'f64': (WAVE_FORMAT_IEEE_FLOAT, 64)}
+
+
+def decode_pcm(pcm, fmt='s16', channels=1):
+    # Headerless little-endian interleaved samples, same output as decode()
+    if fmt not in PCM_FORMATS:
+        raise ValueError(f'Unsupported PCM format {fmt}, choose from {sorted(PCM_FORMATS)}')
+    audio = _samples(pcm, *PCM_FORMATS[fmt])
+    audio = audio[:len(audio) - len(audio) % channels].reshape(-1, channels).T
+    return np.squeeze(audio, 0) if channels == 1 else audio
+
+
+def _samples(pcm, tag, bits):
+    if tag == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = {32: '<f4', 64: '<f8'}[bits]
+        return np.frombuffer(pcm, dtype=dtype).astype(np.float64) * 32768.
+    if tag != WAVE_FORMAT_PCM:
+        raise ValueError(f'Unsupported WAVE format tag {tag}')
+
+    if bits == 8:
+        return (np.frombuffer(pcm, dtype=np.uint8).astype(np.float64) - 128) * 256.
+    if bits == 16:
+        return np.frombuffer(pcm, dtype='<i2').astype(np.float64)
+    if bits == 24:
+        b = np.frombuffer(pcm[:len(pcm) - len(pcm) % 3], dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        x = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        x = np.where(x >= 1 << 23, x - (1 << 24), x)
+        return x / 256.
+    if bits == 32:
+        return np.frombuffer(pcm, dtype='<i4') / 65536.
+    raise ValueError(f'Unsupported PCM bit depth {bits}')
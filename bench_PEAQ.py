@@ -0,0 +1,943 @@
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import approx_PEAQ
+import export_PEAQ
+import live_PEAQ
+import parity_PEAQ
+import resample_PEAQ
+import rescore_PEAQ
+import shared_PEAQ
+
+
+'''
+Reproducible throughput / memory benchmark for the PEAQ backends.
+
+Each measurement (backend, signal config, length, batch size) runs in a fresh
+process so setup cost and peak memory are not polluted by earlier runs, on
+deterministic synthetic audio. Results are written as JSON together with the
+environment they were measured in, and two result files can be compared.
+
+    python bench_PEAQ.py -o base.json                        # quick default matrix
+    python bench_PEAQ.py -b numpy -s 1,10,60,600,3600 -o long.json
+    python bench_PEAQ.py --compare base.json new.json
+    python bench_PEAQ.py -b module64,scripted64,compiled64 -s 10 -n 4   # eager vs compiled
+    python bench_PEAQ.py -b module64,advanced64 -s 10        # Basic vs Advanced version
+    python bench_PEAQ.py --startup -b numpy,torch64,module64  # cold start to first score
+    python bench_PEAQ.py --scaling 1,2,4,8 -b chunked64 -s 10 # N evaluators sharing the CPU
+    python bench_PEAQ.py --live 1024,256 -b numpy_fast -s 60 # live monitor latency
+    python bench_PEAQ.py --rescore 1,5 -b numpy_fast -s 60   # re-scoring an edited region
+    python bench_PEAQ.py --query 1e6,1e8                     # per-frame MOV store queries
+    python bench_PEAQ.py --stereo -b numpy,numpy_fast -s 10  # stereo item vs two mono runs
+'''
+
+AMAX = parity_PEAQ.AMAX
+FS = parity_PEAQ.FS
+CHUNK = 10  # synthetic audio is generated in chunks of this many seconds
+
+# (class, method, stage) timed inside PEAQ.process / avg_get.
+# Stages are inclusive, 'other' is whatever process() spends outside of them.
+STAGES = [('PQEval', '__init__', 'setup'),
+          ('PQEval', 'PQDFTFrame', 'DFT'),
+          ('PQEval', 'PQ_excitCB', 'excitation'),
+          ('PQEval', 'PQ_timeSpread', 'timeSpread'),
+          ('PEAQ', 'PQadapt', 'adapt'),
+          ('PQEval', 'PQmodPatt', 'modPatt'),
+          ('PQEval', 'PQloud', 'Ntot'),
+          ('PQEval', 'PQmovModDiffB', 'ModDiff'),
+          ('PEAQ', 'PQmovNLoudB', 'NL'),
+          ('PEAQ', 'computeBW', 'BW'),
+          ('PQEval', 'PQmovPD', 'PD'),
+          ('PEAQ', 'PQ_ChanPD', 'PD'),
+          ('PEAQ', 'PQmovEHS', 'EHS'),
+          ('PEAQ', 'computeNMR', 'NMR')]
+
+# Same for the single-graph PEAQModule (eager only, scripted/compiled graphs can't be wrapped)
+MODULE_STAGES = [('PEAQModule', 'spectra', 'DFT'),
+                 ('PEAQModule', 'excitation', 'excitation'),
+                 ('PEAQModule', 'time_spread', 'timeSpread'),
+                 ('PEAQModule', 'adapt', 'adapt'),
+                 ('PEAQModule', 'mod_patt', 'modPatt'),
+                 ('PEAQModule', 'loudness', 'Ntot'),
+                 ('PEAQModule', 'mov_mod_diff', 'ModDiff'),
+                 ('PEAQModule', 'mov_nloud', 'NL'),
+                 ('PEAQModule', 'mov_bw', 'BW'),
+                 ('PEAQModule', 'mov_pd', 'PD'),
+                 ('PEAQModule', 'pd_frames', 'PD'),
+                 ('PEAQModule', 'mov_ehs', 'EHS'),
+                 ('PEAQModule', 'mov_nmr', 'NMR'),
+                 ('PEAQModule', 'average', 'average')]
+
+# Advanced version: filter bank ear model, FFT ear model (NMR, EHS) and pattern processing
+ADVANCED_STAGES = [('PEAQFilterBank', 'dc_filter', 'dcFilter'),
+                   ('PEAQFilterBank', 'filter_bank', 'filterBank'),
+                   ('PEAQFilterBank', 'spread', 'spreadFB'),
+                   ('PEAQFilterBank', 'smear', 'backwardMask'),
+                   ('PEAQModule', 'spectra', 'DFT'),
+                   ('PEAQModule', 'excitation', 'excitation'),
+                   ('PEAQModule', 'mov_ehs', 'EHS'),
+                   ('PEAQAdvancedModule', 'adapt', 'adapt'),
+                   ('PEAQAdvancedModule', 'mod_patt', 'modPatt'),
+                   ('PEAQAdvancedModule', 'noise_loud', 'NL'),
+                   ('PEAQAdvancedModule', 'average', 'average')]
+
+
+def _numpy_backend(fast_math=False):
+    import numpy_PEAQ
+    return (numpy_PEAQ,
+            lambda Fs: numpy_PEAQ.PEAQ(AMAX, Fs=Fs, fast_math=fast_math),
+            lambda Fs: numpy_PEAQ.PQEval(AMAX, Fs, fast_math=fast_math),
+            STAGES)
+
+
+def _torch_backend(dtype_name):
+    def load():
+        import torch
+        import torch_PEAQ
+        device = torch.device('cpu')
+        dtype = getattr(torch, dtype_name)
+        return (torch_PEAQ,
+                lambda Fs: torch_PEAQ.PEAQ(AMAX, Fs=Fs, device=device, dtype=dtype),
+                lambda Fs: torch_PEAQ.PQEval(AMAX, Fs, device=device, dtype=dtype),
+                STAGES)
+    return load
+
+
+class _ModuleRunner(object):
+    # Gives a PEAQModule the process()/avg_get() interface measure() drives
+    # block - frames per block of PEAQModule.evaluate (chunked mode), None for one forward()
+    def __init__(self, model, block=None):
+        self.model = model
+        self.block = block
+
+    def process(self, ref, test):
+        import torch
+        # (channels, N) signals are one multichannel item
+        multichannel = ref.ndim > 1
+        with torch.no_grad():
+            if self.block is None:
+                self.out = self.model(torch.from_numpy(ref), torch.from_numpy(test), multichannel=multichannel)
+            else:
+                self.out = self.model.evaluate(ref, test, self.block, multichannel=multichannel)
+        self.Np = self.out['EHS'].shape[-1]
+
+    def avg_get(self):
+        self.ODG = self.out['ODG']
+
+    # First call on a new shape, where torch.compile traces and generates code
+    warmup = process
+
+
+def _module_backend(dtype_name, mode='eager', version='Basic', block=None):
+    def load():
+        import torch
+        import torch_PEAQ
+        dtype = getattr(torch, dtype_name)
+        models = []
+        cls = torch_PEAQ.PEAQModule if version == 'Basic' else torch_PEAQ.PEAQAdvancedModule
+
+        def make_eval(Fs):
+            model = cls(AMAX, Fs=Fs, dtype=dtype)
+            if mode == 'script':
+                model = torch.jit.script(model)
+            elif mode == 'compile':
+                model = torch.compile(model)
+            models.append(_ModuleRunner(model, block))
+            return models[-1]
+        # The model is built once (setup) and reused for every pair of the batch
+        stages = MODULE_STAGES if version == 'Basic' else ADVANCED_STAGES
+        return torch_PEAQ, lambda Fs: models[-1], make_eval, stages if mode == 'eager' else []
+    return load
+
+
+# name -> loader returning (module, PEAQ factory, PQEval factory, timed stages)
+BACKENDS = {'numpy': _numpy_backend,
+            'numpy_fast': functools.partial(_numpy_backend, True),
+            'torch64': _torch_backend('float64'),
+            'torch32': _torch_backend('float32'),
+            'module64': _module_backend('float64'),
+            'module32': _module_backend('float32'),
+            'scripted64': _module_backend('float64', 'script'),
+            'compiled64': _module_backend('float64', 'compile'),
+            'compiled32': _module_backend('float32', 'compile'),
+            'advanced64': _module_backend('float64', version='Advanced'),
+            'advanced32': _module_backend('float32', version='Advanced'),
+            'chunked64': _module_backend('float64', block=256),
+            'chunked32': _module_backend('float32', block=256)}
+
+
+## --------------- Synthetic audio -------------------- ##
+
+def _music_pair(rng, n):
+    ref = parity_PEAQ.music(rng, n)
+    return ref, parity_PEAQ.bandlimit(ref, 16000.) + 3e-3 * AMAX * rng.standard_normal(n)
+
+
+def _noise_pair(rng, n):
+    ref = 0.1 * AMAX * parity_PEAQ.bandlimit(rng.standard_normal(n), 20000.)
+    return ref, ref + 1e-3 * AMAX * rng.standard_normal(n)
+
+
+def _sparse_pair(rng, n):
+    # Half of every second is digital silence
+    ref, test = _music_pair(rng, n)
+    gate = (np.arange(n) % FS) < FS // 2
+    return ref * gate, test * gate
+
+
+CONFIGS = {'music': _music_pair, 'noise': _noise_pair, 'sparse': _sparse_pair}
+
+
+def synthetic(config, seconds, seed=0):
+    # Deterministic (reference, test) pair, built chunk by chunk so hour-long
+    # signals don't need hour-long FFTs. Full chunk i only depends on (seed, i).
+    n = int(round(seconds * FS))
+    ref = np.empty(n)
+    test = np.empty(n)
+    for i, start in enumerate(range(0, n, CHUNK * FS)):
+        m = min(CHUNK * FS, n - start)
+        rng = np.random.RandomState([seed, i])
+        ref[start:start+m], test[start:start+m] = CONFIGS[config](rng, m)
+    return ref, test
+
+
+## --------------- Measurement -------------------- ##
+
+@contextlib.contextmanager
+def stage_timers(module, totals, stages=STAGES):
+    # Temporarily wrap the stage methods of module.PQEval / module.PEAQ with timers
+    # accumulating {stage: [seconds, calls]} into totals.
+    saved = []
+    for cls_name, method, stage in stages:
+        cls = getattr(module, cls_name)
+        fn = cls.__dict__.get(method)
+        if fn is None:
+            continue
+        totals.setdefault(stage, [0., 0])
+
+        def timed(*args, _fn=fn, _stage=stage, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _fn(*args, **kwargs)
+            finally:
+                totals[_stage][0] += time.perf_counter() - start
+                totals[_stage][1] += 1
+        saved.append((cls, method, fn))
+        setattr(cls, method, functools.wraps(fn)(timed))
+    try:
+        yield totals
+    finally:
+        for cls, method, fn in saved:
+            setattr(cls, method, fn)
+
+
+def _max_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.
+
+
+def _scalar(x):
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu()
+    return float(x)
+
+
+def measure(backend, config, seconds, batch, threads=None, trace_memory=False):
+    # One benchmark point, meant to run in its own process.
+    if threads is not None and backend != 'numpy':
+        import torch
+        torch.set_num_threads(threads)
+
+    module, make_peaq, make_eval, stages = BACKENDS[backend]()
+
+    pairs = [synthetic(config, seconds, seed) for seed in range(batch)]
+    rss_before = _max_rss_mb()
+
+    start = time.perf_counter()
+    make_eval(FS)
+    setup_s = time.perf_counter() - start
+
+    if trace_memory:
+        tracemalloc.start()
+
+    # Compilation (and any other first-call cost) is reported on its own, not as throughput
+    warmup_s = None
+    runner = make_peaq(FS)
+    if hasattr(runner, 'warmup'):
+        start = time.perf_counter()
+        runner.warmup(*pairs[0])
+        warmup_s = time.perf_counter() - start
+
+    totals = {}
+    process_s = avg_s = 0.
+    odg = []
+    with stage_timers(module, totals, stages), contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        for ref, test in pairs:
+            peaq = make_peaq(FS)
+            start = time.perf_counter()
+            peaq.process(ref, test)
+            process_s += time.perf_counter() - start
+
+            start = time.perf_counter()
+            peaq.avg_get()
+            avg_s += time.perf_counter() - start
+            odg.append(_scalar(peaq.ODG))
+            frames = int(peaq.Np)
+            del peaq
+
+    traced_peak_mb = None
+    if trace_memory:
+        traced_peak_mb = tracemalloc.get_traced_memory()[1] / 2.**20
+        tracemalloc.stop()
+
+    audio_s = seconds * batch
+    staged = sum(t for t, _ in totals.values())
+    stages = dict((stage, {'seconds': t, 'calls': calls}) for stage, (t, calls) in totals.items())
+    stages['other'] = {'seconds': max(process_s - staged, 0.), 'calls': batch}
+    return {'backend': backend,
+            'config': config,
+            'seconds': seconds,
+            'batch': batch,
+            'frames': frames * batch,
+            'threads': threads,
+            'setup_s': setup_s,
+            'warmup_s': warmup_s,
+            'process_s': process_s,
+            'avg_get_s': avg_s,
+            'total_s': process_s + avg_s,
+            # rtf = processing time / audio time, below 1 is faster than real time
+            'rtf': (process_s + avg_s) / audio_s,
+            'frames_per_s': frames * batch / process_s,
+            'stages': stages,
+            'peak_rss_mb': _max_rss_mb(),
+            'rss_growth_mb': _max_rss_mb() - rss_before,
+            'traced_peak_mb': traced_peak_mb,
+            'odg': odg}
+
+
+def _measure_isolated(args):
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as pool:
+        return pool.submit(measure, *args).result()
+
+
+def environment():
+    env = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+           'argv': sys.argv,
+           'python': platform.python_version(),
+           'implementation': platform.python_implementation(),
+           'platform': platform.platform(),
+           'machine': platform.machine(),
+           'processor': platform.processor(),
+           'cpu_count': os.cpu_count(),
+           'numpy': np.__version__,
+           'threads_env': dict((k, os.environ[k]) for k in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                                                             'OPENBLAS_NUM_THREADS') if k in os.environ)}
+    try:
+        import torch
+        env['torch'] = torch.__version__
+        env['torch_threads'] = torch.get_num_threads()
+    except ImportError:
+        env['torch'] = None
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        env['git_commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                                    stderr=subprocess.DEVNULL).decode().strip()
+        env['git_dirty'] = bool(subprocess.check_output(['git', 'status', '--porcelain', '-uno'], cwd=here,
+                                                        stderr=subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        env['git_commit'] = None
+    return env
+
+
+def run(backends, configs, lengths, batches, threads=None, trace_memory=False, isolate=True, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for config in configs:
+            for seconds in lengths:
+                for batch in batches:
+                    args = (backend, config, seconds, batch, threads, trace_memory)
+                    result = _measure_isolated(args) if isolate else measure(*args)
+                    results.append(result)
+                    print('%-10s %-7s %7gs x%-3d setup %6.2fs  warmup %7.2fs  process %8.2fs  rtf %7.3f  peak %8.1f MB'
+                          % (backend, config, seconds, batch, result['setup_s'], result['warmup_s'] or 0.,
+                             result['process_s'], result['rtf'], result['peak_rss_mb']), file=stream)
+    return {'environment': environment(), 'results': results}
+
+
+## --------------- Scaling -------------------- ##
+
+def _scaling_worker(backend, config, seconds, seed, threads, barrier, results):
+    # One of N concurrent evaluators: set up, wait for the others, score one pair
+    if threads is not None and backend != 'numpy':
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    module, make_peaq, make_eval, _ = BACKENDS[backend]()
+    ref, test = synthetic(config, seconds, seed)
+    make_eval(FS)
+    peaq = make_peaq(FS)
+    barrier.wait()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        peaq.process(ref, test)
+        peaq.avg_get()
+    results.put({'seed': seed, 'seconds': time.perf_counter() - start, 'peak_rss_mb': _max_rss_mb(), 'odg': _scalar(peaq.ODG)})
+
+
+def scaling(backend, config, seconds, evaluators, threads=None):
+    # N evaluators in N processes, all scoring a pair at the same time after their setup.
+    # threads is the torch intra-op thread count of each (default cores // N, so that the
+    # evaluators together don't oversubscribe the CPU).
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // evaluators)
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(evaluators + 1)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_scaling_worker, args=(backend, config, seconds, seed, threads, barrier, results))
+             for seed in range(evaluators)]
+    for proc in procs:
+        proc.start()
+    try:
+        barrier.wait(timeout=600)
+        start = time.perf_counter()
+        workers = [results.get(timeout=3600) for _ in procs]
+        wall_s = time.perf_counter() - start
+        # Results arrive in the order the evaluators finish
+        workers.sort(key=lambda w: w['seed'])
+    finally:
+        for proc in procs:
+            proc.join(10)
+            if proc.is_alive():
+                proc.terminate()
+    return {'backend': backend,
+            'config': config,
+            'seconds': seconds,
+            'evaluators': evaluators,
+            'threads': threads,
+            'wall_s': wall_s,
+            # Seconds of audio scored per second by all evaluators together
+            'throughput': evaluators * seconds / wall_s,
+            'worker_s': [w['seconds'] for w in workers],
+            'peak_rss_mb': max(w['peak_rss_mb'] for w in workers),
+            'odg': [w['odg'] for w in workers]}
+
+
+def run_scaling(backends, configs, lengths, counts, threads=None, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for config in configs:
+            for seconds in lengths:
+                base = None
+                for evaluators in counts:
+                    result = scaling(backend, config, seconds, evaluators, threads)
+                    base = base or result['throughput'] / evaluators
+                    result['speedup'] = result['throughput'] / base
+                    results.append(result)
+                    print('%-10s %-7s %7gs x%-3d threads %3d  wall %8.2fs  throughput %8.2f  speedup %6.2f  peak %8.1f MB'
+                          % (backend, config, seconds, evaluators, result['threads'], result['wall_s'],
+                             result['throughput'], result['speedup'], result['peak_rss_mb']), file=stream)
+    return {'environment': environment(), 'scaling': results}
+
+
+## --------------- Start-up -------------------- ##
+
+# Run with python -c in a fresh interpreter: times the backend imports before anything
+# else is loaded, then hands over to startup_point()
+_STARTUP = '''
+import sys, time
+start = time.perf_counter()
+for name in sys.argv[3:]:
+    __import__(name)
+import_s = time.perf_counter() - start
+import bench_PEAQ
+bench_PEAQ.startup_point(sys.argv[1], float(sys.argv[2]), import_s)
+'''
+
+
+def _backend_modules(backend):
+    return ['numpy_PEAQ'] if backend == 'numpy' else ['torch', 'torch_PEAQ']
+
+
+def startup_point(backend, seconds, import_s):
+    # Second half of a start-up measurement (see startup()), prints the result as JSON
+    module, make_peaq, make_eval, _ = BACKENDS[backend]()
+    ref, test = synthetic('music', seconds)
+
+    start = time.perf_counter()
+    make_eval(FS)
+    setup_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        peaq = make_peaq(FS)
+        peaq.process(ref, test)
+        peaq.avg_get()
+    score_s = time.perf_counter() - start
+    print(json.dumps({'import_s': import_s, 'setup_s': setup_s, 'first_score_s': score_s,
+                      'odg': _scalar(peaq.ODG)}))
+
+
+def startup(backend, seconds=1., cache=None):
+    # Cold start of a scoring job: interpreter start, backend import, model tables and
+    # the first score of a signal of the given length, in a fresh process. The numpy
+    # table cache is measured empty ('cold', tables computed and written) and filled
+    # ('warm', as every later job sees it); cache is its directory (default: a temporary one).
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PEAQ_CACHE=cache or tmp)
+        for state in ('cold', 'warm'):
+            start = time.perf_counter()
+            out = subprocess.check_output([sys.executable, '-c', _STARTUP, backend, str(seconds)]
+                                          + _backend_modules(backend), cwd=here, env=env)
+            wall_s = time.perf_counter() - start
+            result = json.loads(out.decode().strip().splitlines()[-1])
+            # wall_s: process start to first result, including the interpreter
+            result.update({'backend': backend, 'seconds': seconds, 'cache': state, 'wall_s': wall_s})
+            results.append(result)
+    return results
+
+
+def run_startup(backends, lengths, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for seconds in lengths:
+            for result in startup(backend, seconds):
+                results.append(result)
+                print('%-10s %7gs %-5s import %6.2fs  setup %6.2fs  first score %7.2fs  wall %7.2fs'
+                      % (backend, seconds, result['cache'], result['import_s'], result['setup_s'],
+                         result['first_score_s'], result['wall_s']), file=stream)
+    return {'environment': environment(), 'startup': results}
+
+
+def resampling(backend, config, seconds, rate):
+    # Cost of the sample rate conversion front end (resample_PEAQ) relative to scoring:
+    # a pair at rate is converted to FS, then scored by the backend at FS
+    module, make_peaq, make_eval, _ = BACKENDS[backend]()
+    ref, test = (resample_PEAQ.resample(x, FS, rate) for x in synthetic(config, seconds))
+
+    start = time.perf_counter()
+    ref, test = resample_PEAQ.resample(ref, rate), resample_PEAQ.resample(test, rate)
+    resample_s = time.perf_counter() - start
+
+    make_eval(FS)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        peaq = make_peaq(FS)
+        peaq.process(ref, test)
+        peaq.avg_get()
+    score_s = time.perf_counter() - start
+    return {'backend': backend, 'config': config, 'seconds': seconds, 'rate': rate,
+            'resample_s': resample_s, 'score_s': score_s,
+            # share of the total time spent converting
+            'resample_share': resample_s / (resample_s + score_s),
+            'resample_rtf': resample_s / seconds, 'odg': _scalar(peaq.ODG)}
+
+
+def run_resampling(backends, configs, lengths, rates, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for config in configs:
+            for seconds in lengths:
+                for rate in rates:
+                    result = resampling(backend, config, seconds, rate)
+                    results.append(result)
+                    print('%-10s %-7s %7gs %6d Hz  resample %7.3fs  score %7.2fs  share %5.1f%%'
+                          % (backend, config, seconds, rate, result['resample_s'], result['score_s'],
+                             100 * result['resample_share']), file=stream)
+    return {'environment': environment(), 'resampling': results}
+
+
+def channels(backend, config, seconds, seed=0):
+    # One stereo item (both channels through the frame loop together) against the two
+    # channels scored as separate mono pairs, channel c from synthetic(.., seed + c)
+    module, make_peaq, make_eval, _ = BACKENDS[backend]()
+    pairs = [synthetic(config, seconds, seed + c) for c in range(2)]
+    ref, test = np.stack([r for r, _ in pairs]), np.stack([t for _, t in pairs])
+
+    make_eval(FS)
+    times = {}
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        for name, items in (('stereo', [(ref, test)]), ('mono', pairs)):
+            start = time.perf_counter()
+            for r, t in items:
+                peaq = make_peaq(FS)
+                peaq.process(r, t)
+                peaq.avg_get()
+            times[name] = time.perf_counter() - start
+            if name == 'stereo':
+                odg = _scalar(peaq.ODG)
+    return {'backend': backend, 'config': config, 'seconds': seconds, 'stereo_s': times['stereo'],
+            'mono_s': times['mono'], 'ratio': times['stereo'] / times['mono'], 'odg': odg}
+
+
+def run_channels(backends, configs, lengths, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for config in configs:
+            for seconds in lengths:
+                result = channels(backend, config, seconds)
+                results.append(result)
+                print('%-10s %-7s %7gs  stereo %7.2fs  2x mono %7.2fs  ratio %5.2f'
+                      % (backend, config, seconds, result['stereo_s'], result['mono_s'], result['ratio']),
+                      file=stream)
+    return {'environment': environment(), 'channels': results}
+
+
+def approximation(config, seconds, budgets, seed=0):
+    # Frame-sampled approximate ODG (approx_PEAQ, numpy) against the exact one: time,
+    # error and bootstrap interval for each budget
+    ref, test = synthetic(config, seconds, seed)
+    start = time.perf_counter()
+    exact = approx_PEAQ.approximate(ref, test, budget=1.)
+    exact_s = time.perf_counter() - start
+    results = []
+    for budget in budgets:
+        start = time.perf_counter()
+        approx = approx_PEAQ.approximate(ref, test, budget=budget, seed=seed)
+        approx_s = time.perf_counter() - start
+        low, high = approx['ODG_ci']
+        results.append({'config': config, 'seconds': seconds, 'budget': budget, 'fraction': approx['fraction'],
+                        'blocks': len(approx['blocks']), 'odg': approx['ODG'], 'odg_ci': [low, high],
+                        'exact_odg': exact['ODG'], 'error': approx['ODG'] - exact['ODG'],
+                        'covered': low <= exact['ODG'] <= high,
+                        'approx_s': approx_s, 'exact_s': exact_s, 'speedup': exact_s / approx_s})
+    return results
+
+
+def run_approximation(configs, lengths, budgets, stream=sys.stderr):
+    results = []
+    for config in configs:
+        for seconds in lengths:
+            for result in approximation(config, seconds, budgets):
+                results.append(result)
+                print('%-7s %7gs budget %5.2f  ODG %6.3f [%6.3f, %6.3f]  exact %6.3f  %5.1fx faster'
+                      % (config, seconds, result['budget'], result['odg'], result['odg_ci'][0], result['odg_ci'][1],
+                         result['exact_odg'], result['speedup']), file=stream)
+    return {'environment': environment(), 'approximation': results}
+
+
+def _pickled_task(pair):
+    # Pool task of the 'pickle' mode of sharing(): arrays sent through the pipe, own tables
+    before_mb = shared_PEAQ.private_mb()
+    odg = shared_PEAQ._score(*pair)['ODG']
+    return odg, before_mb, shared_PEAQ.private_mb(), shared_PEAQ.tables_shared()
+
+
+def _shared_task(handle):
+    # Pool task of the 'shared' mode of sharing(): pair and tables in shared memory
+    before_mb = shared_PEAQ.private_mb()
+    odg = shared_PEAQ.score(handle)['ODG']
+    return odg, before_mb, shared_PEAQ.private_mb(), shared_PEAQ.tables_shared()
+
+
+def sharing(config, seconds, workers):
+    # N workers scoring one pair each, the pairs and tables handed over by pickling
+    # ('pickle') or in shared memory ('shared', shared_PEAQ): bytes sent per task and
+    # memory private to each worker at the start and the end of its task
+    pairs = [synthetic(config, seconds, seed) for seed in range(workers)]
+    results = []
+    for mode in ('pickle', 'shared'):
+        start = time.perf_counter()
+        if mode == 'pickle':
+            with multiprocessing.get_context('spawn').Pool(workers) as pool:
+                task_bytes = len(pickle.dumps(pairs[0]))
+                out = pool.map(_pickled_task, pairs, chunksize=1)
+        else:
+            with shared_PEAQ.pool(workers) as pool:
+                segments = [shared_PEAQ.share_pair(ref, test) for ref, test in pairs]
+                task_bytes = len(pickle.dumps(segments[0].handle))
+                out = pool.map(_shared_task, [segment.handle for segment in segments], chunksize=1)
+                for segment in segments:
+                    segment.close()
+        wall_s = time.perf_counter() - start
+        results.append({'config': config, 'seconds': seconds, 'workers': workers, 'mode': mode,
+                        'wall_s': wall_s, 'task_bytes': task_bytes,
+                        'start_private_mb': max(o[1] or 0 for o in out),
+                        'end_private_mb': max(o[2] or 0 for o in out),
+                        'tables_shared': all(o[3] for o in out),
+                        'odg': [o[0] for o in out]})
+    return results
+
+
+def run_sharing(configs, lengths, counts, stream=sys.stderr):
+    results = []
+    for config in configs:
+        for seconds in lengths:
+            for workers in counts:
+                for result in sharing(config, seconds, workers):
+                    results.append(result)
+                    print('%-7s %7gs %2d workers %-6s  task %10d B  private start %7.1f MB  end %7.1f MB  wall %7.2fs'
+                          % (config, seconds, workers, result['mode'], result['task_bytes'],
+                             result['start_private_mb'], result['end_private_mb'], result['wall_s']), file=stream)
+    return {'environment': environment(), 'sharing': results}
+
+
+def live(backend, config, seconds, chunk, seed=0):
+    # Live monitor (live_PEAQ, numpy or numpy_fast) fed chunk samples at a time: latency
+    # percentiles per hop and real-time factor
+    if backend not in ('numpy', 'numpy_fast'):
+        raise ValueError(f'live monitoring runs the numpy model, not {backend}')
+    ref, test = synthetic(config, seconds, seed)
+    monitor = live_PEAQ.Monitor(AMAX, fast_math=backend == 'numpy_fast')
+    for start in range(0, len(ref), chunk):
+        monitor.push(ref[start:start + chunk], test[start:start + chunk])
+    monitor.flush()
+    result = {'backend': backend, 'config': config, 'seconds': seconds, 'chunk': chunk,
+              'odg': monitor.averages()['ODG']}
+    result.update(monitor.stats())
+    return result
+
+
+def run_live(backends, configs, lengths, chunks, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for config in configs:
+            for seconds in lengths:
+                for chunk in chunks:
+                    result = live(backend, config, seconds, chunk)
+                    results.append(result)
+                    print('%-10s %-7s %7gs chunk %5d  latency p50 %6.2f  p90 %6.2f  p99 %6.2f  max %6.2f ms'
+                          '  (hop %5.2f ms)  rtf %6.3f'
+                          % (backend, config, seconds, chunk, result['p50_ms'], result['p90_ms'], result['p99_ms'],
+                             result['p100_ms'], result['hop_ms'], result['rtf']), file=stream)
+    return {'environment': environment(), 'live': results}
+
+
+def rescoring(backend, config, seconds, edit, seed=0):
+    # Incremental re-scoring (rescore_PEAQ, numpy or numpy_fast) of a test signal edited
+    # for edit seconds in its middle, against scoring the edited pair again
+    if backend not in ('numpy', 'numpy_fast'):
+        raise ValueError(f're-scoring runs the numpy model, not {backend}')
+    fast_math = backend == 'numpy_fast'
+    ref, test = synthetic(config, seconds, seed)
+    rec = rescore_PEAQ.record(ref, test, fast_math=fast_math)
+    start = int((seconds - edit) * FS / 2)
+    stop = start + int(edit * FS)
+    test = test.copy()
+    test[start:stop] = parity_PEAQ.bandlimit(test[start:stop], 8000.)
+    begin = time.perf_counter()
+    result = rescore_PEAQ.rescore(rec, ref, test, start, stop)
+    rescore_s = time.perf_counter() - begin
+    begin = time.perf_counter()
+    full = rescore_PEAQ.record(ref, test, fast_math=fast_math)
+    full_s = time.perf_counter() - begin
+    return {'backend': backend, 'config': config, 'seconds': seconds, 'edit': edit,
+            'span': list(result['span']), 'frames': rec.Np, 'odg': result['ODG'],
+            'full_odg': full.averages()['ODG'], 'rescore_s': rescore_s, 'full_s': full_s,
+            'speedup': full_s / rescore_s}
+
+
+def run_rescoring(backends, configs, lengths, edits, stream=sys.stderr):
+    results = []
+    for backend in backends:
+        for config in configs:
+            for seconds in lengths:
+                for edit in edits:
+                    result = rescoring(backend, config, seconds, edit)
+                    results.append(result)
+                    print('%-10s %-7s %7gs edit %5gs  frames %6d..%-6d of %6d  ODG %7.4f  full %7.4f'
+                          '  %7.2fs vs %7.2fs  %6.1fx faster'
+                          % (backend, config, seconds, edit, result['span'][0], result['span'][1], result['frames'],
+                             result['odg'], result['full_odg'], result['rescore_s'], result['full_s'],
+                             result['speedup']), file=stream)
+    return {'environment': environment(), 'rescoring': results}
+
+
+def _store(path, frames, pair_frames, part_pairs, seed=0):
+    # Synthetic export_PEAQ store of frames frames: pairs of pair_frames frames, MOVs as
+    # float32 noise, MDiff_Wt slowly varying (a column the chunk min/max can prune)
+    rng = np.random.RandomState(seed)
+    with export_PEAQ.Writer(path, batch=part_pairs) as w:
+        n = pairs = 0
+        while n < frames:
+            m = min(pair_frames, frames - n)
+            result = dict((name, rng.random_sample(m).astype(np.float32)) for name in export_PEAQ.FRAME_MOVS)
+            result['MDiff_Wt'] = np.sin(np.arange(m) / 20000. + rng.uniform(0, 2 * np.pi)).astype(np.float32)
+            result.update((name, 0.) for name in export_PEAQ.AVG_MOVS)
+            w.add('pair%08d' % pairs, result)
+            n += m
+            pairs += 1
+    return pairs
+
+
+def querying(frames, pair_frames=8192, part_pairs=2048, repeat=5, seed=0):
+    # Reader.query over a synthetic store: an indexed MOV, an unindexed one pruned by the
+    # chunk min/max, a pair and time range, and a full scan of an unindexed MOV for scale.
+    # first_ms is the first query of a reader (mapping the columns it touches), ms the
+    # median of repeat more with the reader open.
+    with tempfile.TemporaryDirectory() as path:
+        begin = time.perf_counter()
+        pairs = _store(path, frames, pair_frames, part_pairs, seed)
+        build_s = time.perf_counter() - begin
+        queries = {'indexed': ({'NMRmax': (0.9999, None)}, None, None),
+                   'indexed_two': ({'NMRmax': (0.99, None), 'PD_p': (None, 0.01)}, None, None),
+                   'chunks': ({'MDiff_Wt': (0.9999, None)}, None, None),
+                   'pair_time': ({'EHS': (0.5, None)}, ['pair%08d' % (pairs // 2)], (10., 20.)),
+                   'scan': ({'PD_q': (0.9999, None)}, None, None)}
+        out = {'frames': frames, 'pairs': pairs, 'parts': len(export_PEAQ.Reader(path)), 'build_s': build_s}
+        for name, (where, names, seconds) in queries.items():
+            reader = export_PEAQ.Reader(path)
+            times = []
+            for _ in range(repeat + 1):
+                begin = time.perf_counter()
+                found = reader.query(where, names, seconds)
+                times.append(time.perf_counter() - begin)
+            reader.close()
+            out[name + '_first_ms'] = 1000 * times[0]
+            out[name + '_ms'] = 1000 * float(np.median(times[1:]))
+            out[name + '_rows'] = len(found['frame'])
+    return out
+
+
+def run_querying(counts, stream=sys.stderr):
+    results = []
+    for frames in counts:
+        result = querying(frames)
+        results.append(result)
+        print('%10d frames %3d parts  indexed %8.2f ms  two %8.2f ms  chunks %8.2f ms  pair+time %8.2f ms'
+              '  scan %9.2f ms' % (frames, result['parts'], result['indexed_ms'], result['indexed_two_ms'],
+                                   result['chunks_ms'], result['pair_time_ms'], result['scan_ms']), file=stream)
+    return {'environment': environment(), 'querying': results}
+
+
+## --------------- Comparison -------------------- ##
+
+# Report key -> (fields identifying a point, measurements compared) of every report kind
+COMPARED = {'results': (('backend', 'config', 'seconds', 'batch'), ('setup_s', 'total_s', 'peak_rss_mb')),
+            'scaling': (('backend', 'config', 'seconds', 'evaluators'), ('wall_s', 'throughput', 'peak_rss_mb')),
+            'startup': (('backend', 'seconds', 'cache'), ('import_s', 'setup_s', 'first_score_s', 'wall_s')),
+            'resampling': (('backend', 'config', 'seconds', 'rate'), ('resample_s', 'score_s')),
+            'approximation': (('config', 'seconds', 'budget'), ('approx_s', 'exact_s', 'speedup')),
+            'sharing': (('config', 'seconds', 'workers', 'mode'), ('wall_s', 'task_bytes', 'end_private_mb')),
+            'live': (('backend', 'config', 'seconds', 'chunk'), ('p50_ms', 'p99_ms', 'rtf')),
+            'rescoring': (('backend', 'config', 'seconds', 'edit'), ('rescore_s', 'full_s', 'speedup')),
+            'querying': (('frames',), ('build_s', 'indexed_ms', 'chunks_ms', 'scan_ms')),
+            'channels': (('backend', 'config', 'seconds'), ('stereo_s', 'mono_s', 'ratio'))}
+
+
+def _kind(report):
+    kinds = [name for name in report if name in COMPARED]
+    if len(kinds) != 1:
+        raise ValueError('not a bench_PEAQ report, expected one of the keys: ' + ', '.join(COMPARED))
+    return kinds[0]
+
+
+def compare(base, new, stream=sys.stdout):
+    # Ratio new/base of the measurements of every point present in both runs, which must
+    # be reports of the same kind (< 1 is an improvement for times and sizes, > 1 for
+    # throughput and speedups)
+    kind = _kind(base)
+    if _kind(new) != kind:
+        raise ValueError(f'cannot compare a {kind} report with a {_kind(new)} report')
+    fields, measures = COMPARED[kind]
+    old = dict((tuple(r[f] for f in fields), r) for r in base[kind])
+    widths = [max(len(name), 10) for name in fields + measures]
+    print(' '.join('%-*s' % (w, name) for w, name in zip(widths, fields + measures)), file=stream)
+    for r in new[kind]:
+        key = tuple(r[f] for f in fields)
+        b = old.get(key)
+        if b is None:
+            continue
+        row = ['%-*s' % (w, '%g' % x if isinstance(x, float) else x) for w, x in zip(widths, key)]
+        for w, name in zip(widths[len(fields):], measures):
+            row.append('%*.2fx' % (w - 1, r[name] / b[name]) if b[name] else '%*s' % (w, 'n/a'))
+        print(' '.join(row), file=stream)
+
+
+def _list(text, cast=str):
+    return [cast(x) for x in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PEAQ throughput and memory benchmark')
+    parser.add_argument('-b', '--backends', default='numpy,torch64,module64', help='comma separated, from: ' + ','.join(BACKENDS))
+    parser.add_argument('-c', '--configs', default='music', help='comma separated, from: ' + ','.join(CONFIGS))
+    parser.add_argument('-s', '--seconds', default='1', help='comma separated signal lengths in seconds (e.g. 1,10,60,600,3600)')
+    parser.add_argument('-n', '--batch', default='1', help='comma separated numbers of pairs scored per process')
+    parser.add_argument('-t', '--threads', type=int, help='torch intra-op threads')
+    parser.add_argument('--trace-memory', action='store_true', help='also record the tracemalloc peak (slower)')
+    parser.add_argument('--no-isolate', action='store_true', help='measure in this process instead of a fresh one')
+    parser.add_argument('-o', '--output', help='write JSON results here (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files and exit')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure cold start (import, tables, first score) with an empty and a filled table cache')
+    parser.add_argument('--scaling', help='comma separated numbers of concurrent evaluators (processes) sharing '
+                                          'the CPU, each with -t threads (default: cores // evaluators)')
+    parser.add_argument('--resample', help='comma separated input sampling rates: cost of converting them to '
+                                           '48 kHz relative to scoring')
+    parser.add_argument('--approximate', help='comma separated budgets (fractions of the frames scored): '
+                                              'frame-sampled ODG and interval against the exact ODG (numpy)')
+    parser.add_argument('--shared', help='comma separated numbers of numpy worker processes: pairs and tables '
+                                         'handed over pickled vs in shared memory')
+    parser.add_argument('--live', help='comma separated numbers of samples pushed at a time: latency and '
+                                       'real-time factor of the live monitor (numpy, numpy_fast)')
+    parser.add_argument('--rescore', help='comma separated edit lengths in seconds: incremental re-scoring of '
+                                          'an edited test signal against a full run (numpy, numpy_fast)')
+    parser.add_argument('--stereo', action='store_true',
+                        help='time a stereo item against its two channels scored as mono pairs')
+    parser.add_argument('--query', help='comma separated numbers of frames (e.g. 1e6,1e8): per-frame MOV queries '
+                                        'over a synthetic export_PEAQ store')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as a, open(args.compare[1]) as b:
+            compare(json.load(a), json.load(b))
+        return 0
+
+    if args.query:
+        report = run_querying(_list(args.query, lambda x: int(float(x))))
+    elif args.stereo:
+        report = run_channels(_list(args.backends), _list(args.configs), _list(args.seconds, float))
+    elif args.startup:
+        report = run_startup(_list(args.backends), _list(args.seconds, float))
+    elif args.rescore:
+        report = run_rescoring(_list(args.backends), _list(args.configs), _list(args.seconds, float),
+                               _list(args.rescore, float))
+    elif args.live:
+        report = run_live(_list(args.backends), _list(args.configs), _list(args.seconds, float),
+                          _list(args.live, int))
+    elif args.shared:
+        report = run_sharing(_list(args.configs), _list(args.seconds, float), _list(args.shared, int))
+    elif args.approximate:
+        report = run_approximation(_list(args.configs), _list(args.seconds, float), _list(args.approximate, float))
+    elif args.resample:
+        report = run_resampling(_list(args.backends), _list(args.configs), _list(args.seconds, float),
+                                _list(args.resample, int))
+    elif args.scaling:
+        report = run_scaling(_list(args.backends), _list(args.configs), _list(args.seconds, float),
+                             _list(args.scaling, int), args.threads)
+    else:
+        report = run(_list(args.backends), _list(args.configs), _list(args.seconds, float), _list(args.batch, int),
+                     args.threads, args.trace_memory, not args.no_isolate)
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
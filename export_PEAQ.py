@@ -0,0 +1,402 @@
+import os
+import shutil
+import socket
+import uuid
+
+import numpy as np
+
+
+'''
+Columnar export of PEAQ results.
+
+Per-frame MOVs and per-pair averaged MOVs / ODG of many pairs are written in
+batches ("parts") to a directory. Every writer creates its own parts under
+unique names and renames them into place when complete, so parallel workers
+can append to the same directory without locking, and readers only ever see
+whole parts. A part is a directory with one .npy file per column, which the
+reader memory maps; with compress=True it is a single compressed .npz
+instead (smaller, columns are decompressed when accessed).
+
+    with Writer('movs', dtype=np.float16) as w:
+        for name, peaq in results:          # evaluators after avg_get()
+            w.add(name, peaq)
+    r = Reader('movs')
+    r.pairs()['ODG'], r.frames(['NMRmax'])['NMRmax'], r.pair_frames('item7')
+
+Frame table columns: pair (index into the pair table), frame, FRAME_MOVS.
+Pair table columns: pair (name), frames, AVG_MOVS.
+
+Every part also carries indexes for queries over the frames of all pairs
+(Reader.query): for the key MOVs (INDEXED) the frame positions sorted by value
+and the sorted values, so a range of values is found by binary search, and for
+every MOV its minimum and maximum over chunks of CHUNK frames, so chunks that
+can't match are skipped. Frames are stored pair by pair in time order, so pair
+and time ranges are ranges of positions.
+
+    r.query({'NMRmax': (1.41, None)})               # NMRmax above 1.5 dB
+    r.query({'PD_p': (0.5, None)}, pairs=['item7'], time=(10, 20), columns=['PD_q'])
+
+Many small parts (e.g. one per pair from the nodes of queue_PEAQ) make every
+query open many files: compact() rewrites them into a few large ones.
+'''
+
+# Per-frame MOVs under the evaluator attribute names (PEAQ, PEAQModule outputs)
+FRAME_MOVS = ['loud_NRef', 'loud_NTest', 'MDiff_Mt1B', 'MDiff_Mt2B', 'MDiff_Wt', 'NLoud_NL',
+              'BWRef', 'BWTest', 'NMRavg', 'NMRmax', 'PD_p', 'PD_q', 'EHS']
+# Averaged MOVs in the order of the neural network input, and the ODG
+AVG_MOVS = ['avgBWRef', 'avgBWTest', 'totalNMRB', 'WinModDiff1B', 'ADBB', 'EHSB',
+            'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB', 'MFPDB', 'relDistFramesB', 'ODG']
+DTYPES = (np.float16, np.float32, np.float64)
+# MOVs with a sorted index in every part, frames per min/max chunk, seconds per frame (Nadv / Fs)
+INDEXED = ['NMRavg', 'NMRmax', 'PD_p', 'EHS', 'NLoud_NL']
+CHUNK = 4096
+FRAME_SECONDS = 1024 / 48000.
+
+
+def _array(x):
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _get(result, name):
+    # Evaluator attribute or dict entry (PEAQModule output)
+    return result[name] if isinstance(result, dict) else getattr(result, name)
+
+
+class Writer(object):
+    # path     - output directory, created if needed, shared by any number of writers
+    # dtype    - storage type of the per-frame MOVs (float16, float32 or float64); the
+    #            averaged MOVs are always float64
+    # compress - write parts as compressed .npz instead of memory mappable .npy columns
+    # batch    - pairs per part, add() writes a part when this many are buffered
+    def __init__(self, path, dtype=np.float32, compress=False, batch=256):
+        if np.dtype(dtype) not in [np.dtype(d) for d in DTYPES]:
+            raise ValueError(f'Unsupported dtype {dtype}, choose from float16, float32, float64')
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compress = compress
+        self.batch = batch
+        # Part names start with the writer's host and process, unique across workers
+        self.prefix = 'part-%s-%d-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.parts = 0
+        self._pairs = []
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, pair, result):
+        # pair   - name of the pair (e.g. the test file)
+        # result - evaluator after process() and avg_get(), or a dict with the same names
+        #          such as the output of PEAQModule for one pair (no batch dimensions)
+        frames = dict((name, _array(_get(result, name))) for name in FRAME_MOVS)
+        if frames['EHS'].ndim != 1:
+            raise ValueError(f'{pair}: per-frame MOVs of shape {frames["EHS"].shape}, only mono pairs '
+                             '(one frame axis) are stored')
+        n = len(frames['EHS'])
+        for name, x in frames.items():
+            if x.shape != (n,):
+                raise ValueError(f'{pair}: {name} has shape {x.shape}, expected ({n},)')
+        avg = dict((name, float(_array(_get(result, name)))) for name in AVG_MOVS)
+        self._pairs.append((str(pair), frames, avg))
+        if len(self._pairs) >= self.batch:
+            self.flush()
+
+    def add_batch(self, pairs, out):
+        # pairs - names of the items of a batched PEAQModule output out (leading batch axis)
+        for i, pair in enumerate(pairs):
+            self.add(pair, dict((name, _get(out, name)[i]) for name in FRAME_MOVS + AVG_MOVS))
+
+    def flush(self):
+        # Writes the buffered pairs as one part
+        if not self._pairs:
+            return
+        names = [pair for pair, _, _ in self._pairs]
+        counts = np.array([len(frames['EHS']) for _, frames, _ in self._pairs], dtype=np.int64)
+        columns = {'pair.pair': np.array(names),
+                   'pair.frames': counts,
+                   'frame.pair': np.repeat(np.arange(len(names), dtype=np.int32), counts),
+                   'frame.frame': np.concatenate([np.arange(n, dtype=np.int32) for n in counts])}
+        for name in AVG_MOVS:
+            columns['pair.' + name] = np.array([avg[name] for _, _, avg in self._pairs])
+        for name in FRAME_MOVS:
+            columns['frame.' + name] = np.concatenate([frames[name] for _, frames, _ in self._pairs]).astype(self.dtype)
+        self._pairs = []
+        columns.update(_indexes(columns))
+
+        name = '%s-%05d' % (self.prefix, self.parts)
+        self.parts += 1
+        _write_part(self.path, name, columns, self.compress)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _indexes(columns):
+    # Query indexes of a part from its frame columns: index.<MOV> (positions sorted by
+    # value) and sorted.<MOV> for the INDEXED MOVs, chunks.<MOV> (chunk, [min, max]) for all
+    out = {}
+    n = len(columns['frame.frame'])
+    position = np.int32 if n < 2 ** 31 else np.int64
+    starts = np.arange(0, n, CHUNK)
+    for name in FRAME_MOVS:
+        x = columns['frame.' + name]
+        if name in INDEXED:
+            order = np.argsort(x, kind='stable').astype(position)
+            out['index.' + name] = order
+            out['sorted.' + name] = x[order]
+        if n:
+            out['chunks.' + name] = np.stack([np.fmin.reduceat(x, starts), np.fmax.reduceat(x, starts)], -1)
+        else:
+            out['chunks.' + name] = np.zeros((0, 2), dtype=x.dtype)
+    return out
+
+
+def _write_part(path, name, columns, compress=False):
+    # Written under a hidden name and renamed, readers skip incomplete parts
+    tmp = os.path.join(path, '.' + name)
+    if compress:
+        np.savez_compressed(tmp + '.npz', **columns)
+        os.replace(tmp + '.npz', os.path.join(path, name + '.npz'))
+    else:
+        os.makedirs(tmp)
+        for column, x in columns.items():
+            np.save(os.path.join(tmp, column + '.npy'), x)
+        os.rename(tmp, os.path.join(path, name))
+
+
+def _ranges(lo, hi):
+    # Concatenated np.arange(lo[i], hi[i]) of the non-empty ranges
+    lo, hi = np.asarray(lo, dtype=np.int64), np.asarray(hi, dtype=np.int64)
+    keep = hi > lo
+    lo, hi = lo[keep], hi[keep]
+    if not len(lo):
+        return np.zeros(0, dtype=np.int64)
+    n = hi - lo
+    steps = np.ones(int(n.sum()), dtype=np.int64)
+    steps[0] = lo[0]
+    ends = np.cumsum(n)[:-1]
+    steps[ends] = lo[1:] - hi[:-1] + 1
+    return np.cumsum(steps)
+
+
+def _between(x, low, high):
+    keep = np.ones(len(x), dtype=bool)
+    if low is not None:
+        keep &= x >= low
+    if high is not None:
+        keep &= x <= high
+    return keep
+
+
+def compact(path, frames=1 << 24, compress=False):
+    # Rewrites the parts of path into parts of about frames frames each, with the indexes
+    # of the current version; a pair stored more than once (a job scored twice) is kept
+    # once. Readers opened meanwhile may see a pair twice until they are reopened.
+    reader = Reader(path)
+    if not len(reader):
+        return 0
+    dtype = reader.part(0)['frame.' + FRAME_MOVS[0]].dtype
+    seen = set()
+    with Writer(path, dtype=dtype, compress=compress, batch=1 << 62) as w:
+        buffered = 0
+        for i in range(len(reader)):
+            part = reader.part(i)
+            names = part['pair.pair']
+            counts = part['pair.frames']
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+            for j, pair in enumerate(names):
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                rows = slice(int(starts[j]), int(starts[j] + counts[j]))
+                result = dict((name, np.array(part['frame.' + name][rows])) for name in FRAME_MOVS)
+                result.update((name, float(part['pair.' + name][j])) for name in AVG_MOVS)
+                w.add(pair, result)
+                buffered += int(counts[j])
+                if buffered >= frames:
+                    w.flush()
+                    buffered = 0
+    old = reader.names
+    reader.close()
+    for name in old:
+        full = os.path.join(path, name)
+        if os.path.isdir(full):
+            shutil.rmtree(full)
+        else:
+            os.remove(full)
+    return w.parts
+
+
+class Reader(object):
+    # Lazy view of the parts in path at the time of opening (reopen to see newer parts)
+    def __init__(self, path):
+        self.path = path
+        self.names = sorted(name for name in os.listdir(path) if name.startswith('part-'))
+        self._parts = {}
+
+    def part(self, i):
+        # {table.column: array} of part i, memory mapped .npy or lazily read .npz members
+        if i not in self._parts:
+            self._parts[i] = _Columns(os.path.join(self.path, self.names[i]))
+        return self._parts[i]
+
+    def __len__(self):
+        return len(self.names)
+
+    def close(self):
+        for part in self._parts.values():
+            part.close()
+        self._parts = {}
+
+    def _table(self, table, columns, all_columns):
+        columns = all_columns if columns is None else columns
+        out = {}
+        offset = 0
+        for i in range(len(self)):
+            part = self.part(i)
+            for column in columns:
+                x = part[table + '.' + column]
+                if table == 'frame' and column == 'pair':
+                    # Local pair indices to indices into pairs()
+                    x = x + offset
+                out.setdefault(column, []).append(x)
+            offset += len(part['pair.frames'])
+        return dict((column, np.concatenate(x) if x else np.zeros(0)) for column, x in out.items())
+
+    def pairs(self, columns=None):
+        # Pair table of all parts: pair, frames and AVG_MOVS (or the given columns)
+        return self._table('pair', columns, ['pair', 'frames'] + AVG_MOVS)
+
+    def frames(self, columns=None):
+        # Frame table of all parts: pair, frame and FRAME_MOVS (or the given columns)
+        return self._table('frame', columns, ['pair', 'frame'] + FRAME_MOVS)
+
+    def pair_frames(self, pair):
+        # Per-frame MOVs of one pair as a dict of (memory mapped) slices, like PEAQ.get() flattened
+        for i in range(len(self)):
+            part = self.part(i)
+            names = part['pair.pair']
+            hit = np.flatnonzero(names == pair)
+            if len(hit):
+                counts = part['pair.frames']
+                start = int(np.sum(counts[:hit[0]]))
+                frames = slice(start, start + int(counts[hit[0]]))
+                return dict((name, part['frame.' + name][frames]) for name in FRAME_MOVS)
+        raise KeyError(pair)
+
+    def query(self, where=None, pairs=None, time=None, columns=None):
+        # Frames of all parts matching every condition
+        #   where   - {MOV: (low, high)}, inclusive bounds, None for no bound
+        #   pairs   - only frames of these pair names
+        #   time    - (start, end) in seconds from the start of the pair, inclusive
+        #   columns - MOVs returned (default: those of where)
+        # Returns {pair (index into pairs()), frame, time, columns...} in storage order
+        where = dict(where or {})
+        columns = list(where) if columns is None else list(columns)
+        out = dict((column, []) for column in ['pair', 'frame', 'time'] + columns)
+        offset = 0
+        for i in range(len(self)):
+            part = self.part(i)
+            rows = self._rows(part, where, pairs, time)
+            out['pair'].append(part['frame.pair'][rows].astype(np.int64) + offset)
+            frame = part['frame.frame'][rows]
+            out['frame'].append(frame)
+            out['time'].append(frame * FRAME_SECONDS)
+            for column in columns:
+                out[column].append(part['frame.' + column][rows])
+            offset += len(part['pair.frames'])
+        return dict((column, np.concatenate(x) if x else np.zeros(0)) for column, x in out.items())
+
+    def _rows(self, part, where, pairs, time):
+        # Sorted positions of the matching frames of a part
+        counts = part['pair.frames'].astype(np.int64)
+        starts = np.cumsum(counts) - counts
+        rows = None
+        if pairs is not None or time is not None:
+            # Frames of a time range are a range of positions in every pair
+            first, last = 0, counts
+            if time is not None:
+                first = 0 if time[0] is None else max(int(np.floor(time[0] / FRAME_SECONDS)), 0)
+                if time[1] is not None:
+                    last = np.minimum(counts, int(np.ceil(time[1] / FRAME_SECONDS)) + 1)
+            hit = np.isin(part['pair.pair'], list(pairs)) if pairs is not None else np.ones(len(counts), dtype=bool)
+            rows = _ranges((starts + first)[hit], (starts + last)[hit])
+
+        # The indexed condition with the fewest frames
+        best = None
+        for name, (low, high) in where.items():
+            if 'index.' + name not in part:
+                continue
+            values = part['sorted.' + name]
+            # Bounds in the stored type, as the exact comparison below does (a float bound
+            # would make searchsorted convert the whole column)
+            lo = 0 if low is None else np.searchsorted(values, values.dtype.type(low), 'left')
+            hi = len(values) if high is None else np.searchsorted(values, values.dtype.type(high), 'right')
+            if best is None or hi - lo < best[2] - best[1]:
+                best = (name, lo, hi)
+        if best is not None and (rows is None or best[2] - best[1] < len(rows)):
+            found = np.sort(part['index.' + best[0]][best[1]:best[2]]).astype(np.int64)
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+
+        if rows is None:
+            # Chunks whose value ranges overlap every condition
+            keep = None
+            for name, (low, high) in where.items():
+                if 'chunks.' + name not in part:
+                    continue
+                chunks = part['chunks.' + name]
+                k = np.ones(len(chunks), dtype=bool)
+                if low is not None:
+                    k &= chunks[:, 1] >= low
+                if high is not None:
+                    k &= chunks[:, 0] <= high
+                keep = k if keep is None else keep & k
+            n = int(counts.sum())
+            if keep is None or 8 * keep.sum() > len(keep):
+                # Most chunks left: comparing whole columns beats gathering their frames
+                match = np.ones(n, dtype=bool)
+                for name, (low, high) in where.items():
+                    match &= _between(part['frame.' + name], low, high)
+                return np.flatnonzero(match)
+            lo = np.flatnonzero(keep) * CHUNK
+            rows = _ranges(lo, np.minimum(lo + CHUNK, n))
+
+        # Exact conditions on the candidates
+        keep = np.ones(len(rows), dtype=bool)
+        for name, (low, high) in where.items():
+            keep &= _between(part['frame.' + name][rows], low, high)
+        if time is not None:
+            keep &= _between(part['frame.frame'][rows] * FRAME_SECONDS, *time)
+        return rows[keep]
+
+
+class _Columns(object):
+    # Columns of a part, read on first access: memory mapped from a part directory,
+    # decompressed from a .npz part
+    def __init__(self, path):
+        self.path = path
+        self.npz = np.load(path) if path.endswith('.npz') else None
+        self._columns = {}
+
+    def __contains__(self, column):
+        if self.npz is not None:
+            return column in self.npz.files
+        return column in self._columns or os.path.exists(os.path.join(self.path, column + '.npy'))
+
+    def close(self):
+        if self.npz is not None:
+            self.npz.close()
+        self._columns = {}
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            if self.npz is not None:
+                self._columns[column] = self.npz[column]
+            else:
+                self._columns[column] = np.load(os.path.join(self.path, column + '.npy'), mmap_mode='r')
+        return self._columns[column]
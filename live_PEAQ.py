@@ -0,0 +1,271 @@
+import collections
+import time
+
+import numpy as np
+
+import export_PEAQ
+import numpy_PEAQ
+import resample_PEAQ
+
+
+'''
+Live monitoring of a test signal (e.g. an encoder output) against its reference.
+
+The signals are pushed as they arrive, in hops of Nadv = 1024 samples or chunks of
+any size. The last two hops of each signal are kept in a ring buffer of one frame,
+and every hop that completes a frame runs the numpy model on that one frame: the
+per-frame MOVs come out one hop after the end of the frame's second half, and the
+averaged MOVs and ODG of everything so far are updated with them (Running). The
+work per hop does not depend on how long the monitor has run, so neither does the
+latency.
+
+    monitor = Monitor()
+    for ref_hop, test_hop in stream:
+        for frame in monitor.push(ref_hop, test_hop):
+            frame['ODG'], frame['NMRavg'], frame['latency']
+    monitor.flush()                 # end of the signals: the last frame
+    monitor.averages()              # = PEAQ.process + avg_get of the whole signals
+    monitor.stats()                 # latency percentiles and real-time factor
+
+Other input rates are converted to 48 kHz on the fly (resample_PEAQ.Resampler).
+'''
+
+AMAX = 32768
+FS = 48000
+
+
+class Running(object):
+    # The averages of PEAQ.avg_get, updated frame by frame in constant time and memory.
+    # Skipping the first 0.5 s of the modulation differences (Ndel) and the noise loudness
+    # frames before both loudnesses reach the threshold are decided as the frames arrive:
+    # the threshold frame is known before any frame it excludes or includes.
+    def __init__(self, peaq):
+        self.peaq = peaq
+        Fss = peaq.Fs / peaq.Nadv
+        self.Ndel = int(max(np.ceil(0.5 * Fss), 0))
+        self.N50ms = int(np.ceil(0.05 * Fss))
+        # PQ_avgModDiffB window (at 48 kHz, as there)
+        self.L = int(np.floor(0.1 * 48000 / 1024))
+        self.Np = 0
+        self.BW = np.zeros((2, 2))          # [ref, test] x [sum, count] of BW >= 0
+        self.NMRavg = 0.
+        self.NMRdist = 0
+        self.EHS = [0., 0]
+        self.sqrtMt1B = collections.deque(maxlen=self.L)
+        self.win = [0., 0]                  # sum of window averages ** 4, windows
+        self.Mt = np.zeros(3)               # sums of Wt * Mt1B, Wt * Mt2B, Wt
+        self.Mtn = 0
+        self.Phc = self.Pcmax = 0.
+        self.nd = 0
+        self.Qsum = 0.
+        self.Nloud = None
+        self.NL = [0., 0]
+
+    def update(self, frame):
+        # frame - {name: value} of the export_PEAQ.FRAME_MOVS of the next frame
+        i = self.Np
+        self.Np += 1
+        for k, name in enumerate(('BWRef', 'BWTest')):
+            if frame[name] >= 0:
+                self.BW[k] += frame[name], 1
+        self.NMRavg += frame['NMRavg']
+        self.NMRdist += frame['NMRmax'] > 10 ** (1.5 / 10)
+        if frame['EHS'] >= 0:
+            self.EHS[0] += frame['EHS']
+            self.EHS[1] += 1
+
+        if i >= self.Ndel:
+            self.sqrtMt1B.appendleft(np.sqrt(frame['MDiff_Mt1B']))
+            if len(self.sqrtMt1B) == self.L:
+                t = 0
+                for x in self.sqrtMt1B:
+                    t = t + x
+                self.win[0] += (t / self.L) ** 4
+                self.win[1] += 1
+            W = frame['MDiff_Wt']
+            self.Mt += W * frame['MDiff_Mt1B'], W * frame['MDiff_Mt2B'], W
+            self.Mtn += 1
+
+        c0 = 0.9
+        self.Phc = c0 * self.Phc + (1 - c0) * frame['PD_p']
+        self.Pcmax = max(self.Pcmax, self.Phc)
+        if frame['PD_p'] > 0.5:
+            self.nd += 1
+            self.Qsum += frame['PD_q']
+
+        Thr = 0.1
+        if self.Nloud is None and frame['loud_NRef'] > Thr and frame['loud_NTest'] > Thr:
+            self.Nloud = i
+        if self.Nloud is not None and i >= max(self.Nloud + self.N50ms, self.Ndel):
+            self.NL[0] += frame['NLoud_NL'] ** 2
+            self.NL[1] += 1
+
+    def values(self):
+        # Averaged MOVs and ODG (export_PEAQ.AVG_MOVS) of the frames so far, NaN where
+        # avg_get averages over no frames
+        def mean(s, n):
+            return s / n if n else np.nan
+
+        out = {}
+        out['avgBWRef'] = mean(*self.BW[0])
+        out['avgBWTest'] = mean(*self.BW[1])
+        out['totalNMRB'] = 10 * np.log10(mean(self.NMRavg, self.Np)) if self.Np else np.nan
+        out['relDistFramesB'] = mean(self.NMRdist, self.Np)
+        out['WinModDiff1B'] = np.sqrt(self.win[0] / self.win[1]) if self.win[1] else 0
+        out['AvgModDiff1B'] = self.Mt[0] / self.Mt[2] if self.Mtn else 0
+        out['AvgModDiff2B'] = self.Mt[1] / self.Mt[2] if self.Mtn else 0
+        if self.nd == 0:
+            out['ADBB'] = 0
+        elif self.Qsum > 0:
+            out['ADBB'] = np.log10(self.Qsum / self.nd)
+        else:
+            out['ADBB'] = -0.5
+        out['MFPDB'] = self.Pcmax
+        out['RmsNoiseLoudB'] = (self.NL[0] / self.NL[1]) ** 0.5 if self.NL[1] else 0
+        out['EHSB'] = 1000 * mean(*self.EHS)
+        out['ODG'] = self.peaq.PQnNetB([out[name] for name in export_PEAQ.AVG_MOVS[:-1]])
+        return dict((name, float(out[name])) for name in export_PEAQ.AVG_MOVS)
+
+
+class Monitor(object):
+    # Amax      - maximum signal amplitude (16-bit scale)
+    # Fs        - rate of the pushed signals, converted to 48 kHz if different
+    # fast_math - numpy_PEAQ fast math kernels (the exact EHS correlation alone takes about
+    #             two hops per frame)
+    # window    - hops kept for the latency percentiles
+    def __init__(self, Amax=AMAX, Fs=FS, fast_math=True, window=10000):
+        peaq = self.peaq = numpy_PEAQ.PEAQ(Amax, fast_math=fast_math)
+        peaq.PQE = numpy_PEAQ.PQEval(Amax, peaq.Fs, peaq.NF, fast_math=fast_math)
+        peaq.PQ_workspace()
+        # One frame at a time, in row 0
+        peaq.PQ_frameArrays(1)
+        peaq.Np = 1
+        self.Nadv = peaq.Nadv
+        self.rate = peaq.Fs
+        self.resamplers = None
+        if int(Fs) != peaq.Fs:
+            self.resamplers = [resample_PEAQ.Resampler(Fs, peaq.Fs) for _ in range(2)]
+
+        # Last two hops (one frame) of both signals, the hop being filled
+        self.x = np.zeros((2, peaq.NF))
+        self.hop = np.zeros((2, self.Nadv))
+        self.filled = 0
+        self.X2 = np.zeros((2, peaq.NF // 2 + 1))
+        self.Ef = np.zeros((2, peaq.Nc))
+        # Excitation of a silent frame, computed at the first one
+        self.zero = None
+
+        self.hops = 0
+        self.frames = 0
+        self.closed = False
+        self.running = Running(peaq)
+        self.latency = collections.deque(maxlen=window)
+        self.busy = 0.
+
+    def push(self, ref, test):
+        # Appends samples (equal numbers) of both mono signals; returns the frames they
+        # complete as {frame, FRAME_MOVS..., AVG_MOVS of the frames so far..., latency}
+        start = time.perf_counter()
+        if self.closed:
+            raise ValueError('monitor is flushed')
+        ref = np.asarray(ref, dtype=np.float64)
+        test = np.asarray(test, dtype=np.float64)
+        if ref.ndim > 1 or test.ndim > 1:
+            raise ValueError(f'mono chunks expected, not of shape {ref.shape} and {test.shape}')
+        ref, test = ref.reshape(-1), test.reshape(-1)
+        if len(ref) != len(test):
+            raise ValueError(f'{len(ref)} reference and {len(test)} test samples')
+        if self.resamplers is not None:
+            ref, test = [r.process(x) for r, x in zip(self.resamplers, (ref, test))]
+        self.busy += time.perf_counter() - start
+        return self._append(ref, test)
+
+    def flush(self):
+        # End of the signals: the frame of the last complete hop, its second half
+        # zero padded as in PEAQ.process
+        if self.closed:
+            return []
+        start = time.perf_counter()
+        out = []
+        if self.resamplers is not None:
+            ref, test = [r.flush() for r in self.resamplers]
+            self.busy += time.perf_counter() - start
+            out = self._append(ref, test)
+        self.closed = True
+        if self.hops:
+            self.hop[:, self.filled:] = 0
+            out.append(self._frame(time.perf_counter()))
+        return out
+
+    def _append(self, ref, test):
+        out = []
+        n = 0
+        while n < len(ref):
+            start = time.perf_counter()
+            m = min(self.Nadv - self.filled, len(ref) - n)
+            self.hop[0, self.filled:self.filled + m] = ref[n:n + m]
+            self.hop[1, self.filled:self.filled + m] = test[n:n + m]
+            self.filled += m
+            n += m
+            if self.filled == self.Nadv:
+                if self.hops:
+                    out.append(self._frame(start))
+                else:
+                    self.x[:, self.Nadv:] = self.hop
+                self.hops += 1
+                self.filled = 0
+        return out
+
+    def _frame(self, start):
+        # Frame of the last complete hop and the hop in self.hop
+        peaq, PQE, X2 = self.peaq, self.peaq.PQE, self.X2
+        x = self.x
+        x[:, :self.Nadv] = x[:, self.Nadv:]
+        x[:, self.Nadv:] = self.hop
+
+        silent = peaq.skip_silent and not x.any()
+        if silent and self.zero is not None:
+            X2[:] = 0
+            EbN = self.zero[0]
+            PQE.Es[:] = self.zero[1]
+        else:
+            PQE.PQDFTFrame(x[0], out=X2[0])
+            PQE.PQDFTFrame(x[1], out=X2[1])
+            EbN, Es = PQE.PQ_excitCB(X2)
+            if silent:
+                self.zero = EbN.copy(), Es.copy()
+
+        PQE.PQ_timeSpread(PQE.Es[0], self.Ef[0], out=peaq.EhsR[0])
+        PQE.PQ_timeSpread(PQE.Es[1], self.Ef[1], out=peaq.EhsT[0])
+        EP = peaq.PQadapt(peaq.EhsR[0], peaq.EhsT[0], 'FFT')
+        M, ERavg = PQE.PQmodPatt()
+        peaq.PQ_movBlock(0, M[:, None], ERavg[None], EP[:, None])
+        peaq.BWRef[0], peaq.BWTest[0] = peaq.computeBW(X2[0], X2[1])
+        peaq.NMRavg, peaq.NMRmax = peaq.computeNMR(EbN[None], peaq.EhsR)
+        peaq.EHS[0] = peaq.PQmovEHS(x[0], x[1], X2)
+
+        frame = dict((name, float(np.asarray(getattr(peaq, name))[0])) for name in export_PEAQ.FRAME_MOVS)
+        self.running.update(frame)
+        result = self.running.values()
+        result.update(frame)
+        result['frame'] = self.frames
+        self.frames += 1
+        latency = time.perf_counter() - start
+        self.busy += latency
+        self.latency.append(latency)
+        result['latency'] = latency
+        return result
+
+    def averages(self):
+        # Averaged MOVs and ODG (export_PEAQ.AVG_MOVS) of the frames so far
+        return self.running.values()
+
+    def stats(self):
+        # Latency from a hop completing a frame to its MOVs (percentiles over the last
+        # window hops, ms) and real-time factor (processing time / signal time, < 1 keeps up)
+        lat = 1000 * np.asarray(self.latency)
+        out = {'frames': self.frames, 'hop_ms': 1000 * self.Nadv / self.rate,
+               'rtf': self.busy / (self.hops * self.Nadv / self.rate) if self.hops else np.nan}
+        for p in (50, 90, 99, 100):
+            out['p%d_ms' % p] = float(np.percentile(lat, p)) if len(lat) else np.nan
+        return out
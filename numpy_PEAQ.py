@@ -1,16 +1,122 @@
-import numpy as np
+import os
 import time
 
+import numpy as np
+
+import align_PEAQ
+import resample_PEAQ
+
 
 '''
 Original code: https://github.com/stephencwelch/Perceptual-Coding-In-Python/tree/master/PEAQPython
 '''
+
+# numpy >= 2 can write the FFT into a given array
+_FFT_OUT = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+
+def _rfft(x, out):
+    if _FFT_OUT:
+        return np.fft.rfft(x, out=out)
+    out[:] = np.fft.rfft(x)
+    return out
+
+
+# fast_math: the non-integer powers, exponentials and logarithms of the loudness, noise
+# loudness, PD, spreading and modulation kernels are evaluated in float32 and in the log
+# domain, x ** p as exp2(p * log2(x)), with per-band factors precomputed (PQfastTables).
+# Each such power has a relative error below FAST_MATH_RTOL for |p * log2(x)| <= 64
+# (float32 rounding of p * log2(x), scaled by ln 2); sums and the frame recursions stay
+# in float64. The EHS correlation is one matrix-vector product (BLAS summation order)
+# instead of the frame loop. The ODG of the tested signals moves by less than
+# FAST_MATH_ODG_TOL.
+FAST_MATH_RTOL = 1e-5
+FAST_MATH_ODG_TOL = 1e-3
+
+
+def _pow32(x, p):
+    # x ** p for x > 0 in float32 (fast_math)
+    y = np.log2(x, dtype=np.float32)
+    y *= np.float32(p)
+    return np.exp2(y, out=y)
+
+
+# Level independent PQEval tables (see tables()), bump TABLES_VERSION when their computation changes
+TABLES = ['f', 'W2', 'Nc', 'fc', 'fl', 'fu', 'dz', 'EIN', 'Et', 'sIdx', 'Ets',
+          'aTS', 'bTS', 'aMod', 'bMod', 'bFss', 'Bs', 'df', 'Emin', 'U']
+TABLES_VERSION = 1
+# Recursive state of PEAQ.PQ_state
+STATE = ['Ef', 'P', 'Rn', 'Rd', 'PC', 'DE', 'Ese', 'Eavg']
+# Averaged MOVs in the order of the neural network input
+MOVS = ['avgBWRef', 'avgBWTest', 'totalNMRB', 'WinModDiff1B', 'ADBB', 'EHSB',
+        'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB', 'MFPDB', 'relDistFramesB']
+_tables = {}
+
+
+def cache_dir():
+    # Directory of the table cache: $PEAQ_CACHE (empty = no files), default ~/.cache/PEAQ_python
+    path = os.environ.get('PEAQ_CACHE')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'PEAQ_python')
+    return path
+
+
+def tables(Fs=48000, NF=2048):
+    # PQEval tables for a sampling rate and frame length, computed once per process
+    # (building U alone takes seconds) and stored as .npz in cache_dir() for the next
+    # processes. The arrays are read-only, every PQEval with the same Fs, NF shares them.
+    key = (int(Fs), int(NF))
+    if key in _tables:
+        return _tables[key]
+
+    path = None
+    if cache_dir():
+        path = os.path.join(cache_dir(), 'PQEval_v%d_%d_%d.npz' % ((TABLES_VERSION,) + key))
+    table = None
+    if path is not None and os.path.exists(path):
+        try:
+            with np.load(path) as f:
+                table = dict((name, f[name]) for name in TABLES)
+        except (OSError, KeyError, ValueError):
+            # Truncated or stale file, computed again below
+            table = None
+    if table is None:
+        # __init__ computes the tables once, they are taken from the attributes
+        computed = PQEval(1, key[0], key[1], cache=False)
+        table = dict((name, getattr(computed, name)) for name in TABLES)
+        if path is not None:
+            try:
+                os.makedirs(cache_dir(), exist_ok=True)
+                # Written under a temporary name and renamed, concurrent processes see whole files
+                tmp = '%s.%d.tmp.npz' % (path[:-4], os.getpid())
+                np.savez(tmp, **table)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+    for name, value in table.items():
+        if np.ndim(value) == 0:
+            table[name] = value.item() if isinstance(value, np.ndarray) else value
+        else:
+            value = np.array(value)
+            value.setflags(write=False)
+            table[name] = value
+    table['Nc'] = int(table['Nc'])
+    _tables[key] = table
+    return table
+
+
 class PQEval(object):
-    def __init__(self, Amax = 1, Fs= 48000, NF= 2048):
+    def __init__(self, Amax = 1, Fs= 48000, NF= 2048, cache=True, fast_math=False, channels=None):
         #Amax is maximum signal amplitude, Fs is sampling frequency
         #Setup parameters and precompute quantities we'll need.
+        # cache = take the level independent tables from tables() instead of computing them
+        # fast_math = approximate float32 / log domain kernels (see FAST_MATH_RTOL)
+        # channels = number of channels of a multichannel signal, the per-frame buffers get
+        #            a leading channel axis and the kernels process all channels at once
         self.Fs = Fs
         self.NF = NF
+        self.fast_math = fast_math
 
         #Hardcode the louness scalling params:
         fcLoudness = 1019.5
@@ -22,6 +128,63 @@ class PQEval(object):
         #Precompute hann window:
         self.hw = self.GL*self.PQHannWin(self.NF)
 
+        #Tables that don't depend on Amax (shared, read-only when cached)
+        if cache:
+            self.__dict__.update(tables(Fs, NF))
+        else:
+            self.PQtables()
+
+        # Allocate storage. The per-frame kernels write into these buffers (and the
+        # scratch arrays below), so a frame allocates no arrays.
+        lead = () if channels is None else (channels,)
+        self.Eb = np.zeros(lead + (2, self.Nc))
+        self.Xw2 = np.zeros(lead + (2, self.NF//2+1))
+        self.XwN2 = np.zeros(lead + (self.NF//2+1,))
+        self.EbN = np.zeros(lead + (self.Nc,))
+        self.E = np.zeros(self.Eb.shape)
+        self.Es = np.zeros(lead + (2, self.Nc))
+        self.xw = np.zeros(lead + (self.NF,))
+        self.X = np.zeros(lead + (self.NF//2+1,), dtype=complex)
+        self.Xi2 = np.zeros(lead + (self.NF//2+1,))
+        self.aUCEe = np.zeros(self.Nc)
+        self.Ene = np.zeros(self.Nc)
+        self.tmpNc = np.zeros(lead + (self.Nc,))
+        self.Ee = np.zeros(lead + (2, self.Nc))
+        self.M = np.zeros(lead + (2, self.Nc))
+        self.dEe = np.zeros(lead + (2, self.Nc))
+
+        # check FLAG, False means first operation
+        self.check_PQmodPatt = False
+
+        if fast_math:
+            self.PQfastTables()
+
+    def PQfastTables(self):
+        # Per-band factors of the fast_math kernels
+        e = 0.4
+        Nc = self.Nc
+        l = np.arange(Nc)
+        aL = 10 ** (2.7 * self.dz)
+        # Spreading: log2 of the level independent upper slope factor, lower slope sums
+        f32 = np.float32
+        self.fm_log2aUC = ((-2.4 - 23 / self.fc) * self.dz * np.log2(10)).astype(f32)
+        self.fm_gIL = ((1 - aL ** (-1 * (l + 1))) / (1 - aL ** (-1))).astype(f32)
+        self.fm_NcL = (Nc - l).astype(f32)
+        lag = l[None, :] - l[:, None]
+        # Lower spreading Es[i] = sum over l >= i of aL^(-e (l - i)) Ene[l], as Ene @ fm_low
+        self.fm_low = np.where(lag >= 0, aL ** (-e * np.maximum(lag, 0)), 0.).T.copy()
+        # Upper spreading Es[l] = sum over i < l of Ene[i] aUCEe[i]^(l - i), exponents (l - i)
+        self.fm_up = lag > 0
+        self.fm_lag = np.where(self.fm_up, lag, 0).astype(f32)
+        self.fm_log2Bs = np.log2(self.Bs).astype(f32)
+        # Loudness: 1 - s + s * Ehs / Et = fm_A + fm_B * Ehs
+        self.fm_A = 1 - self.sIdx
+        self.fm_B = self.sIdx / self.Et
+        self.fm_log2EIN = np.log2(self.EIN).astype(f32)
+
+    def PQtables(self):
+        # Computes the tables listed in TABLES as attributes and returns them as a dict
+
         #Precompute frequency vector:
         self.f = np.linspace(0, self.Fs//2, self.NF//2+1)
 
@@ -34,16 +197,23 @@ class PQEval(object):
         #Internal Noise:
         self.EIN = self.PQIntNoise(self.fc)
 
-        #Precompute normalization for frequency spreading:
+        #Loudness thresholds and excitation index:
+        self.Et = self.PQ_enThresh(self.fc)
+        self.sIdx = self.PQ_exIndex(self.fc)
+        self.Ets = 1.07664 * (self.Et / (self.sIdx * 1e4)) ** 0.23
+
+        #Time constants of the time spreading and of the modulation patterns:
+        Fss = float(self.Fs)/(self.NF//2)
+        self.aTS, self.bTS = self.PQtConst(0.030, 0.008, self.fc, Fss)
+        # (2, Nc) for both signals at once, in-place products with broadcasting use a buffer
+        self.aMod, self.bMod = [np.stack([x, x]) for x in self.PQtConst(0.050, 0.008, self.fc, Fss)]
+        self.bFss = self.bMod * Fss
+
+        #Precompute normalization for frequency spreading (aUCEe, Ene are its scratch arrays):
+        self.aUCEe = np.zeros(self.Nc)
+        self.Ene = np.zeros(self.Nc)
         self.Bs = self.PQ_SpreadCB(np.ones(self.Nc), np.ones(self.Nc))
 
-        # Allocate storage
-        self.Eb = np.zeros((2, self.Nc))
-        self.Xw2 = np.zeros((2, self.NF//2+1))
-        self.XwN2 = np.zeros(self.NF//2+1)
-        self.E = np.zeros(self.Eb.shape)
-        self.Es = np.zeros((2, self.Nc))
-
         #Precompute for PQ Group:
         self.df = float(self.Fs) / self.NF
         self.Emin = 1e-12
@@ -55,64 +225,80 @@ class PQEval(object):
                 temp = (np.amin([self.fu[i], (k+0.5)*self.df]) - np.amax([self.fl[i], (k-0.5)*self.df])) / self.df
                 self.U[k, i] = np.amax([0, temp])
 
-        # check FLAG, False means first operation
-        self.check_PQmodPatt = False
+        return dict((name, getattr(self, name)) for name in TABLES)
                 
-    def PQDFTFrame(self, x):
+    def PQDFTFrame(self, x, out=None):
+        # x - (..., NF) frame, with the channel axis of the buffers if any
+        # out - (..., NF/2+1) array for the squared magnitude, allocated if None
+        if out is None:
+            out = np.zeros(self.xw.shape[:-1] + (self.NF//2+1,))
+
         # Window the data
-        xw = self.hw * x
+        np.multiply(self.hw, x, out=self.xw)
 
-        # DFT (output is real followed by imaginary)
-        X = self.PQRFFT(xw, self.NF, 1)
+        # DFT
+        _rfft(self.xw, self.X)
 
         # Squared magnitude
-        X2 = self.PQRFFTMSq(X, self.NF)
+        np.multiply(self.X.real, self.X.real, out=out)
+        np.multiply(self.X.imag, self.X.imag, out=self.Xi2)
+        out += self.Xi2
         
-        return X2
+        return out
 
     def PQ_excitCB(self, X2):
         # Critical band grouping and frequency spreading
+        # X2 - (..., 2, NF/2+1) reference and test spectra, with the channel axis of the buffers
+        # Returns the EbN and Es buffers, overwritten at the next frame
 
-        # Outer and middle ear filtering
-        self.Xw2[0,:] = self.W2 * X2[0,0:self.NF//2+1]
-        self.Xw2[1,:] = self.W2 * X2[1,0:self.NF//2+1]
+        # Outer and middle ear filtering, row by row: a broadcast operand makes the ufunc
+        # allocate buffers
+        K = self.NF//2+1
+        for X, Xw in zip(X2.reshape(-1, X2.shape[-1]), self.Xw2.reshape(-1, K)):
+            np.multiply(self.W2, X[0:K], out=Xw)
 
         # Form the difference magnitude signal
-        self.XwN2 = self.Xw2[0,:] - 2*np.sqrt(self.Xw2[0,:]*self.Xw2[1,:]) + self.Xw2[1,:]
+        np.multiply(self.Xw2[..., 0, :], self.Xw2[..., 1, :], out=self.XwN2)
+        np.sqrt(self.XwN2, out=self.XwN2)
+        self.XwN2 *= -2
+        self.XwN2 += self.Xw2[..., 0, :]
+        self.XwN2 += self.Xw2[..., 1, :]
         
         # Group into partial critical bands
-        self.Eb[0,:] = self.PQgroupCB(self.Xw2[0,:])
-        self.Eb[1,:] = self.PQgroupCB(self.Xw2[1,:])
-        self.EbN     = self.PQgroupCB(self.XwN2)
+        self.PQgroupCB(self.Xw2, out=self.Eb)
+        self.PQgroupCB(self.XwN2, out=self.EbN)
 
         # Add the internal noise term => "Pitch patterns"
-        self.E[0,:] = self.Eb[0,:] + self.EIN
-        self.E[1,:] = self.Eb[1,:] + self.EIN
+        for Eb, E in zip(self.Eb.reshape(-1, self.Nc), self.E.reshape(-1, self.Nc)):
+            np.add(Eb, self.EIN, out=E)
 
         # Critical band spreading => "Unsmeared (in time) excitation patterns"
-        self.Es[0,:] = self.PQspreadCB(self.E[0,:])
-        self.Es[1,:] = self.PQspreadCB(self.E[1,:])
+        if self.fast_math:
+            self.Es[:] = self.PQ_SpreadCBfast(self.E)
+        else:
+            for E, Es in zip(self.E.reshape(-1, self.Nc), self.Es.reshape(-1, self.Nc)):
+                self.PQspreadCB(E, out=Es)
         
         return self.EbN, self.Es
 
-    def PQgroupCB(self, X2):
+    def PQgroupCB(self, X2, out=None):
         # Group a DFT energy vector into critical bands
-        # X2 - Squared-magnitude vector (DFT bins)
-        # Eb - Excitation vector (fractional critical bands)
+        # X2 - Squared-magnitude vector (DFT bins), or (..., NF/2+1) vectors
+        # Eb - Excitation vector (fractional critical bands), written to out if given
 
-        Eb = np.dot(X2,self.U)
-        Eb[Eb<self.Emin] = self.Emin
+        Eb = np.dot(X2, self.U, out=out)
+        np.maximum(Eb, self.Emin, out=Eb)
         
         return Eb
 
-    def PQspreadCB(self, E):
+    def PQspreadCB(self, E, out=None):
         # Spread an excitation vector (pitch pattern) - FFT model
         # Both E and Es are powers	    
-        Es = self.PQ_SpreadCB(E, self.Bs)
+        Es = self.PQ_SpreadCB(E, self.Bs, out)
         
         return Es
 
-    def PQ_SpreadCB(self, E, Bs):
+    def PQ_SpreadCB(self, E, Bs, out=None):
         e = 0.4 # Commonly used power value
         
         # Initialize arrays for storage. These values are used
@@ -129,9 +315,8 @@ class PQEval(object):
         # Es is the overall spread Bark-domain energy
         #
 
-        aUCEe = np.zeros(self.Nc)
-        Ene = np.zeros(self.Nc)
-        Es = np.zeros(self.Nc)
+        aUCEe, Ene = self.aUCEe, self.Ene
+        Es = np.zeros(self.Nc) if out is None else out
         
         # Calculate energy-dependent terms
         aL = 10**(2.7*self.dz)
@@ -166,20 +351,37 @@ class PQEval(object):
             
         return Es
 
-    def PQ_timeSpread(self, Es, Ef):
-        
-        Nadv = self.NF//2
-        Fss = float(self.Fs)/Nadv
-        tau_100 = 0.030
-        tau_min = 0.008
-        alpha, beta = self.PQtConst(tau_100, tau_min, self.fc, Fss)
-        
-        # Allocate storage
-        Ehs = np.zeros(self.Nc)
+    def PQ_SpreadCBfast(self, E):
+        # PQ_SpreadCB of E (..., Nc) for fast_math: all bands at once in the log domain,
+        # the spreading sums as products with the tables of PQfastTables
+        e = np.float32(0.4)
+        lE = np.log2(E, dtype=np.float32)
+        # log2 aUCE = log2 aUC + 0.2 dz log2 E
+        la = self.fm_log2aUC + np.float32(0.2 * self.dz) * lE
+        aUCE = np.exp2(la)
+        gIU = (1 - np.exp2(self.fm_NcL * la)) / (1 - aUCE)
+        # log2 Ene = e log2(E / (gIL + gIU - 1))
+        lEne = e * (lE - np.log2(self.fm_gIL + gIU - 1))
+        up = np.exp2(lEne[..., :, None] + self.fm_lag * (e * la)[..., :, None])
+        up[..., ~self.fm_up] = 0
+        Es = np.exp2(lEne).astype(np.float64) @ self.fm_low + up.sum(-2, dtype=np.float64)
+        # Es ** (1/e) / Bs
+        y = np.log2(Es, dtype=np.float32)
+        y *= np.float32(1 / 0.4)
+        y -= self.fm_log2Bs
+        return np.exp2(y, out=y)
+
+    def PQ_timeSpread(self, Es, Ef, out=None):
+        # Ef is the filter state, updated in place. Ehs is written to out if given.
+        # Time constants: 30 ms at 100 Hz, 8 ms minimum (aTS, bTS)
+        alpha = self.aTS
+        Ehs = np.zeros(np.shape(Es)) if out is None else out
+
         # Time domain smoothing
-        for i in range(self.Nc):
-            Ef[i] = alpha[i]*Ef[i] + (1-alpha[i])*Es[i]
-            Ehs[i] = max(Ef[i],Es[i])
+        Ef *= alpha
+        np.multiply(self.bTS, Es, out=self.tmpNc)
+        Ef += self.tmpNc
+        np.maximum(Ef, Es, out=Ehs)
         
         return Ehs, Ef
 
@@ -373,40 +575,48 @@ class PQEval(object):
         return Nc, fc, fl, fu, dz
 
     def PQmodPatt(self):
-        Nadv = self.NF//2
-        Fss = float(self.Fs)/Nadv
-        tau_100 = 0.050
-        tau_min = 0.008
-        alpha, beta = self.PQtConst(tau_100, tau_min, self.fc, Fss)
+        # Returns the M buffer and a view of the state, both overwritten at the next frame
+        # Time constants: 50 ms at 100 Hz, 8 ms minimum
+        alpha, beta = self.aMod, self.bMod
         if self.check_PQmodPatt == False:
-            self.DE = np.zeros((2, self.Nc))
-            self.Ese = np.zeros((2, self.Nc))
-            self.Eavg = np.zeros((2, self.Nc))
+            self.DE = np.zeros(self.Es.shape)
+            self.Ese = np.zeros(self.Es.shape)
+            self.Eavg = np.zeros(self.Es.shape)
             self.check_PQmodPatt = True
         
         e = 0.3
-        Ee = self.Es ** e
-        alpha, beta = alpha[None], beta[None]
-        self.DE = alpha * self.DE + beta * Fss * np.abs(Ee - self.Ese)
-        self.Eavg = alpha * self.Eavg + beta * Ee
-        self.Ese = Ee
-        M = self.DE / (1 + self.Eavg / e)
-        ERavg = self.Eavg[0]
+        if self.fast_math:
+            self.Ee[:] = _pow32(self.Es, e)
+            Ee = self.Ee
+        else:
+            Ee = np.power(self.Es, e, out=self.Ee)
+        np.subtract(Ee, self.Ese, out=self.dEe)
+        np.abs(self.dEe, out=self.dEe)
+        self.dEe *= self.bFss
+        self.DE *= alpha
+        self.DE += self.dEe
+        np.multiply(beta, Ee, out=self.dEe)
+        self.Eavg *= alpha
+        self.Eavg += self.dEe
+        # The previous Ee is kept by swapping the buffers
+        self.Ese, self.Ee = Ee, self.Ese
+        M = np.divide(self.Eavg, e, out=self.M)
+        M += 1
+        np.divide(self.DE, M, out=M)
+        ERavg = self.Eavg[..., 0, :]
         return M, ERavg
 
     def PQloud(self, Ehs, mod='FFT'):
+        # Ehs: (..., Nc), e.g. (2, frames, Nc) for both signals of a block of frames
         if mod != 'FFT':
             raise ValueError(f'Only FFT mod support, you choose {mod}')
 
-        c = 1.07664
         e = 0.23
-        E0 = 1e4
-        self.Et = self.PQ_enThresh(self.fc)
-        s = self.PQ_exIndex(self.fc)
-        Ets = c * (self.Et / (s * E0)) ** e
-
-        
-        sN = np.sum(np.maximum(Ets * ((1 - s + s * Ehs / self.Et) ** e - 1), 0))
+        s = self.sIdx
+        if self.fast_math:
+            sN = np.sum(np.maximum(self.Ets * (_pow32(self.fm_A + self.fm_B * Ehs, e) - 1), 0), -1)
+        else:
+            sN = np.sum(np.maximum(self.Ets * ((1 - s + s * Ehs / self.Et) ** e - 1), 0), -1)
         Ntot = (24 / self.Nc) * sN
         return Ntot
 
@@ -419,6 +629,7 @@ class PQEval(object):
         return 10**((-2 - 2.05 * np.arctan(fc / 4000) - 0.75 * np.arctan((fc / 1600) ** 2)) / 10)
 
     def PQmovModDiffB(self, M, ERavg):
+        # M: (2, ..., Nc) reference and test, ERavg: (..., Nc)
         e = 0.3
         Ete = self.EIN ** e
         negWt2B = 0.1
@@ -431,9 +642,9 @@ class PQEval(object):
         num2B = np.where(cond, negWt2B * num1B, num1B)
         MD1B = num1B / (offset1B + M[0])
         MD2B = num2B / (offset2B + M[0])
-        s1B = np.sum(MD1B)
-        s2B = np.sum(MD2B)
-        Wt = np.sum(ERavg / (ERavg + levWt * Ete))
+        s1B = np.sum(MD1B, -1)
+        s2B = np.sum(MD2B, -1)
+        Wt = np.sum(ERavg / (ERavg + levWt * Ete), -1)
 
         return (100 / self.Nc) * s1B, (100 / self.Nc) * s2B, Wt
 
@@ -454,20 +665,44 @@ class PQEval(object):
         b = np.where(cond, bP, bM)
 
         cond = L > 0
+        if self.fast_math:
+            # (d2 / L) ** g in float32, (edB / s) ** b by products (b = 4 or 6),
+            # 1 - 0.5 ** x = -expm1(-x ln 2), returned in float64: the bands are combined
+            # as 1 - prod(1 - p), where float32 would lose the small p
+            Lp = np.where(cond, L, 1)
+            s = np.where(cond, d1 * _pow32(d2 / Lp, g) + c[0] + L * (c[1] + L * (c[2] + L * (c[3] + L * c[4]))), 1e30)
+            r = (edB / s) ** 2
+            x = r * r
+            x = np.where(b == bP, x, x * r)
+            PD_p = -np.expm1(np.float32(-np.log(2)) * x.astype(np.float32)).astype(np.float64)
+            PD_q = np.abs(edB.astype(int)) / s
+            return PD_p, PD_q
         s = np.where(cond, d1 * (d2 / L) ** g + c[0] + L * (c[1] + L * (c[2] + L * (c[3] + L * c[4]))), 1e30)
 
         PD_p = 1 - 0.5 ** ((edB / s) ** b)
-        PD_q = np.abs(edB.astype(np.int)) / s
+        PD_q = np.abs(edB.astype(int)) / s
         return PD_p, PD_q
 
 
 class PEAQ(object):
-    def __init__(self, Amax = 1, Fs = 48000, NF = 2048):
+    def __init__(self, Amax = 1, Fs = 48000, NF = 2048, skip_silent=True, keep_spectra=True, block=256,
+                 fast_math=False):
         # Amax = maximum signal amplitude
         # Fs = sampling frequency
         # NF = Length of analysis window
-
+        # skip_silent = reuse the fixed results of silent frames (see PQ_frameClasses)
+        # keep_spectra = store the DFT spectra in X2MatR/X2MatT and compute the bandwidths
+        #                for all frames at once; otherwise (less memory, X2MatR/X2MatT = None)
+        #                the bandwidths are computed per frame from the spectra of the frame
+        # block = frames per call of the loudness, modulation difference, noise loudness and PD kernels
+        # fast_math = float32 / log domain loudness, noise loudness, PD, spreading and modulation
+        #             kernels (see FAST_MATH_RTOL), the ODG within FAST_MATH_ODG_TOL
+
+        self.block = block
+        self.fast_math = fast_math
         self.NF = NF
+        self.skip_silent = skip_silent
+        self.keep_spectra = keep_spectra
         self.Fs = Fs
         self.Amax = Amax
 
@@ -476,129 +711,299 @@ class PEAQ(object):
 
         #Number of critical bands:
         self.Nc = 109
-        self.P = np.zeros((2, self.Nc))
-        self.Rn = np.zeros((self.Nc))
-        self.Rd = np.zeros((self.Nc))
-        self.PC = np.zeros((2, self.Nc))
-
-    def process(self, referenceSignal, testSignal):
+        # Masking offsets of the NMR, built at the first computeNMR call
+        self.gm = None
+        # Delay of the test signal found by process(align=True)
+        self.delay = None
+        # Number of channels of a multichannel signal, None for mono (see process)
+        self.channels = None
+
+    def process(self, referenceSignal, testSignal, Fs=None, align=False, snapshots=None, verbose=False):
         #Preform basic procssing (Section 2 in Kabal.)
         # sigR = reference signal	
         # sigT = test signal
+        # verbose = print the signal levels and progress
+        # Fs = sampling rate of the signals if not self.Fs, they are resampled first (resample_PEAQ)
+        # align = estimate the delay of the test signal and score the aligned overlap of the
+        #         signals (align_PEAQ); the delay in samples at self.Fs is kept in self.delay
+        # snapshots = keep the recursive state before every snapshots-th frame in self.states
+        #             (see PQ_state, rescore_PEAQ)
+        # Signals of shape (channels, N) are scored as one multichannel item: the channels go
+        # through the frame loop together, every per-frame array gets a leading channel axis
+        # (PD_p, PD_q are combined over the channels, see PQ_movBlock)
 
         sigR = referenceSignal
         sigT = testSignal
+        if Fs is not None and int(Fs) != self.Fs:
+            sigR = resample_PEAQ.resample(sigR, Fs, self.Fs)
+            sigT = resample_PEAQ.resample(sigT, Fs, self.Fs)
+        self.delay = None
+        if align:
+            sigR, sigT, self.delay = align_PEAQ.align(sigR, sigT, self.Fs)
+        self.channels = None
+        if np.ndim(sigR) > 1:
+            if np.ndim(sigR) > 2 or np.shape(sigR)[:-1] != np.shape(sigT)[:-1]:
+                raise ValueError('reference and test have different numbers of channels')
+            if snapshots:
+                raise ValueError('snapshots of multichannel signals are not supported')
+            self.channels = len(sigR)
 
         #Number of frames:
-        self.Np = (np.floor(len(sigR)/self.Nadv)).astype(np.int32)
+        self.Np = (np.floor(np.shape(sigR)[-1]/self.Nadv)).astype(np.int32)
         
         #Scale audio:
-        if np.amax(abs(sigR)) != self.Amax:
-            # sigRS = self.Amax*sigR/float(np.amax(abs(sigR)))
-            # sigTS = self.Amax*sigT/float(np.amax(abs(sigT)))
-            sigRS = sigR
-            sigTS = sigT
+        # sigRS = self.Amax*sigR/float(np.amax(abs(sigR)))
+        # sigTS = self.Amax*sigT/float(np.amax(abs(sigT)))
+        sigRS = sigR
+        sigTS = sigT
+        if verbose and np.amax(abs(sigR)) != self.Amax:
             print ('Signals scaled, max reference value = ' + str(np.amax(abs(sigRS))) + ',')
             print ('and max test value = ' + str(np.amax(abs(sigTS))) +'.')
 
         #Instantiate Object to process single frames of data:
-        self.PQE = PQEval(Amax = self.Amax, Fs = self.Fs, NF = self.NF)
+        self.PQE = PQEval(Amax = self.Amax, Fs = self.Fs, NF = self.NF, fast_math = self.fast_math,
+                          channels = self.channels)
 
-        print('Processing Audio...')
-        
-        #Create empty matrices:
-        X2 = np.zeros((2,self.NF//2+1))
-
-        self.X2MatR = np.zeros((self.Np, self.NF//2+1))
-        self.X2MatT = np.zeros((self.Np, self.NF//2+1))
+        if verbose:
+            print('Processing Audio...')
 
-        self.EbNMat = np.zeros((self.Np, self.Nc))
-        self.EsMatR = np.zeros((self.Np, self.Nc))
-        self.EsMatT = np.zeros((self.Np, self.Nc))
+        self.PQ_workspace()
+        self.PQ_frameArrays(self.Np)
 
-        self.EhsR = np.zeros((self.Np, self.Nc))
-        self.EhsT = np.zeros((self.Np, self.Nc))
-
-        previousFrameR = np.zeros(self.Nc)
-        previousFrameT = np.zeros(self.Nc)
-
-        #Maybe take this out later, but useful in debugging:
-        self.xMatR = np.zeros((self.Np, self.NF))
-        self.xMatT = np.zeros((self.Np, self.NF))
-
-        self.loud_NRef = np.zeros((self.Np,))
-        self.loud_NTest = np.zeros((self.Np,))
-
-        self.BWRef = np.zeros((self.Np,))
-        self.BWTest = np.zeros((self.Np,))
-
-        self.PD_p = np.zeros((self.Np))
-        self.PD_q = np.zeros((self.Np))
-        self.MDiff_Mt1B = np.zeros((self.Np))
-        self.MDiff_Mt2B = np.zeros((self.Np))
-        self.MDiff_Wt = np.zeros((self.Np))
-        self.NLoud_NL = np.zeros((self.Np))
-        
-        self.EHS = np.zeros((self.Np,))
-
-        startS = 0
+        # Time spreading state of both signals
+        self.Ef = np.zeros(self.PQ_lead() + (2, self.Nc))
+        if snapshots:
+            self.states = dict((name, np.zeros((-(-int(self.Np) // snapshots),) + np.shape(x)))
+                               for name, x in self.PQ_state().items())
 
         startTime = time.time()
 
-        for i in np.arange(self.Np):
-            xR = sigRS[startS:self.NF+startS]
-            xT = sigTS[startS:self.NF+startS]
+        silent, quiet = self.PQ_frameClasses(sigRS, sigTS)
+        self.PQ_frames(sigRS, sigTS, 0, self.Np, silent, ~quiet, snapshots)
+        if self.keep_spectra:
+            self.BWRef[:], self.BWTest[:] = self.computeBW(self.X2MatR, self.X2MatT)
+        self.NMRavg, self.NMRmax = self.computeNMR(self.EbNMat, self.EhsR)
+
+    def PQ_frames(self, sigR, sigT, start, stop, silent, ehs, snapshots=None):
+        # Frames start..stop-1, continuing from the recursive state left by frame start-1
+        # silent    - frames of digital silence in every channel (PQ_frameClasses)
+        # ehs       - frames whose EHS is computed, -1 for the others; (channels, Np) for a
+        #             multichannel signal
+        # snapshots - the state before every frame i with i % snapshots == 0 goes to
+        #             row i // snapshots of self.states (see PQ_state)
+        # The per-frame arrays and buffers have the leading channel axis of PQ_lead
+        lead = self.PQ_lead()
+        X2 = np.zeros(lead + (2, self.NF//2+1))
+        startS = start * self.Nadv
+
+        # DFT / excitation of a silent frame, computed at the first one
+        zero = {}
+
+        # Modulation patterns and adapted excitations of the current block of frames, the
+        # signal axis first as the block kernels take it
+        block = self.block
+        Mb = np.zeros((2,) + lead + (block, self.Nc))
+        ERavgb = np.zeros(lead + (block, self.Nc))
+        EPb = np.zeros((2,) + lead + (block, self.Nc))
+
+        for i in np.arange(start, stop):
+            if snapshots and i % snapshots == 0:
+                for name, x in self.PQ_state().items():
+                    self.states[name][i // snapshots] = x
+
+            xR = sigR[..., startS:self.NF+startS]
+            xT = sigT[..., startS:self.NF+startS]
             if xR.shape[-1] < self.NF:
-                xR = np.pad(xR, (0, self.NF - xR.shape[-1]))
+                xR = np.pad(xR, [(0, 0)] * len(lead) + [(0, self.NF - xR.shape[-1])])
             if xT.shape[-1] < self.NF:
-                xT = np.pad(xT, (0, self.NF - xT.shape[-1]))
+                xT = np.pad(xT, [(0, 0)] * len(lead) + [(0, self.NF - xT.shape[-1])])
             startS = startS+self.Nadv
 
             #Store unmodified windows of audio:
-            self.xMatR[i, :] = xR
-            self.xMatT[i, :] = xT
-            
-            #Process Frame: 
-            X2[0,:] = self.PQE.PQDFTFrame(xR)
-            X2[1,:] = self.PQE.PQDFTFrame(xT)
-            self.X2MatR[i,:] = X2[0,:]
-            self.X2MatT[i,:] = X2[1,:]
+            self.xMatR[..., i, :] = xR
+            self.xMatT[..., i, :] = xT
             
-            # Critical band grouping and frequency spreading
-            self.EbN, self.Es = self.PQE.PQ_excitCB(X2)
+            if silent[i] and 'Es' in zero:
+                # Zero spectra (X2Mat rows stay zero); PQmodPatt reads the excitation from PQE
+                X2[:] = 0
+                self.PQE.Es[:] = zero['Es']
+                self.EbN, self.Es = zero['EbN'], self.PQE.Es
+            else:
+                #Process Frame: 
+                self.PQE.PQDFTFrame(xR, out=X2[..., 0, :])
+                self.PQE.PQDFTFrame(xT, out=X2[..., 1, :])
+                if self.keep_spectra:
+                    self.X2MatR[..., i, :] = X2[..., 0, :]
+                    self.X2MatT[..., i, :] = X2[..., 1, :]
+
+                # Critical band grouping and frequency spreading
+                self.EbN, self.Es = self.PQE.PQ_excitCB(X2)
+                if silent[i]:
+                    zero['EbN'], zero['Es'] = self.EbN.copy(), self.Es.copy()
             
-            self.EbNMat[i,:] = self.EbN
-            self.EsMatR[i,:] = self.Es[0,:]
-            self.EsMatT[i,:] = self.Es[1,:]
+            self.EbNMat[..., i, :] = self.EbN
+            self.EsMatR[..., i, :] = self.Es[..., 0, :]
+            self.EsMatT[..., i, :] = self.Es[..., 1, :]
             
             #Time domain spreading
-            self.EhsR[i,:], previousFrameR = self.PQE.PQ_timeSpread(self.EsMatR[i,:], previousFrameR)
-            self.EhsT[i,:], previousFrameT = self.PQE.PQ_timeSpread(self.EsMatT[i,:], previousFrameT)
-
-            EP = self.PQadapt(self.EhsR[i], self.EhsT[i], 'FFT')
-            M, ERavg = self.PQE.PQmodPatt()
-            self.loud_NRef[i] = self.PQE.PQloud(self.EhsR[i,:])
-            self.loud_NTest[i] = self.PQE.PQloud(self.EhsT[i,:])
-
-            self.MDiff_Mt1B[i], self.MDiff_Mt2B[i], self.MDiff_Wt[i] = self.PQE.PQmovModDiffB(M, ERavg)
-
-            self.NLoud_NL[i] = self.PQmovNLoudB(M, EP)
+            self.PQE.PQ_timeSpread(self.EsMatR[..., i, :], self.Ef[..., 0, :], out=self.EhsR[..., i, :])
+            self.PQE.PQ_timeSpread(self.EsMatT[..., i, :], self.Ef[..., 1, :], out=self.EhsT[..., i, :])
+
+            # Recursive stages, their outputs are kept for the block MOVs
+            j = (i - start) % block
+            EPb[..., j, :] = np.moveaxis(self.PQadapt(self.EhsR[..., i, :], self.EhsT[..., i, :], 'FFT'), -2, 0)
+            M, ERavgb[..., j, :] = self.PQE.PQmodPatt()
+            Mb[..., j, :] = np.moveaxis(M, -2, 0)
+            if j == block - 1 or i == stop - 1:
+                self.PQ_movBlock(i - j, Mb[..., :j+1, :], ERavgb[..., :j+1, :], EPb[..., :j+1, :])
+
+            if not self.keep_spectra:
+                self.BWRef[..., i], self.BWTest[..., i] = self.computeBW(X2[..., 0, :], X2[..., 1, :])
+
+            if not lead:
+                self.EHS[i] = self.PQmovEHS(self.xMatR[i], self.xMatT[i], X2) if ehs[i] else -1
+            elif ehs[:, i].any():
+                self.EHS[:, i] = np.where(ehs[:, i], self.PQmovEHS(self.xMatR[:, i], self.xMatT[:, i], X2), -1)
+            else:
+                self.EHS[:, i] = -1
+
+    def PQ_state(self):
+        # Copies of the recursive state carried from frame to frame: time spreading (Ef),
+        # level and pattern adaptation (P, Rn, Rd, PC), modulation patterns (DE, Ese, Eavg)
+        PQE = self.PQE
+        if PQE.check_PQmodPatt:
+            mod = [PQE.DE, PQE.Ese, PQE.Eavg]
+        else:
+            mod = [np.zeros(self.Ef.shape)] * 3
+        return dict((name, np.array(x)) for name, x in zip(STATE, [self.Ef, self.P, self.Rn, self.Rd, self.PC] + mod))
+
+    def PQ_setState(self, state):
+        # Continues from a state of PQ_state (after PQ_workspace)
+        self.Ef = np.array(state['Ef'])
+        self.P, self.Rn, self.Rd, self.PC = [np.array(state[name]) for name in ('P', 'Rn', 'Rd', 'PC')]
+        self.PQE.DE, self.PQE.Ese, self.PQE.Eavg = [np.array(state[name]) for name in ('DE', 'Ese', 'Eavg')]
+        self.PQE.check_PQmodPatt = True
+
+    def PQ_lead(self):
+        # Leading axes of the per-frame arrays and buffers: (channels,) or () for mono
+        return () if self.channels is None else (self.channels,)
+
+    def PQ_workspace(self):
+        # Workspace and recursive state of PQadapt, workspace of PQmovEHS, the frame loop
+        # allocates no arrays
+        lead = self.PQ_lead()
+        self.aP, self.bP = [np.stack([x, x]) for x in self.PQE.PQtConst(0.050, 0.008, self.PQE.fc, 48000 / self.Nadv)]
+        # Pattern correction averages R over the bands m-3..m+4 (clipped at the edges): R @ Wm / nm
+        M1, M2 = 3, 4
+        k = np.arange(self.Nc)
+        self.Wm = ((k[:,None] >= k[None,:] - M1) & (k[:,None] <= k[None,:] + M2)).astype(np.float64)
+        self.nm = np.tile(np.minimum(k + M2, self.Nc - 1) - np.maximum(k - M1, 0) + 1., (2, 1))
+        self.P = np.zeros(lead + (2, self.Nc))
+        self.Rn = np.zeros(lead + (self.Nc,))
+        self.Rd = np.zeros(lead + (self.Nc,))
+        self.PC = np.zeros(lead + (2, self.Nc))
+        self.EP = np.zeros(lead + (2, self.Nc))
+        self.R = np.zeros(lead + (2, self.Nc))
+        self.tmp2 = np.zeros(lead + (2, self.Nc))
+        self.tmpNc = np.zeros(lead + (self.Nc,))
+        self.cond = np.zeros(lead + (self.Nc,), dtype=bool)
+        # EHS: correlation lag and window length for Fmax = 9 kHz (NF = 2048, Fs = 48000)
+        self.NL = int(2**self.PQ_log2(2048 * 9000 / 48000))
+        self.Hw = (1 / self.NL) * (8 / 3) ** 0.5 * self.PQE.PQHannWin(self.NL)
+        self.D = np.zeros(lead + (2048//2+1,))
+        self.C = np.zeros(lead + (self.NL,))
+        self.Cn = np.zeros(lead + (self.NL,))
+        self.Cw = np.zeros(lead + (self.NL,))
+        self.cp = np.zeros(lead + (self.NL//2+1,), dtype=complex)
+        self.c2 = np.zeros(lead + (self.NL//2+1,))
+        self.c2i = np.zeros(lead + (self.NL//2+1,))
+
+    def PQ_frameArrays(self, Np):
+        # Per-frame results of Np frames, after the leading axes of PQ_lead
+        lead = self.PQ_lead()
+        if self.keep_spectra:
+            self.X2MatR = np.zeros(lead + (Np, self.NF//2+1))
+            self.X2MatT = np.zeros(lead + (Np, self.NF//2+1))
+        else:
+            self.X2MatR = self.X2MatT = None
 
-            self.BWRef[i], self.BWTest[i] = self.computeBW(self.X2MatR[i], self.X2MatT[i])
+        self.EbNMat = np.zeros(lead + (Np, self.Nc))
+        self.EsMatR = np.zeros(lead + (Np, self.Nc))
+        self.EsMatT = np.zeros(lead + (Np, self.Nc))
 
-            PD_p, PD_q = self.PQE.PQmovPD(self.EhsR[i,:], self.EhsT[i,:])
-            self.PD_p[i], self.PD_q[i] = self.PQ_ChanPD(PD_p, PD_q)
+        self.EhsR = np.zeros(lead + (Np, self.Nc))
+        self.EhsT = np.zeros(lead + (Np, self.Nc))
 
-            self.EHS[i] = self.PQmovEHS(xR, xT, X2)
-        self.NMRavg, self.NMRmax = self.computeNMR(self.EbNMat, self.EhsR)
+        #Maybe take this out later, but useful in debugging:
+        self.xMatR = np.zeros(lead + (Np, self.NF))
+        self.xMatT = np.zeros(lead + (Np, self.NF))
+
+        self.loud_NRef = np.zeros(lead + (Np,))
+        self.loud_NTest = np.zeros(lead + (Np,))
+
+        self.BWRef = np.zeros(lead + (Np,))
+        self.BWTest = np.zeros(lead + (Np,))
+
+        self.PD_p = np.zeros(lead + (Np,))
+        self.PD_q = np.zeros(lead + (Np,))
+        self.MDiff_Mt1B = np.zeros(lead + (Np,))
+        self.MDiff_Mt2B = np.zeros(lead + (Np,))
+        self.MDiff_Wt = np.zeros(lead + (Np,))
+        self.NLoud_NL = np.zeros(lead + (Np,))
+
+        self.EHS = np.zeros(lead + (Np,))
+
+    def PQ_movBlock(self, start, M, ERavg, EP):
+        # Per-frame MOVs of frames start.. from their (2, ..., frames, Nc) patterns, both
+        # signals, all channels and all frames of the block in one call of each kernel
+        frames = slice(start, start + M.shape[-2])
+        Ehs = np.stack([self.EhsR[..., frames, :], self.EhsT[..., frames, :]])
+        self.loud_NRef[..., frames], self.loud_NTest[..., frames] = self.PQE.PQloud(Ehs)
+
+        self.MDiff_Mt1B[..., frames], self.MDiff_Mt2B[..., frames], self.MDiff_Wt[..., frames] = \
+            self.PQE.PQmovModDiffB(M, ERavg)
+
+        self.NLoud_NL[..., frames] = self.PQmovNLoudB(M, EP)
+
+        PD_p, PD_q = self.PQE.PQmovPD(Ehs[0], Ehs[1])
+        if self.channels is not None:
+            # As in BS.1387 / Kabal's PQmovPD, p and q are the maxima over the channels per
+            # band before the bands are combined: every channel gets the combined values
+            PD_p, PD_q = np.amax(PD_p, 0), np.amax(PD_q, 0)
+        self.PD_p[..., frames], self.PD_q[..., frames] = self.PQ_ChanPD(PD_p, PD_q)
+
+    def PQ_frameClasses(self, sigR, sigT):
+        # Classifies all frames at once, before the frame loop.
+        # silent - reference and test frames are digital silence: the DFT, excitation and
+        #          bandwidth results are those of a zero frame. The recursive stages
+        #          (time spreading, adaptation, modulation) still run, so their state is
+        #          the same as without skipping.
+        # quiet  - the second halves of both frames are below the EHS energy threshold
+        #          (with a margin for rounding, frames close to it are left to PQmovEHS),
+        #          so EHS = -1.
+        # For (channels, N) signals a frame is silent when it is in every channel, quiet is
+        # (channels, Np).
+        Np = int(self.Np)
+        lead = np.shape(sigR)[:-1]
+        if not self.skip_silent:
+            return np.zeros(Np, dtype=bool), np.zeros(lead + (Np,), dtype=bool)
+        EnThr = 8000
+        N = (Np + 1) * self.Nadv
+        silent = np.ones(lead + (Np,), dtype=bool)
+        quiet = np.ones(lead + (Np,), dtype=bool)
+        for x in (sigR, sigT):
+            # Frame i consists of the half frames i and i+1
+            x = np.asarray(x[..., :N], dtype=np.float64)
+            h = np.pad(x, [(0, 0)] * len(lead) + [(0, N - x.shape[-1])]).reshape(lead + (Np + 1, self.Nadv))
+            zero = ~np.any(h, -1)
+            silent &= zero[..., :-1] & zero[..., 1:]
+            quiet &= np.einsum('...ij,...ij->...i', h[..., 1:, :], h[..., 1:, :]) < 0.999 * EnThr
+        return silent.reshape(-1, Np).all(0), quiet
 
     def PQ_ChanPD(self, p, q):
-        Pr = 1
-        Qc = 0
-        for m in range(self.Nc):
-            Pr *= 1 - p[m]
-            Qc += q[m]
-        Pc = 1 - Pr
+        # p, q: (..., Nc)
+        Pc = 1 - np.prod(1 - p, -1)
+        Qc = np.sum(q, -1)
         return Pc, Qc
 
     def get(self):
@@ -611,68 +1016,65 @@ class PEAQ(object):
                 'EHS': self.EHS}
 
     def PQadapt(self, EhsR, EhsT, Mod='FFT'):
+        # Returns the EP buffer, overwritten at the next frame
         if Mod != 'FFT':
             raise ValueError(f'Mod only supports FFT, but {Mod}')
         
-        Fs = 48000
-        Fss = Fs / self.Nadv
-        t100 = 0.050
-        tmin = 0.008
-        a, b = self.PQE.PQtConst(t100, tmin, self.PQE.fc, Fss)
-        M1, M2 = 3, 4
+        # Time constants: 50 ms at 100 Hz, 8 ms minimum, Fs = 48000 (aP, bP)
+        a, b = self.aP, self.bP
 
-        EP = np.zeros((2, self.Nc))
-        R = np.zeros((2, self.Nc))
+        EP, R, tmp, v, cond = self.EP, self.R, self.tmp2, self.tmpNc, self.cond
 
-        self.P = np.expand_dims(a,-2) * self.P + np.expand_dims(b,-2) * np.stack([EhsR, EhsT])
-        sn = np.sum(np.sqrt(self.P[...,0,:] * self.P[...,1,:]), -1)
-        sd = np.sum(self.P[...,1,:], -1)
+        self.P *= a
+        np.multiply(b[0], EhsR, out=tmp[..., 0, :])
+        np.multiply(b[1], EhsT, out=tmp[..., 1, :])
+        self.P += tmp
+        np.multiply(self.P[..., 0, :], self.P[..., 1, :], out=v)
+        sn = np.sum(np.sqrt(v, out=v), -1)
+        sd = np.sum(self.P[..., 1, :], -1)
 
         CL = (sn / sd) ** 2
-        cond = CL > 1
-        EP[0] = np.where(cond, EhsR / CL, EhsR)
-        EP[1] = np.where(cond, EhsT, EhsT * CL)
-
-        self.Rn = a * self.Rn + EP[1] * EP[0]
-        self.Rd = a * self.Rd + EP[0] ** 2
-
-        cond = self.Rn >= self.Rd
-        R[0] = np.where(cond, 1, self.Rn / self.Rd)
-        R[1] = np.where(cond, self.Rd / self.Rn, 1)
-        
-        for m in range(self.Nc):
-            iL = max(m - M1, 0)
-            iU = min(m + M2, self.Nc-1)
-            s1 = np.sum(R[0,iL:iU+1], -1)
-            s2 = np.sum(R[1,iL:iU+1], -1)
-
-            self.PC[0,m] = a[m] * self.PC[0,m] + b[m] * s1 / (iU-iL+1)
-            self.PC[1,m] = a[m] * self.PC[1,m] + b[m] * s2 / (iU-iL+1)
-
-            EP[0,m] *= self.PC[0,m]
-            EP[1,m] *= self.PC[1,m]
+        if np.ndim(CL) == 0:
+            # Mono: scalar branches, no temporaries
+            if CL > 1:
+                np.divide(EhsR, CL, out=EP[0])
+                EP[1] = EhsT
+            else:
+                EP[0] = EhsR
+                np.multiply(EhsT, CL, out=EP[1])
+        else:
+            # Per channel, the same branches (a NaN CL takes the second)
+            CL = CL[:, None]
+            np.divide(EhsR, np.where(CL > 1, CL, 1), out=EP[..., 0, :])
+            np.multiply(EhsT, np.where(CL > 1, 1, CL), out=EP[..., 1, :])
+
+        self.Rn *= a[0]
+        self.Rn += np.multiply(EP[..., 1, :], EP[..., 0, :], out=v)
+        self.Rd *= a[0]
+        self.Rd += np.multiply(EP[..., 0, :], EP[..., 0, :], out=v)
+
+        np.greater_equal(self.Rn, self.Rd, out=cond)
+        np.divide(self.Rn, self.Rd, out=R[..., 0, :])
+        np.copyto(R[..., 0, :], 1, where=cond)
+        np.divide(self.Rd, self.Rn, out=R[..., 1, :])
+        np.copyto(R[..., 1, :], 1, where=np.logical_not(cond, out=cond))
+
+        # Pattern correction factors, smoothed over time
+        np.dot(R, self.Wm, out=tmp)
+        tmp *= b
+        tmp /= self.nm
+        self.PC *= a
+        self.PC += tmp
+
+        EP *= self.PC
         return EP
 
     def avg_get(self):
-        self.avgBWRef, self.avgBWTest = self.PQ_avgBW(self.BWRef, self.BWTest)
-        self.totalNMRB, self.relDistFramesB = self.PQ_avgNMRB(self.NMRavg, self.NMRmax)
-
-        tdel = 0.5
-        Fss = self.Fs / self.Nadv
-        N500ms = np.ceil(tdel * Fss)
-        Nwup = 0
-        Ndel = np.maximum(np.zeros_like(N500ms), N500ms - Nwup)
-        tex = 0.05
-        
-        self.WinModDiff1B, self.AvgModDiff1B, self.AvgModDiff2B = self.PQ_avgModDiffB(Ndel, self.MDiff_Mt1B, self.MDiff_Mt2B, self.MDiff_Wt)
-        self.ADBB, self.MFPDB = self.PQ_avgPD(self.PD_p, self.PD_q)
-
-        N50ms = np.ceil(tex * Fss)
-        Nloud = self.PQloudTest(self.loud_NRef, self.loud_NTest)
-        Ndel = max(Nloud + N50ms, Ndel)
-        self.RmsNoiseLoudB = self.PQ_avgNLoudB(Ndel, self.NLoud_NL)
-        self.EHSB = self.PQ_avgEHS(self.EHS)
-        self.ODG = self.PQnNetB([self.avgBWRef, self.avgBWTest, self.totalNMRB, self.WinModDiff1B, self.ADBB, self.EHSB, self.AvgModDiff1B, self.AvgModDiff2B, self.RmsNoiseLoudB, self.MFPDB, self.relDistFramesB])
+        if self.channels is None:
+            self.PQ_avgMOVs(self.PQloudTest(self.loud_NRef, self.loud_NTest))
+        else:
+            self.PQ_avgChannels()
+        self.ODG = self.PQnNetB([getattr(self, name) for name in MOVS])
         return {'BW': {'BWRef': self.avgBWRef, 'BWTest': self.avgBWTest},
                 'NMR': {'totalNMRB': self.totalNMRB, 'relDistFramesB': self.relDistFramesB},
                 'WinModDiff1B': self.WinModDiff1B,
@@ -739,6 +1141,40 @@ class PEAQ(object):
             bmax = 0.22
         return amin, amax, wx, wxb, wy, wyb, bmin, bmax
 
+    def PQ_avgMOVs(self, Nloud, c=()):
+        # Averaged MOVs (MOVS) of the per-frame MOVs of channel c, Nloud = first frame where
+        # both signals are audible
+        self.avgBWRef, self.avgBWTest = self.PQ_avgBW(self.BWRef[c], self.BWTest[c])
+        self.totalNMRB, self.relDistFramesB = self.PQ_avgNMRB(self.NMRavg[c], self.NMRmax[c])
+
+        tdel = 0.5
+        Fss = self.Fs / self.Nadv
+        N500ms = np.ceil(tdel * Fss)
+        Nwup = 0
+        Ndel = np.maximum(np.zeros_like(N500ms), N500ms - Nwup)
+        tex = 0.05
+
+        self.WinModDiff1B, self.AvgModDiff1B, self.AvgModDiff2B = self.PQ_avgModDiffB(
+            Ndel, self.MDiff_Mt1B[c], self.MDiff_Mt2B[c], self.MDiff_Wt[c])
+        self.ADBB, self.MFPDB = self.PQ_avgPD(self.PD_p[c], self.PD_q[c])
+
+        N50ms = np.ceil(tex * Fss)
+        Ndel = max(Nloud + N50ms, Ndel)
+        self.RmsNoiseLoudB = self.PQ_avgNLoudB(Ndel, self.NLoud_NL[c])
+        self.EHSB = self.PQ_avgEHS(self.EHS[c])
+
+    def PQ_avgChannels(self):
+        # As Kabal's PQavgMOVB: the loudness delay is the earliest of the channels, the MOVs
+        # are averaged per channel, then over the channels (the PD MOVs are the same in
+        # every channel, see PQ_movBlock)
+        Nloud = min(self.PQloudTest(self.loud_NRef[c], self.loud_NTest[c]) for c in range(self.channels))
+        movs = []
+        for c in range(self.channels):
+            self.PQ_avgMOVs(Nloud, c)
+            movs.append([getattr(self, name) for name in MOVS])
+        for name, x in zip(MOVS, np.mean(movs, 0)):
+            setattr(self, name, x)
+
     def PQ_avgEHS(self, EHS):
         s = np.sum(self.PQ_LinPosAvg(EHS), -1)
         return 1000 * s
@@ -791,6 +1227,7 @@ class PEAQ(object):
         return ADBB, MFPDB
 
     def PQmovNLoudB(self, M, EP):
+        # M, EP: (2, ..., Nc) reference and test
         alpha = 1.5
         TF0 = 0.15
         S0 = 0.5
@@ -800,17 +1237,26 @@ class PEAQ(object):
 
         sref = TF0 * M[0] + S0
         test = TF0 * M[1] + S0
+        if self.PQE.fast_math:
+            # (EIN / test) ** e as exp2(e (log2 EIN - log2 test)), (1 + a/b) ** e - 1 as
+            # expm1(e log1p(a/b)), in float32
+            beta = np.exp((-alpha * (EP[1] - EP[0]) / EP[0]).astype(np.float32))
+            a = np.maximum(test * EP[1] - sref * EP[0], 0)
+            b = self.PQE.EIN + sref * EP[0] * beta
+            lt = np.float32(e) * (self.PQE.fm_log2EIN - np.log2(test, dtype=np.float32))
+            s = np.sum(np.exp2(lt) * np.expm1(np.float32(e) * np.log1p((a / b).astype(np.float32))), -1, dtype=np.float64)
+            NL = (24 / self.Nc) * s
+            return np.where(NL < NLmin, 0, NL)
         beta = np.exp(-alpha * (EP[1] - EP[0]) / EP[0])
         tmp = test * EP[1] - sref * EP[0]
         a = np.maximum(tmp, np.zeros_like(tmp))
         b = self.PQE.EIN + sref * EP[0] * beta
-        s = np.sum((self.PQE.EIN / test) ** e * ((1 + a / b) ** e - 1))
+        s = np.sum((self.PQE.EIN / test) ** e * ((1 + a / b) ** e - 1), -1)
         NL = (24 / self.Nc) * s
-        if NL < NLmin:
-            return 0
-        return NL
+        return np.where(NL < NLmin, 0, NL)
 
     def computeBW(self, X2MatR, X2MatT):
+        # X2MatR, X2MatT: (..., NF/2+1) spectra of one frame or of all frames at once
         fx = 21586
         kx = int(round(self.NF * float(fx)/self.Fs)) # 921
         fl = 8109
@@ -823,106 +1269,123 @@ class PEAQ(object):
         Xth = np.amax(X2MatT[...,kx:-1], -1)
         XthR = FR * Xth
         cond = X2MatR[...,kl+1:kx] >= XthR[...,None]
-        BWRef = (np.arange(kl + 1, cond.shape[-1] + kl + 1)[None] * cond).max(-1) + 1
+        BWRef = (np.arange(kl + 1, cond.shape[-1] + kl + 1) * cond).max(-1) + 1
 
+        # The test bandwidth is searched below BWRef-1 <= kx-1, masked per frame instead
+        # of sliced. An empty range (BWRef = 1) gives BWTest = 1.
         XthT = FT * Xth
-        cond = X2MatT[...,:int(BWRef-1)] >= XthT[...,None]
-        BWTest = (np.arange(cond.shape[-1])[None] * cond).max(-1) + 1
+        k = np.arange(kx)
+        cond = (X2MatT[...,:kx] >= XthT[...,None]) & (k < BWRef[...,None] - 1)
+        BWTest = (k * cond).max(-1) + 1
         return BWRef, BWTest
 
     def computeNMR(self, EbNMat, EhsR):
         #Kabal Section
         #Compute NRM for whole time series.
+        # EbNMat, EhsR: (Np, Nc), all frames in one division and reduction
 
-        NMRavg = np.zeros(self.Np)
-        NMRmax = np.zeros(self.Np)
-
-        for i in range(int(self.Np)):
-            NMR = self.PQmovNMRB(EbNMat[i,:], EhsR[i,:])
-            NMRavg[i] = NMR['NMRavg']
-            NMRmax[i] = NMR['NMRmax']
+        NMRm = EbNMat / (self.PQ_MaskOffset() * EhsR)
+        NMRavg = np.mean(NMRm, -1)
+        NMRmax = np.maximum(np.amax(NMRm, -1), 0)
 
         return NMRavg, NMRmax
 
     def PQmovNMRB(self, EbN, Ehs):
-        NMR = dict()
-        
-        Nc, fc, fl, fu, dz = self.PQE.PQCB()
-        gm = self.PQ_MaskOffset(dz, Nc)
-        
-        NMRmax = 0
-        NMRm = 0
-        s = 0
-
-        R_NM = np.zeros(Nc)
-        
-        for k in range(Nc):
-            NMRm = EbN[k] / (gm[k] * Ehs[k])
-            R_NM[k] = NMRm # Remove later!
-            s = s + NMRm
-            
-            if (NMRm > NMRmax):
-                NMRmax = NMRm
-                
-        NMR['NMRmax'] = NMRmax
-        NMR['NMRavg'] = float(s)/Nc
-        
-        return NMR
-
-    def PQ_MaskOffset(self, dz, Nc):
-        gm = np.zeros(Nc)
-        for k in range(Nc):
-            if (k <= 12./dz):
-                mdB = 3
-            else:
-                mdB = 0.25*k*dz  
-            gm[k] = 10**(-1*float(mdB)/10) 
-        return gm
+        # NMR of a single frame
+        NMRavg, NMRmax = self.computeNMR(EbN, Ehs)
+        return {'NMRmax': NMRmax, 'NMRavg': float(NMRavg)}
+
+    def PQ_MaskOffset(self):
+        # Masking offset per band, 3 dB up to 12 Bark then 0.25 dB/Bark
+        if self.gm is None:
+            Nc, fc, fl, fu, dz = self.PQE.PQCB()
+            k = np.arange(Nc)
+            mdB = np.where(k <= 12./dz, 3, 0.25*k*dz)
+            self.gm = 10**(-mdB/10)
+        return self.gm
 
     def PQmovEHS(self, xR, xT, X2):
         NF = 2048
         Nadv = NF // 2
-        Fs = 48000
-        Fmax = 9000
-        NL = 2**(self.PQ_log2(NF * Fmax / Fs))
-        M = NL
-        Hw = (1 / M) * (8 / 3) ** 0.5 * self.PQE.PQHannWin(M)
+        NL = M = self.NL
 
         EnThr = 8000
-        kmax = NL + M - 1
 
-        xR, xT = np.copy(xR).astype(np.float64), np.copy(xT).astype(np.float64)
+        xR, xT = np.asarray(xR, dtype=np.float64), np.asarray(xT, dtype=np.float64)
+        if xR.ndim > 1:
+            return self.PQ_movEHSChannels(xR, xT, X2)
 
-        EnRef  = np.matmul(xR[Nadv:NF+1], xR[Nadv:NF+1].T)
-        EnTest = np.matmul(xT[Nadv:NF+1], xT[Nadv:NF+1].T)
+        EnRef  = np.dot(xR[Nadv:NF+1], xR[Nadv:NF+1])
+        EnTest = np.dot(xT[Nadv:NF+1], xT[Nadv:NF+1])
 
         if EnRef < EnThr and EnTest < EnThr:
             return -1
 
-        D = np.log(X2[1] / X2[0])
-        C = self.PQ_Corr(D, NL, M)
+        D = np.divide(X2[1], X2[0], out=self.D)
+        np.log(D, out=D)
+        C = self.PQ_Corr(D, NL, M, out=self.C)
 
-        Cn = self.PQ_NCorr(C, D, NL, M)
-        Cnm = (1 / NL) * np.sum(Cn[:NL.astype(np.int)+1])
+        Cn = self.PQ_NCorr(C, D, NL, M, out=self.Cn)
+        Cnm = (1 / NL) * np.sum(Cn[:NL+1])
 
-        Cw = Hw * (Cn - Cnm)
+        Cw = np.subtract(Cn, Cnm, out=self.Cw)
+        Cw *= self.Hw
 
-        cp = self.PQE.PQRFFT(Cw, NL.astype(np.int), 1)
-        c2 = self.PQE.PQRFFTMSq(cp, NL.astype(np.int))
+        cp = _rfft(Cw, self.cp)
+        c2 = np.multiply(cp.real, cp.real, out=self.c2)
+        c2 += np.multiply(cp.imag, cp.imag, out=self.c2i)
 
-        EHS = self.PQ_FindPeak(c2, (NL/2+1).astype(np.int))
+        EHS = self.PQ_FindPeak(c2, NL//2+1)
         return EHS
 
-    def PQ_Corr(self, D, NL, M): # DFT-based operation in original matlab code
-        M = M.astype(np.int)
-        NL = NL.astype(np.int)
+    def PQ_movEHSChannels(self, xR, xT, X2):
+        # PQmovEHS of the (channels, NF) windows and (channels, 2, NF/2+1) spectra of a
+        # frame, -1 in the channels below the energy threshold
+        NF = 2048
+        Nadv = NF // 2
+        NL = M = self.NL
+
+        EnThr = 8000
+
+        EnRef = np.einsum('...i,...i->...', xR[..., Nadv:NF+1], xR[..., Nadv:NF+1])
+        EnTest = np.einsum('...i,...i->...', xT[..., Nadv:NF+1], xT[..., Nadv:NF+1])
+        below = (EnRef < EnThr) & (EnTest < EnThr)
+
+        # The channels below the threshold may have zero spectra, their EHS is discarded
+        with np.errstate(divide='ignore', invalid='ignore'):
+            D = np.divide(X2[..., 1, :], X2[..., 0, :], out=self.D)
+            np.log(D, out=D)
+            C = self.PQ_Corr(D, NL, M, out=self.C)
 
-        C = np.zeros(NL)
+            Cn = self.PQ_NCorr(C, D, NL, M, out=self.Cn)
+            Cnm = (1 / NL) * np.sum(Cn[..., :NL+1], -1, keepdims=True)
+
+            Cw = np.subtract(Cn, Cnm, out=self.Cw)
+            Cw *= self.Hw
+
+            cp = _rfft(Cw, self.cp)
+            c2 = np.multiply(cp.real, cp.real, out=self.c2)
+            c2 += np.multiply(cp.imag, cp.imag, out=self.c2i)
+
+            EHS = self.PQ_FindPeak(c2, NL//2+1)
+        return np.where(below, -1, EHS)
+
+    def PQ_Corr(self, D, NL, M, out=None): # DFT-based operation in original matlab code
+        M = int(M)
+        NL = int(NL)
+
+        C = np.zeros(np.shape(D)[:-1] + (NL,)) if out is None else out
+        if self.fast_math:
+            # C[i] = D[:M] . D[i:i+M], all lags at once
+            W = np.lib.stride_tricks.sliding_window_view(D, M, axis=-1)[..., :NL, :]
+            if np.ndim(D) == 1:
+                return np.dot(W, D[:M], out=C)
+            return np.einsum('...ij,...j->...i', W, D[..., :M], out=C)
         for i in range(NL):
             s = 0
             for j in range(M):
                 s += D[...,j] * D[...,i+j]
-            C[i] = s
+            C[...,i] = s
         return C
 
     @staticmethod
@@ -934,10 +1397,20 @@ class PEAQ(object):
             m *= 2
         return res - 1
 
-    def PQ_NCorr(self, C, D, NL, M):
-        NL = NL.astype(np.int)
-        M = M.astype(np.int)
-        Cn = np.zeros((NL,))
+    def PQ_NCorr(self, C, D, NL, M, out=None):
+        NL = int(NL)
+        M = int(M)
+        Cn = np.zeros(np.shape(C)[:-1] + (NL,)) if out is None else out
+
+        if np.ndim(C) > 1:
+            # Channels and lags at once, the recursion of sj as a cumulative sum (same order)
+            s0 = C[..., :1]
+            sj = np.cumsum(np.concatenate([s0, D[..., M:NL+M-1] ** 2 - D[..., :NL-1] ** 2], -1), -1)
+            d = s0 * sj
+            np.divide(C, np.sqrt(np.where(d > 0, d, 1)), out=Cn)
+            np.copyto(Cn, 1, where=d <= 0)
+            Cn[..., 0] = 1
+            return Cn
 
         s0 = C[0]
         sj = s0
@@ -953,6 +1426,9 @@ class PEAQ(object):
 
     @staticmethod
     def PQ_FindPeak(c2, N):
+        if np.ndim(c2) > 1:
+            # The largest c2[n], n >= 1, above c2[0] (c2 >= 0), per channel
+            return np.amax(np.where(c2[..., 1:N] > c2[..., :1], c2[..., 1:N], 0), -1)
         cprev = c2[0]
         cmax = 0
         for n in range(1, N):
@@ -998,7 +1474,6 @@ class PEAQ(object):
         Fss = Fs / Nadv
         tavg = 0.1
 
-        import pdb; pdb.set_trace()
         L = np.floor(tavg * Fss)
         WinModDiff1B = self.PQ_WinAvg(int(L), Mt1B[Ndel:])
 
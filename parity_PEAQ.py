@@ -0,0 +1,360 @@
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+import audio_PEAQ
+import numpy_PEAQ
+
+
+'''
+Numerical parity harness for the PEAQ backends.
+
+Every backend/mode is run on the same signals and compared against the numpy
+implementation stage by stage (spectra, excitation patterns, per-frame MOVs,
+averaged MOVs and ODG), reporting the first stage that leaves its tolerance.
+The numpy backend itself is checked against the MATLAB outputs of the bundled
+WAV pair with --matlab.
+
+    python parity_PEAQ.py                 # quick gate, all backends (within BUDGET)
+    python parity_PEAQ.py --all-cases     # also the slow backends on every case
+    python parity_PEAQ.py --matlab        # also the full-length MATLAB check
+    python parity_PEAQ.py -b numpy,torch64 -c tones
+'''
+
+AMAX = 32768
+FS = 48000
+NADV = 1024
+# Wall-clock seconds of a default run (CPU only, no --matlab / --all-cases)
+BUDGET = 60
+
+# MATLAB (PQevalAudio) outputs for test_clean.wav / test_recons.wav
+MATLAB_REFERENCE = {'avgBWRef': 841.045,
+                    'avgBWTest': 304.442,
+                    'totalNMRB': 12.1637,
+                    'WinModDiff1B': 65.3313,
+                    'ADBB': 3.06878,
+                    'EHSB': 7.32808,
+                    'AvgModDiff1B': 65.2213,
+                    'AvgModDiff2B': 125.292,
+                    'RmsNoiseLoudB': 5.72994,
+                    'MFPDB': 1,
+                    'relDistFramesB': 1,
+                    'ODG': -3.875}
+
+# Averaged MOVs in the order the neural network consumes them, followed by ODG
+AVG_MOVS = ['avgBWRef', 'avgBWTest', 'totalNMRB', 'WinModDiff1B', 'ADBB', 'EHSB',
+            'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB', 'MFPDB', 'relDistFramesB', 'ODG']
+
+# Pipeline stages in dependency order: (stage, evaluator attributes)
+# Intermediate stages are optional, backends that don't keep them are compared from the MOVs on.
+STAGES = [('DFT', ['X2MatR', 'X2MatT']),
+          ('excitation', ['EbNMat', 'EsMatR', 'EsMatT']),
+          ('timeSpread', ['EhsR', 'EhsT']),
+          ('Ntot', ['loud_NRef', 'loud_NTest']),
+          ('ModDiff', ['MDiff_Mt1B', 'MDiff_Mt2B', 'MDiff_Wt']),
+          ('NL', ['NLoud_NL']),
+          ('BW', ['BWRef', 'BWTest']),
+          ('PD', ['PD_p', 'PD_q']),
+          ('EHS', ['EHS']),
+          ('NMR', ['NMRavg', 'NMRmax'])] + [(mov, [mov]) for mov in AVG_MOVS]
+OPTIONAL_STAGES = ('DFT', 'excitation', 'timeSpread')
+
+# Per stage (rtol, atol) for each precision class of backend
+TOLERANCES = {
+    'float64': dict([(stage, (1e-9, 1e-9)) for stage, _ in STAGES],
+                    # EbN is a difference spectrum, EHS the peak of a log-ratio correlation
+                    excitation=(1e-9, 1e-6), EHS=(1e-6, 1e-9), EHSB=(1e-6, 1e-9), ODG=(1e-6, 1e-9)),
+    # Largest errors of torch32 / module32 on the generated cases and the bundled pair, with
+    # about 3-10x headroom. The spectra and excitation patterns reach 1e7, float32 resolves
+    # them to about 1; EbN (a difference spectrum) has no relative accuracy near zero.
+    'float32': {'DFT': (1e-4, 1e-3),
+                'excitation': (1e-4, 1.),
+                'timeSpread': (1e-4, 1e-3),
+                'Ntot': (1e-4, 1e-6),
+                'ModDiff': (1e-3, 1e-5),
+                'NL': (1e-4, 1e-6),
+                # One bin
+                'BW': (0, 1),
+                'PD': (1e-3, 1e-6),
+                'EHS': (1e-3, 1e-7),
+                'NMR': (1e-4, 1e-6),
+                'avgBWRef': (1e-5, 1e-4),
+                'avgBWTest': (1e-5, 1e-4),
+                'totalNMRB': (1e-5, 1e-6),
+                'WinModDiff1B': (1e-5, 1e-5),
+                'ADBB': (1e-5, 1e-6),
+                'EHSB': (1e-4, 1e-5),
+                'AvgModDiff1B': (1e-5, 1e-5),
+                'AvgModDiff2B': (1e-4, 1e-5),
+                'RmsNoiseLoudB': (1e-5, 1e-6),
+                'MFPDB': (1e-5, 1e-6),
+                'relDistFramesB': (1e-5, 1e-6),
+                'ODG': (1e-4, 1e-5)},
+}
+MATLAB_TOLERANCE = (1e-4, 1e-3)
+
+
+class Backend(object):
+    # name       - label used on the command line and in the report
+    # run        - callable (ref, test, Fs) -> evaluator with get()/avg_get() already called
+    # precision  - key into TOLERANCES
+    # max_frames - signals are truncated to this many frames for slow backends
+    # cases      - cases run by default for slow backends (None = all)
+    def __init__(self, name, run, precision='float64', max_frames=None, cases=None):
+        self.name = name
+        self.run = run
+        self.precision = precision
+        self.max_frames = max_frames
+        self.cases = cases
+
+
+def _run_numpy(ref, test, Fs):
+    peaq = numpy_PEAQ.PEAQ(AMAX, Fs=Fs)
+    peaq.process(ref, test)
+    peaq.avg_get()
+    return peaq
+
+
+def _torch_runner(dtype_name):
+    def run(ref, test, Fs):
+        import torch
+        import torch_PEAQ
+        peaq = torch_PEAQ.PEAQ(AMAX, Fs=Fs, device=torch.device('cpu'), dtype=getattr(torch, dtype_name))
+        peaq.process(ref, test)
+        peaq.avg_get()
+        return peaq
+    return run
+
+
+def _module_runner(dtype_name, script=False):
+    # PEAQModule returns a dict under the evaluator attribute names, wrap it so collect() can read it
+    def run(ref, test, Fs):
+        import types
+        import torch
+        import torch_PEAQ
+        model = torch_PEAQ.PEAQModule(AMAX, Fs=Fs, dtype=getattr(torch, dtype_name), intermediate=True)
+        if script:
+            model = torch.jit.script(model)
+        with torch.no_grad():
+            out = model(torch.from_numpy(np.asarray(ref, dtype=np.float64)), torch.from_numpy(np.asarray(test, dtype=np.float64)))
+        return types.SimpleNamespace(**out)
+    return run
+
+
+def _torch_available():
+    try:
+        import torch  # noqa: F401
+        import tqdm  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def backends():
+    # Registry of every backend/mode the harness knows about, keyed by name.
+    # The first entry is the reference the others are compared against.
+    registry = [Backend('numpy', _run_numpy)]
+    if _torch_available():
+        # The eager ports run one frame at a time, 'gated' (silent frames included) by default
+        registry.append(Backend('torch64', _torch_runner('float64'), cases=('gated',)))
+        registry.append(Backend('torch32', _torch_runner('float32'), 'float32', cases=('gated',)))
+        registry.append(Backend('module64', _module_runner('float64')))
+        registry.append(Backend('module32', _module_runner('float32'), 'float32'))
+        registry.append(Backend('scripted64', _module_runner('float64', script=True), cases=('tones',)))
+    return dict((backend.name, backend) for backend in registry)
+
+
+## --------------- Signals -------------------- ##
+
+def bandlimit(x, fc, Fs=FS):
+    X = np.fft.rfft(x)
+    X[int(round(fc / Fs * len(x))):] = 0
+    return np.fft.irfft(X, len(x))
+
+
+def music(rng, n, Fs=FS):
+    # Harmonic tones with a slow amplitude envelope over a band limited noise floor
+    t = np.arange(n) / Fs
+    x = np.zeros(n)
+    for f0 in (220., 330., 1250.):
+        for h in range(1, 8):
+            x += np.sin(2 * np.pi * f0 * h * t + rng.uniform(0, 2 * np.pi)) / h
+    x *= 0.6 + 0.4 * np.sin(2 * np.pi * 3 * t)
+    x += 0.05 * rng.standard_normal(n)
+    x = bandlimit(x, 20000., Fs)
+    return 0.3 * AMAX * x / np.amax(np.abs(x))
+
+
+def signals(duration=0.75, seed=1387):
+    # Deterministic (reference, test) pairs covering the code paths of the model:
+    # coding noise, bandwidth loss, clipping and silent frames (EHS = -1, loudness threshold)
+    rng = np.random.RandomState(seed)
+    n = int(duration * FS)
+
+    ref = music(rng, n)
+    noise = 3e-3 * AMAX * rng.standard_normal(n)
+    cases = {'tones': (ref, bandlimit(ref, 16000.) + noise)}
+
+    ref = music(rng, n)
+    cases['bandlimited'] = (ref, bandlimit(ref, 7000.) + 0.1 * noise)
+
+    ref = music(rng, n)
+    test = 0.4 * AMAX * np.tanh(2.5 * ref / AMAX)
+    cases['clipped'] = (ref, bandlimit(test, 18000.) + 0.1 * noise)
+
+    ref = music(rng, n)
+    gate = (np.arange(n) // (6 * NADV)) % 2 == 0
+    ref = ref * gate
+    cases['gated'] = (ref, (bandlimit(ref, 12000.) + 0.01 * noise) * gate)
+
+    return cases
+
+
+def bundled(duration=None):
+    ref, Fs = audio_PEAQ.load('test_clean.wav')
+    test, _ = audio_PEAQ.load('test_recons.wav')
+    if duration is not None:
+        ref, test = ref[:int(duration * Fs)], test[:int(duration * Fs)]
+    return ref, test, Fs
+
+
+## --------------- Comparison -------------------- ##
+
+def _as_array(x):
+    if hasattr(x, 'detach'):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x, dtype=np.float64)
+
+
+def collect(peaq):
+    # Flatten an evaluator into {stage: [(attribute, array)]}
+    out = {}
+    for stage, attrs in STAGES:
+        if not all(hasattr(peaq, attr) for attr in attrs):
+            continue
+        out[stage] = [(attr, _as_array(getattr(peaq, attr))) for attr in attrs]
+    return out
+
+
+def compare(ref, test, tolerances):
+    # Returns a list of (stage, attribute, max abs error, ok) in pipeline order
+    rows = []
+    for stage, _ in STAGES:
+        if stage not in ref or stage not in test:
+            if stage in OPTIONAL_STAGES:
+                continue
+            rows.append((stage, None, np.inf, False))
+            continue
+        rtol, atol = tolerances[stage]
+        for (attr, a), (_, b) in zip(ref[stage], test[stage]):
+            if a.shape != b.shape:
+                rows.append((stage, attr, np.inf, False))
+                continue
+            # NaN on both sides is a match (EHS of silent frames), on one side a failure
+            both_nan = np.isnan(a) & np.isnan(b)
+            err = np.where(both_nan, 0, np.where(np.isnan(a) | np.isnan(b), np.inf, np.abs(a - b)))
+            ok = bool(np.all(err <= atol + rtol * np.abs(np.where(both_nan, 0, a))))
+            rows.append((stage, attr, float(np.max(err)) if err.size else 0., ok))
+    return rows
+
+
+def first_divergence(rows):
+    for stage, attr, err, ok in rows:
+        if not ok:
+            return stage, attr, err
+    return None
+
+
+def _quiet(run, *args):
+    # The models print progress, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return run(*args)
+
+
+def check(cases, names=None, verbose=False, all_cases=False, stream=sys.stdout):
+    # Run every selected backend on every case and compare against the reference backend.
+    # Returns True when all comparisons are within tolerance.
+    registry = backends()
+    reference = next(iter(registry.values()))
+    names = list(registry) if names is None else names
+    passed = True
+    cache = {}
+
+    for case, (ref, test, Fs) in cases.items():
+        for name in names:
+            backend = registry[name]
+            if not all_cases and backend.cases is not None and case not in backend.cases:
+                continue
+            n = len(ref)
+            if backend.max_frames is not None:
+                n = min(n, backend.max_frames * NADV)
+
+            start = time.time()
+            if (case, n) not in cache:
+                cache[(case, n)] = collect(_quiet(reference.run, ref[:n], test[:n], Fs))
+            if backend is reference:
+                print('%-12s %-8s %5d frames %6.1fs  reference' % (case, name, n // NADV, time.time() - start), file=stream)
+                continue
+
+            start = time.time()
+            result = collect(_quiet(backend.run, ref[:n], test[:n], Fs))
+            elapsed = time.time() - start
+
+            rows = compare(cache[(case, n)], result, TOLERANCES[backend.precision])
+            diverged = first_divergence(rows)
+            passed = passed and diverged is None
+            status = 'ok' if diverged is None else 'FIRST DIVERGENCE %s.%s (max abs err %.3g)' % diverged
+            print('%-12s %-8s %5d frames %6.1fs  %s' % (case, name, n // NADV, elapsed, status), file=stream)
+            if verbose:
+                for stage, attr, err, ok in rows:
+                    print('    %-14s %-16s %.3g %s' % (stage, attr, err, '' if ok else '<--'), file=stream)
+    return passed
+
+
+def check_matlab(stream=sys.stdout):
+    # Full-length bundled pair against the MATLAB reference outputs
+    ref, test, Fs = bundled()
+    start = time.time()
+    peaq = _quiet(_run_numpy, ref, test, Fs)
+    passed = True
+    rtol, atol = MATLAB_TOLERANCE
+    for mov in AVG_MOVS:
+        value = float(_as_array(getattr(peaq, mov)))
+        expected = MATLAB_REFERENCE[mov]
+        # MATLAB values are printed with 6 significant digits
+        ok = abs(value - expected) <= atol + rtol * abs(expected)
+        passed = passed and ok
+        print('    %-16s %12.6g %12.6g %s' % (mov, value, expected, '' if ok else '<--'), file=stream)
+    print('%-12s %-8s %5d frames %6.1fs  %s' % ('matlab', 'numpy', peaq.Np, time.time() - start,
+                                                'ok' if passed else 'MISMATCH'), file=stream)
+    return passed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PEAQ backend parity harness')
+    parser.add_argument('-b', '--backends', help='comma separated backends (default: all available)')
+    parser.add_argument('-c', '--cases', help='comma separated cases (default: all)')
+    parser.add_argument('-d', '--duration', type=float, default=0.75, help='seconds per generated signal')
+    parser.add_argument('--all-cases', action='store_true', help='run slow backends on every case too')
+    parser.add_argument('--matlab', action='store_true', help='also check the full bundled pair against MATLAB')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every stage comparison')
+    args = parser.parse_args(argv)
+
+    cases = dict((name, (ref, test, FS)) for name, (ref, test) in signals(args.duration).items())
+    cases['bundled'] = bundled(args.duration)
+    if args.cases:
+        cases = dict((name, cases[name]) for name in args.cases.split(','))
+    names = args.backends.split(',') if args.backends else None
+
+    passed = check(cases, names, args.verbose, args.all_cases)
+    if args.matlab:
+        passed = check_matlab() and passed
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
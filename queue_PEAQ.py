@@ -0,0 +1,354 @@
+import argparse
+import contextlib
+import csv
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import audio_PEAQ
+import export_PEAQ
+import numpy_PEAQ
+
+
+'''
+Corpus scoring by any number of nodes sharing a work queue in a directory.
+
+The queue is a directory on a file system all nodes can reach (a local disk for
+several processes on one machine, NFS or similar across machines):
+
+    jobs/<id>.json           (reference, test) WAV paths, written once by submit()
+    locks/<id>.lock          held by the node scoring the job, O_EXCL created
+    done/<id>                the job's result is in a shard
+    results/<node>.jsonl     one shard per node, a line per scored job
+    results.csv              merged table, written by merge()
+    frames/                  with frames=True: per-frame MOVs of every job, an
+                             export_PEAQ store (pair = job id) for Reader.query
+
+A node claims a job by creating its lock file exclusively and keeps touching it
+(heartbeat) while it scores the pair with PEAQ.process / avg_get. The result is
+appended to the node's shard and synced before the done marker is written and the
+lock removed. A lock that has not been touched for timeout seconds, or whose process
+is gone (same host), belongs to a crashed node: another node renames it away
+(only one rename succeeds) and takes the job over. A job can then rarely be scored
+twice; merge() keeps one result per job.
+
+    python queue_PEAQ.py submit corpus pairs.csv        # lines: reference,test
+    python queue_PEAQ.py work corpus                    # on every node, as often as wanted
+    python queue_PEAQ.py status corpus
+    python queue_PEAQ.py merge corpus                   # corpus/results.csv
+
+Nodes run with --frames also write the per-frame MOVs of every job as a part of
+corpus/frames before marking it done; merge() compacts these parts into a few
+large ones, indexed for queries over all frames of the corpus.
+'''
+
+AMAX = 32768
+COLUMNS = ['id', 'reference', 'test', 'node', 'seconds', 'error', 'frames_error'] + export_PEAQ.AVG_MOVS
+
+
+def _dirs(path):
+    return dict((name, os.path.join(path, name)) for name in ('jobs', 'locks', 'done', 'results'))
+
+
+def _write(path, text):
+    # Written under a hidden name and renamed, readers see whole files only
+    tmp = os.path.join(os.path.dirname(path), '.%s.%s' % (os.path.basename(path), uuid.uuid4().hex[:8]))
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def submit(path, pairs):
+    # Adds (reference, test) WAV path pairs as jobs; returns their ids. Ids continue the
+    # existing ones, concurrent submitters skip ids taken meanwhile.
+    dirs = _dirs(path)
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    n = len(jobs(path))
+    ids = []
+    for ref, test in pairs:
+        text = json.dumps({'reference': os.path.abspath(ref), 'test': os.path.abspath(test)})
+        tmp = os.path.join(dirs['jobs'], '.submit-' + uuid.uuid4().hex)
+        with open(tmp, 'w') as f:
+            f.write(text)
+        try:
+            while True:
+                job = '%08d' % n
+                n += 1
+                try:
+                    # A hard link fails if the name exists: the complete job appears atomically
+                    os.link(tmp, os.path.join(dirs['jobs'], job + '.json'))
+                    break
+                except FileExistsError:
+                    continue
+        finally:
+            os.remove(tmp)
+        ids.append(job)
+    return ids
+
+
+def jobs(path):
+    # Ids of all submitted jobs, in submission order
+    d = _dirs(path)['jobs']
+    if not os.path.isdir(d):
+        return []
+    return sorted(name[:-5] for name in os.listdir(d) if name.endswith('.json') and not name.startswith('.'))
+
+
+def _alive(info):
+    # Whether the process holding a lock may still run (unknown on other hosts)
+    if info.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(int(info['pid']), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, KeyError, ValueError):
+        pass
+    return True
+
+
+def _abandoned(lock, timeout):
+    try:
+        age = time.time() - os.stat(lock).st_mtime
+        with open(lock) as f:
+            info = json.loads(f.read() or '{}')
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        info = {}
+    return age > timeout or ('pid' in info and not _alive(info))
+
+
+class Lock(object):
+    # Exclusive claim of a job by a node, kept alive by a heartbeat thread
+    def __init__(self, path, job, node, timeout=60.):
+        self.path = os.path.join(_dirs(path)['locks'], job + '.lock')
+        self.node = node
+        self.timeout = timeout
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        # True if this node now holds the job, taking over an abandoned lock
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not _abandoned(self.path, self.timeout):
+                    return False
+                stale = '%s.stale-%s' % (self.path, uuid.uuid4().hex[:8])
+                try:
+                    os.rename(self.path, stale)
+                except FileNotFoundError:
+                    return False
+                if not _abandoned(stale, self.timeout):
+                    # Renamed a lock taken meanwhile, give it back unless replaced again
+                    try:
+                        os.link(stale, self.path)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale)
+                    return False
+                os.remove(stale)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps({'node': self.node, 'host': socket.gethostname(), 'pid': os.getpid(),
+                                    'time': time.time()}))
+            self._thread = threading.Thread(target=self._beat, daemon=True)
+            self._thread.start()
+            return True
+        return False
+
+    def _beat(self):
+        while not self._stop.wait(self.timeout / 4):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                # Taken over by another node, which scores the job again
+                self.lost = True
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if not self.lost:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+
+def _score(ref, test, fast_math=False, frames=False):
+    # Averaged MOVs and ODG (export_PEAQ.AVG_MOVS) of a pair of WAV files, PEAQ.process / avg_get;
+    # with frames=True also the per-frame MOVs (export_PEAQ.FRAME_MOVS) as arrays
+    ref, Fs = audio_PEAQ.load(ref)
+    test, rate = audio_PEAQ.load(test)
+    if rate != Fs:
+        raise ValueError(f'reference at {Fs} Hz and test at {rate} Hz')
+    peaq = numpy_PEAQ.PEAQ(AMAX, fast_math=fast_math)
+    peaq.process(ref, test, Fs=Fs)
+    peaq.avg_get()
+    out = dict((name, float(getattr(peaq, name))) for name in export_PEAQ.AVG_MOVS)
+    if frames:
+        out.update((name, getattr(peaq, name)) for name in export_PEAQ.FRAME_MOVS)
+    return out
+
+
+def _run(path, job, node, shard, fast_math=False, frames=False):
+    # Scores a claimed job, writes its per-frame MOVs (frames=True) and appends the
+    # result to the shard, then marks the job done
+    dirs = _dirs(path)
+    with open(os.path.join(dirs['jobs'], job + '.json')) as f:
+        spec = json.load(f)
+    row = {'id': job, 'reference': spec['reference'], 'test': spec['test'], 'node': node}
+    start = time.perf_counter()
+    try:
+        result = _score(spec['reference'], spec['test'], fast_math, frames)
+    except Exception as e:
+        # Recorded as done, a damaged file would fail on every node
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+    else:
+        row.update((name, result[name]) for name in export_PEAQ.AVG_MOVS)
+        if frames:
+            # One part per job, complete before the job is done; merge() compacts them. The
+            # averages are kept if they can't be stored (e.g. multichannel pairs).
+            try:
+                with export_PEAQ.Writer(os.path.join(path, 'frames'), batch=1) as w:
+                    w.add(job, result)
+            except Exception as e:
+                row['frames_error'] = '%s: %s' % (type(e).__name__, e)
+    row['seconds'] = time.perf_counter() - start
+    with open(shard, 'a') as f:
+        f.write(json.dumps(row) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    _write(os.path.join(dirs['done'], job), node)
+
+
+def work(path, node=None, timeout=60., poll=1., wait=False, fast_math=False, max_jobs=None, frames=False):
+    # Runs a node: claims and scores jobs until all are done (or max_jobs are scored),
+    # waiting for jobs held by other live nodes in case they crash; with wait=True it
+    # keeps polling for new jobs, with frames=True it stores the per-frame MOVs in
+    # path/frames. Returns the number of jobs this node scored.
+    node = node or '%s-%d' % (socket.gethostname(), os.getpid())
+    dirs = _dirs(path)
+    for d in dirs.values():
+        os.makedirs(d, exist_ok=True)
+    shard = os.path.join(dirs['results'], node + '.jsonl')
+    scored = 0
+    while max_jobs is None or scored < max_jobs:
+        todo = [job for job in jobs(path) if not os.path.exists(os.path.join(dirs['done'], job))]
+        if not todo and not wait:
+            break
+        claimed = 0
+        for job in todo:
+            if max_jobs is not None and scored >= max_jobs:
+                break
+            lock = Lock(path, job, node, timeout)
+            if not lock.acquire():
+                continue
+            try:
+                if os.path.exists(os.path.join(dirs['done'], job)):
+                    continue
+                _run(path, job, node, shard, fast_math, frames)
+                claimed += 1
+                scored += 1
+            finally:
+                lock.release()
+        if not claimed:
+            # The rest is held by other nodes, until they finish or are found abandoned
+            time.sleep(poll)
+    return scored
+
+
+def status(path, timeout=60.):
+    # Job counts: total, done, running (live locks), abandoned (stale locks), pending
+    dirs = _dirs(path)
+    ids = jobs(path)
+    done = running = abandoned = 0
+    for job in ids:
+        lock = os.path.join(dirs['locks'], job + '.lock')
+        if os.path.exists(os.path.join(dirs['done'], job)):
+            done += 1
+        elif os.path.exists(lock):
+            if _abandoned(lock, timeout):
+                abandoned += 1
+            else:
+                running += 1
+    return {'jobs': len(ids), 'done': done, 'running': running, 'abandoned': abandoned,
+            'pending': len(ids) - done - running - abandoned}
+
+
+def merge(path, out=None):
+    # One row per job from all shards (a scored result before an error, either before a
+    # duplicate), in job order, written as CSV to out (default path/results.csv); returns
+    # the rows as dicts. The per-frame MOVs in path/frames, if any, are compacted (no
+    # node should be writing them meanwhile).
+    rows = {}
+    d = _dirs(path)['results']
+    for name in sorted(os.listdir(d)) if os.path.isdir(d) else []:
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(d, name)) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # Last line of a node that crashed while writing it
+                    continue
+                if row['id'] not in rows or ('error' in rows[row['id']] and 'error' not in row):
+                    rows[row['id']] = row
+    rows = [rows[job] for job in sorted(rows)]
+    out = os.path.join(path, 'results.csv') if out is None else out
+    with open(out + '.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    os.replace(out + '.tmp', out)
+    if os.path.isdir(os.path.join(path, 'frames')):
+        export_PEAQ.compact(os.path.join(path, 'frames'))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Corpus scoring over a shared directory work queue')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('submit', help='add jobs from a CSV of reference,test WAV paths')
+    p.add_argument('path')
+    p.add_argument('pairs', help='CSV file, one reference,test pair per line')
+    p = commands.add_parser('work', help='score jobs until all are done')
+    p.add_argument('path')
+    p.add_argument('--node', help='shard name (default: host-pid)')
+    p.add_argument('--timeout', type=float, default=60., help='seconds without heartbeat until a lock is abandoned')
+    p.add_argument('--wait', action='store_true', help='keep polling for new jobs')
+    p.add_argument('--fast-math', action='store_true', help='numpy_PEAQ fast math kernels')
+    p.add_argument('--frames', action='store_true', help='also store the per-frame MOVs in path/frames')
+    p = commands.add_parser('status', help='job counts')
+    p.add_argument('path')
+    p = commands.add_parser('merge', help='merge the shards into path/results.csv')
+    p.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'submit':
+        with open(args.pairs, newline='') as f:
+            pairs = [row[:2] for row in csv.reader(f) if row]
+        print('%d jobs' % len(submit(args.path, pairs)))
+    elif args.command == 'work':
+        n = work(args.path, args.node, args.timeout, wait=args.wait, fast_math=args.fast_math,
+                 frames=args.frames)
+        print('%d jobs scored' % n, file=sys.stderr)
+    elif args.command == 'status':
+        print(json.dumps(status(args.path)))
+    else:
+        print('%d rows' % len(merge(args.path)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
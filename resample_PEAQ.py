@@ -0,0 +1,143 @@
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+'''
+Sample rate conversion front end for the PEAQ models, which assume 48 kHz.
+
+Resampler converts by the rational factor L/M = Fs_out/Fs_in (reduced) with a
+polyphase windowed-sinc filter: output sample n is the dot product of the
+T input samples ending at (n*M + D)//L with the filter phase (n*M + D) % L,
+where D is the delay of the linear phase filter, so the output is time aligned
+with the input. The output samples of a block are computed phase by phase,
+each phase as one product of a strided view of the input windows with its
+taps, and the state between blocks is the input history the next outputs
+need, so signals can be converted as they arrive:
+
+    rs = Resampler(44100)
+    for chunk in chunks:                    # (..., n) blocks of input samples
+        y = rs.process(chunk)               # the 48 kHz samples they complete
+    y = rs.flush()                          # the rest, the input is zero padded
+
+resample(x, Fs) converts a whole signal the same way, block by block.
+'''
+
+FS = 48000
+
+
+class Resampler(object):
+    # Fs_in, Fs_out - sampling rates (integers)
+    # zeros         - zero crossings of the sinc on each side, taps per phase about 2 * zeros
+    # rolloff       - cutoff as a fraction of the lower Nyquist frequency
+    # beta          - Kaiser window parameter (stop band attenuation about 8.7 * beta dB)
+    def __init__(self, Fs_in, Fs_out=FS, zeros=16, rolloff=0.95, beta=10.):
+        g = math.gcd(int(Fs_in), int(Fs_out))
+        self.Fs_in, self.Fs_out = int(Fs_in), int(Fs_out)
+        self.L, self.M = self.Fs_out // g, self.Fs_in // g
+        L, M = self.L, self.M
+
+        # Prototype low pass at the upsampled rate L*Fs_in, linear phase with delay D
+        R = max(L, M)
+        self.D = zeros * R
+        n = np.arange(2 * self.D + 1) - self.D
+        fc = 0.5 * rolloff / R
+        h = 2 * fc * np.sinc(2 * fc * n) * np.kaiser(len(n), beta) * L
+        # Phase p holds the taps h[p + k*L], k = 0..T-1, against the inputs base - k
+        self.T = -(-len(h) // L)
+        self.H = np.pad(h, (0, self.T * L - len(h))).reshape(self.T, L).T.copy()
+
+        self.reset()
+
+    def reset(self):
+        self.n = 0          # next output sample
+        self.received = 0   # input samples received
+        self.start = 0      # input index of buf[..., 0]
+        self.buf = None
+
+    def _base(self, n):
+        return (n * self.M + self.D) // self.L
+
+    def output_length(self, N):
+        # Output samples for N input samples (of a whole signal)
+        return -(-N * self.L // self.M)
+
+    def process(self, x):
+        # x: (..., n) next input samples, returns the output samples they complete
+        x = np.asarray(x, dtype=np.float64)
+        if self.buf is None:
+            # Inputs before the start are zeros
+            self.start = -(self.T - 1)
+            self.buf = np.zeros(x.shape[:-1] + (self.T - 1,))
+        self.buf = np.concatenate([self.buf, x], -1)
+        self.received += x.shape[-1]
+        return self._run(self.received)
+
+    def flush(self):
+        # Remaining output samples of the signal, the input continued with zeros
+        if self.buf is None:
+            return np.zeros(0)
+        end = self.output_length(self.received)
+        need = self._base(end - 1) + 1 if end > self.n else self.received
+        pad = max(need - (self.start + self.buf.shape[-1]), 0)
+        self.buf = np.concatenate([self.buf, np.zeros(self.buf.shape[:-1] + (pad,))], -1)
+        return self._run(self.start + self.buf.shape[-1], end)
+
+    def _run(self, available, end=None):
+        # Output samples n whose inputs are all below available (and n < end). Outputs n
+        # and n + L use the same phase with inputs M apart, so each phase is a product of
+        # a strided view of the input windows (no copies) with its taps.
+        stop = (available * self.L - self.D - 1) // self.M + 1
+        if end is not None:
+            stop = min(stop, end)
+        count = max(stop - self.n, 0)
+        out = np.empty(self.buf.shape[:-1] + (count,))
+        if count == 0:
+            return out
+        windows = sliding_window_view(self.buf, self.T, axis=-1)
+        for r in range(min(self.L, count)):
+            n = self.n + r
+            first = self._base(n) - (self.T - 1) - self.start
+            m = len(range(r, count, self.L))
+            x = windows[..., first:first + (m - 1) * self.M + 1:self.M, :]
+            out[..., r::self.L] = x @ self.H[(n * self.M + self.D) % self.L, ::-1]
+        self.n = max(self.n, stop)
+        # Keep the history the next output needs
+        first = self._base(self.n) - (self.T - 1)
+        drop = min(max(first - self.start, 0), self.buf.shape[-1])
+        self.buf = self.buf[..., drop:]
+        self.start += drop
+        return out
+
+
+def resample(x, Fs_in, Fs_out=FS, block=1 << 16, **kwargs):
+    # Whole signal (..., N) at Fs_in to Fs_out, output_length(N) samples, converted in blocks
+    x = np.asarray(x, dtype=np.float64)
+    if int(Fs_in) == int(Fs_out):
+        return x
+    rs = Resampler(Fs_in, Fs_out, **kwargs)
+    out = [rs.process(x[..., i:i + block]) for i in range(0, x.shape[-1], block)]
+    out.append(rs.flush())
+    return np.concatenate(out, -1)
+
+
+def blocks(x, Fs_in, sizes, Fs_out=FS, chunk=1 << 14):
+    # Generator converting x (..., N) on the fly into consecutive output blocks of the given
+    # sizes (an iterable of sample counts); the input is consumed chunk by chunk as needed
+    # and the last blocks are cut at the end of the converted signal
+    rs = Resampler(Fs_in, Fs_out)
+    total = rs.output_length(x.shape[-1])
+    pending = np.zeros(x.shape[:-1] + (0,))
+    pos = 0
+    for size in sizes:
+        size = min(size, total - rs.n + pending.shape[-1])
+        while pending.shape[-1] < size:
+            if pos < x.shape[-1]:
+                y = rs.process(x[..., pos:pos + chunk])
+                pos += chunk
+            else:
+                y = rs.flush()
+            pending = np.concatenate([pending, y], -1)
+        yield pending[..., :size]
+        pending = pending[..., size:]
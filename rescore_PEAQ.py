@@ -0,0 +1,146 @@
+import numpy as np
+
+import approx_PEAQ
+import export_PEAQ
+import numpy_PEAQ
+
+
+'''
+Incremental re-scoring of a test signal of which only a region changed.
+
+record() scores a pair once and keeps the per-frame MOVs and, before every
+every-th frame, the recursive state of the model (numpy_PEAQ.STATE: time spreading,
+level and pattern adaptation, modulation patterns). After an edit of the test
+signal in samples start..stop-1, rescore() restarts from the last snapshot before
+the first frame that sees the edit and scores frames up to the end of the edit,
+then on, snapshot by snapshot, until the state agrees with the stored one again
+(the recursive smoothers have settled on the old trajectory, to rtol). Only the
+frames of that span are spliced into the stored per-frame MOVs, and the averages
+and ODG are computed from them again, as PEAQ.avg_get of a full rerun.
+
+    rec = record(ref, test)                     # or load('pair.npz')
+    test[start:stop] = reencoded
+    result = rescore(rec, ref, test, start, stop)
+    result['ODG'], result['span']
+
+EHS, bandwidth and NMR don't depend on earlier frames; they are computed again only
+for frames overlapping the edit. 48 kHz signals of the length of the recording only.
+'''
+
+AMAX = 32768
+
+
+class Record(object):
+    # Per-frame MOVs (export_PEAQ.FRAME_MOVS) of a full run and its state snapshots
+    # frames  - {name: (Np,) array}
+    # states  - {name: (ceil(Np / every), ...) array}, row k is the state before frame k * every
+    # length  - samples of the reference
+    def __init__(self, frames, states, every, length, fast_math=False):
+        self.frames = frames
+        self.states = states
+        self.every = int(every)
+        self.length = int(length)
+        self.fast_math = bool(fast_math)
+        self.Np = len(frames['EHS'])
+
+    def averages(self):
+        # Averaged MOVs and ODG (export_PEAQ.AVG_MOVS) of the stored frames
+        return approx_PEAQ.average(self.frames)
+
+    def save(self, path):
+        arrays = dict(('frame_' + name, x) for name, x in self.frames.items())
+        arrays.update(('state_' + name, x) for name, x in self.states.items())
+        np.savez(path, every=self.every, length=self.length, fast_math=self.fast_math, **arrays)
+
+
+def load(path):
+    with np.load(path) as f:
+        frames = dict((name, f['frame_' + name]) for name in export_PEAQ.FRAME_MOVS)
+        states = dict((name, f['state_' + name]) for name in numpy_PEAQ.STATE)
+        return Record(frames, states, f['every'], f['length'], f['fast_math'])
+
+
+def _peaq(fast_math):
+    return numpy_PEAQ.PEAQ(AMAX, keep_spectra=False, fast_math=fast_math)
+
+
+def record(ref, test, every=64, fast_math=False):
+    # Full run of a 48 kHz pair keeping what rescore() needs; every = frames between
+    # snapshots (64 frames = 1.4 s, 12 KB of state each)
+    peaq = _peaq(fast_math)
+    peaq.process(ref, test, snapshots=every)
+    frames = dict((name, np.array(getattr(peaq, name), dtype=np.float64)) for name in export_PEAQ.FRAME_MOVS)
+    return Record(frames, peaq.states, every, len(ref), fast_math)
+
+
+def rescore(rec, ref, test, start, stop, rtol=1e-12, verify=False):
+    # Updates rec for the test signal edited in samples start..stop-1 and returns the
+    # averaged MOVs and ODG (export_PEAQ.AVG_MOVS) with
+    #   span   - (first, end): frames scored again
+    #   edited - (first, end): frames overlapping the edit
+    #   error  - verify=True only: largest relative difference of the per-frame MOVs and
+    #            the averages to a full rerun
+    # rtol is the agreement of the state with a stored snapshot that ends the span.
+    if len(ref) != rec.length or len(test) != rec.length:
+        raise ValueError(f'signals of {len(ref)} and {len(test)} samples, recorded {rec.length}')
+    peaq = _peaq(rec.fast_math)
+    Nadv, every, Np = peaq.Nadv, rec.every, rec.Np
+    # Frame i reads samples i * Nadv .. i * Nadv + NF - 1
+    first = max(int(start) // Nadv - 1, 0)
+    last = min((int(stop) - 1) // Nadv + 1, Np) if stop > start else first
+    span = edited = (first, max(first, last))
+
+    if first < last:
+        peaq.PQE = numpy_PEAQ.PQEval(AMAX, peaq.Fs, peaq.NF, fast_math=rec.fast_math)
+        peaq.PQ_workspace()
+        k = first // every
+        peaq.PQ_setState(dict((name, x[k]) for name, x in rec.states.items()))
+        a = k * every
+        while a < Np:
+            # The next every frames, from a view of the signals starting at frame a
+            n = min(every, Np - a)
+            sigR, sigT = ref[a * Nadv:], test[a * Nadv:]
+            peaq.Np = n
+            peaq.PQ_frameArrays(n)
+            silent, _ = peaq.PQ_frameClasses(sigR, sigT)
+            frames = np.arange(a, a + n)
+            ehs = (frames >= first) & (frames < last)
+            peaq.PQ_frames(sigR, sigT, 0, n, silent, ehs)
+            peaq.NMRavg, peaq.NMRmax = peaq.computeNMR(peaq.EbNMat, peaq.EhsR)
+            for name in export_PEAQ.FRAME_MOVS:
+                x = np.asarray(getattr(peaq, name), dtype=np.float64)
+                if name == 'EHS':
+                    rec.frames[name][a:a + n][ehs] = x[ehs]
+                else:
+                    rec.frames[name][a:a + n] = x
+            a += n
+            span = (first, a)
+            if a >= Np:
+                break
+            state = peaq.PQ_state()
+            if a >= last and all(np.allclose(state[name], rec.states[name][a // every], rtol=rtol, atol=0)
+                                 for name in numpy_PEAQ.STATE):
+                break
+            for name, x in state.items():
+                rec.states[name][a // every] = x
+
+    result = rec.averages()
+    result['span'] = span
+    result['edited'] = edited
+    if verify:
+        full = record(ref, test, every, rec.fast_math)
+        error = 0.
+        for name in export_PEAQ.FRAME_MOVS:
+            error = max(error, _relative(rec.frames[name], full.frames[name]))
+        average = full.averages()
+        for name in export_PEAQ.AVG_MOVS:
+            error = max(error, _relative(result[name], average[name]))
+        result['error'] = error
+    return result
+
+
+def _relative(x, y):
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    both = np.isnan(x) & np.isnan(y)
+    d = np.abs(x - y) / np.maximum(np.abs(y), 1e-12)
+    return float(np.max(np.where(both, 0, d), initial=0))
@@ -0,0 +1,346 @@
+import argparse
+import base64
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import audio_PEAQ
+
+
+'''
+Local PEAQ scoring service.
+
+A long-running HTTP server in front of a pool of warm worker processes. Each
+worker imports its backend and builds the model tables once, requests are
+queued, batched (pairs of the same length are scored in one PEAQModule call)
+and answered with the averaged MOVs / ODG as JSON, with per-request latency.
+Multichannel inputs are scored with the BS.1387 channel combination.
+
+    python server_PEAQ.py --port 8387 --workers 2
+
+    POST /score    {"reference": "ref.wav", "test": "test.wav"}
+                   {"reference_pcm": <base64>, "test_pcm": <base64>, "rate": 48000,
+                    "format": "s16", "channels": 1}   (format: u8, s16, s24, s32, f32, f64)
+    GET  /metrics  request counts, batch sizes and latency percentiles
+    GET  /health
+'''
+
+AMAX = 32768
+FS = 48000
+MOVS = ['avgBWRef', 'avgBWTest', 'totalNMRB', 'WinModDiff1B', 'ADBB', 'EHSB',
+        'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB', 'MFPDB', 'relDistFramesB', 'ODG']
+BACKENDS = ('module64', 'module32', 'numpy')
+
+
+class Busy(Exception):
+    # Raised when the request queue is full
+    pass
+
+
+## --------------- Worker processes -------------------- ##
+
+_worker = {}
+
+
+def _init_worker(backend, threads):
+    # Runs once per worker process: imports and model tables stay warm
+    _worker['backend'] = backend
+    if backend.startswith('module'):
+        import torch
+        import torch_PEAQ
+        if threads:
+            torch.set_num_threads(threads)
+        dtype = torch.float64 if backend == 'module64' else torch.float32
+        _worker['model'] = torch_PEAQ.PEAQModule(AMAX, Fs=FS, dtype=dtype)
+
+
+def _ready():
+    return _worker['backend']
+
+
+def _score(pairs):
+    # pairs: list of (ref, test), references of the same shape for the module backends;
+    # 2-D signals are (channels, samples) and scored as one multichannel item
+    start = time.perf_counter()
+    if _worker['backend'] == 'numpy':
+        import numpy_PEAQ
+        results = []
+        for ref, test in pairs:
+            peaq = numpy_PEAQ.PEAQ(AMAX, Fs=FS)
+            peaq.process(ref, test)
+            peaq.avg_get()
+            result = dict((mov, float(getattr(peaq, mov))) for mov in MOVS)
+            result['frames'] = int(peaq.Np)
+            results.append(result)
+    else:
+        import torch
+        # Tests cut or zero padded to the reference length, as PEAQModule does, so that
+        # pairs with equal references but different test lengths stack into one batch
+        n = pairs[0][0].shape[-1]
+        tests = [np.pad(test[..., :n], [(0, 0)] * (test.ndim - 1) + [(0, n - min(test.shape[-1], n))])
+                 for _, test in pairs]
+        with torch.no_grad():
+            out = _worker['model'](torch.from_numpy(np.stack([p[0] for p in pairs])),
+                                   torch.from_numpy(np.stack(tests)), pairs[0][0].ndim > 1)
+        results = []
+        for i in range(len(pairs)):
+            result = dict((mov, float(out[mov][i])) for mov in MOVS + ['DI'])
+            result['frames'] = int(out['EHS'].shape[-1])
+            results.append(result)
+    return results, time.perf_counter() - start
+
+
+## --------------- Queue and batching -------------------- ##
+
+class Job(object):
+    def __init__(self, ref, test):
+        self.ref = ref
+        self.test = test
+        self.future = concurrent.futures.Future()
+        self.received = time.perf_counter()
+        self.started = None
+
+
+class Scorer(object):
+    # Request queue in front of the worker pool. A dispatcher thread waits for a free
+    # worker, then takes whatever is queued (up to max_batch, waiting at most
+    # batch_window for more) and sends pairs of equal length to a worker together.
+    def __init__(self, backend='module64', workers=2, max_batch=8, batch_window=0.005, max_pending=64, threads=1):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend}, choose from {BACKENDS}')
+        self.backend = backend
+        self.max_batch = 1 if backend == 'numpy' else max_batch
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.queue = queue.Queue()
+        self.free = threading.Semaphore(workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.counts = collections.Counter()
+        self.latency = collections.deque(maxlen=1000)
+        self.batches = collections.deque(maxlen=1000)
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                                           initializer=_init_worker, initargs=(backend, threads))
+        # Start the workers now rather than on the first request
+        concurrent.futures.wait([self.pool.submit(_ready) for _ in range(workers)])
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, ref, test):
+        # Returns a Future with the result dict, raises Busy when the queue is full
+        if ref.shape[:-1] != test.shape[:-1]:
+            raise ValueError('reference and test have different numbers of channels')
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.counts['rejected'] += 1
+                raise Busy('%d requests pending' % self.pending)
+            self.pending += 1
+            self.counts['requests'] += 1
+        job = Job(ref, test)
+        self.queue.put(job)
+        return job.future
+
+    def score(self, ref, test):
+        return self.submit(ref, test).result()
+
+    def _dispatch(self):
+        while True:
+            self.free.acquire()
+            job = self.queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            deadline = time.perf_counter() + self.batch_window
+            while len(jobs) < self.max_batch:
+                try:
+                    job = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.queue.put(None)
+                    break
+                jobs.append(job)
+
+            groups = collections.OrderedDict()
+            for job in jobs:
+                groups.setdefault(job.ref.shape, []).append(job)
+            for i, group in enumerate(groups.values()):
+                if i > 0:
+                    self.free.acquire()
+                self._run(group)
+
+    def _run(self, jobs):
+        now = time.perf_counter()
+        for job in jobs:
+            job.started = now
+        try:
+            future = self.pool.submit(_score, [(job.ref, job.test) for job in jobs])
+        except RuntimeError as e:  # pool shut down
+            self.free.release()
+            self._finish(jobs, error=e)
+            return
+        future.add_done_callback(lambda f: self._done(jobs, f))
+
+    def _done(self, jobs, future):
+        self.free.release()
+        try:
+            results, compute_s = future.result()
+        except Exception as e:
+            self._finish(jobs, error=e)
+            return
+        self._finish(jobs, results, compute_s)
+
+    def _finish(self, jobs, results=None, compute_s=0., error=None):
+        now = time.perf_counter()
+        with self.lock:
+            self.pending -= len(jobs)
+            self.batches.append(len(jobs))
+            self.counts['errors' if error is not None else 'scored'] += len(jobs)
+        for i, job in enumerate(jobs):
+            if error is not None:
+                job.future.set_exception(error)
+                continue
+            result = results[i]
+            result['latency'] = {'queue_s': job.started - job.received,
+                                 'compute_s': compute_s,
+                                 'total_s': now - job.received,
+                                 'batch': len(jobs)}
+            with self.lock:
+                self.latency.append(result['latency'])
+            job.future.set_result(result)
+
+    def metrics(self):
+        with self.lock:
+            latency = list(self.latency)
+            batches = list(self.batches)
+            out = dict(self.counts)
+            out['pending'] = self.pending
+        out['backend'] = self.backend
+        out['mean_batch'] = float(np.mean(batches)) if batches else None
+        for key in ('queue_s', 'compute_s', 'total_s'):
+            x = np.array([l[key] for l in latency])
+            out[key] = (dict((name, float(np.percentile(x, q))) for name, q in (('p50', 50), ('p95', 95), ('max', 100)))
+                        if len(x) else None)
+        return out
+
+    def close(self):
+        self.queue.put(None)
+        self.dispatcher.join()
+        self.pool.shutdown()
+
+
+## --------------- HTTP front end -------------------- ##
+
+def _signal(payload, name):
+    # A request signal is either a file path or base64 raw PCM, on the 16-bit scale
+    if name in payload:
+        audio, rate = audio_PEAQ.load(payload[name])
+    elif name + '_pcm' in payload:
+        pcm = base64.b64decode(payload[name + '_pcm'])
+        audio = audio_PEAQ.decode_pcm(pcm, payload.get('format', 's16'), int(payload.get('channels', 1)))
+        rate = int(payload.get('rate', FS))
+    else:
+        raise ValueError(f'Missing "{name}" (file path) or "{name}_pcm" (base64 PCM)')
+    if rate != FS:
+        raise ValueError(f'{name}: sampling rate {rate}, the model needs {FS} Hz')
+    return np.ascontiguousarray(audio, dtype=np.float64)
+
+
+class Handler(BaseHTTPRequestHandler):
+    scorer = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._reply(200, self.scorer.metrics())
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            ref = _signal(payload, 'reference')
+            test = _signal(payload, 'test')
+        except (ValueError, KeyError, OSError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        try:
+            future = self.scorer.submit(ref, test)
+        except Busy as e:
+            self._reply(503, {'error': str(e)})
+            return
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+            return
+        try:
+            self._reply(200, future.result())
+        except Exception as e:
+            self._reply(500, {'error': '%s: %s' % (type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(scorer, host='127.0.0.1', port=8387):
+    # Returns the (not yet started) server, port 0 picks a free port
+    handler = type('Handler', (Handler,), {'scorer': scorer})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def request(url, payload=None, timeout=None):
+    # Small client: GET when payload is None, POST JSON otherwise
+    data = None if payload is None else json.dumps(payload).encode()
+    req = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as r:
+        return json.loads(r.read())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local PEAQ scoring server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8387)
+    parser.add_argument('-b', '--backend', default='module64', choices=BACKENDS)
+    parser.add_argument('-w', '--workers', type=int, default=2, help='worker processes')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--max-batch', type=int, default=8, help='pairs scored together per worker call')
+    parser.add_argument('--batch-window', type=float, default=0.005, help='seconds to wait for a batch to fill')
+    parser.add_argument('--max-pending', type=int, default=64, help='queued requests before answering 503')
+    args = parser.parse_args(argv)
+
+    scorer = Scorer(args.backend, args.workers, args.max_batch, args.batch_window, args.max_pending, args.threads)
+    server = serve(scorer, args.host, args.port)
+    print('PEAQ server on http://%s:%d (%s, %d workers)' % (server.server_address + (args.backend, args.workers)),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scorer.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
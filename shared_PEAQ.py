@@ -0,0 +1,204 @@
+import collections
+import contextlib
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import audio_PEAQ
+import export_PEAQ
+import numpy_PEAQ
+
+
+'''
+Shared memory for multi-process scoring.
+
+Workers of a process pool would each build (or load) their own PQEval tables and
+receive the audio of every pair pickled through a pipe. Here the parent puts the
+arrays into multiprocessing.shared_memory segments once and sends only a small
+handle (segment name, array layout, scalars); workers map the segment and use
+read-only numpy views of it, so their memory and the IPC per task don't grow
+with the signal length or the number of workers.
+
+    with pool(4) as workers:                        # workers use the shared tables
+        with share_pair('ref.wav', 'test.wav') as pair:
+            result = workers.apply(score, (pair.handle,))
+
+The process that creates a segment owns it: it is removed when the Shared object
+is closed (or leaves its with block), after the workers are done with it.
+'''
+
+AMAX = 32768
+# Segments attached by this process, by name (the views keep them alive)
+_attached = {}
+
+
+class Shared(object):
+    # arrays  - {name: array} copied into one new shared memory segment
+    # scalars - {name: value} sent along in the handle
+    def __init__(self, arrays, scalars=None):
+        layout = []
+        offset = 0
+        for name, x in arrays.items():
+            x = np.asarray(x)
+            layout.append((name, x.dtype.str, x.shape, offset))
+            # Arrays start at multiples of 64 bytes
+            offset += -(-x.nbytes // 64) * 64
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (name, dtype, shape, start), x in zip(layout, arrays.values()):
+            np.ndarray(shape, dtype, self.shm.buf, start)[...] = x
+        self.handle = (self.shm.name, tuple(layout), dict(scalars or {}))
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(handle):
+    # {name: read-only view} of the arrays of a handle plus its scalars; the segment stays
+    # mapped in this process until detach()
+    name, layout, scalars = handle
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    buf = _attached[name].buf
+    out = dict(scalars)
+    for key, dtype, shape, start in layout:
+        x = np.ndarray(shape, dtype, buf, start)
+        x.setflags(write=False)
+        out[key] = x
+    return out
+
+
+def detach(handle):
+    # Unmaps a segment attached by attach() once no views of it are left
+    shm = _attached.pop(handle[0], None)
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            # Views still referenced (e.g. by a traceback), unmapped when they are collected
+            pass
+
+
+def share_tables(Fs=48000, NF=2048):
+    # The PQEval tables (numpy_PEAQ.tables) in shared memory, computed or read from the
+    # cache once in this process
+    table = numpy_PEAQ.tables(Fs, NF)
+    arrays = dict((name, x) for name, x in table.items() if np.ndim(x))
+    scalars = dict((name, x) for name, x in table.items() if not np.ndim(x))
+    scalars['key'] = (int(Fs), int(NF))
+    return Shared(arrays, scalars)
+
+
+def use_tables(handle):
+    # Makes every PQEval of this process with the same Fs, NF use the shared tables
+    # (pool initializer)
+    table = attach(handle)
+    key = table.pop('key')
+    numpy_PEAQ._tables[key] = table
+
+
+@contextlib.contextmanager
+def pool(processes=None, Fs=48000, NF=2048, context='spawn'):
+    # Process pool whose workers use one shared copy of the tables
+    tables = share_tables(Fs, NF)
+    ctx = multiprocessing.get_context(context)
+    try:
+        with ctx.Pool(processes, initializer=use_tables, initargs=(tables.handle,)) as workers:
+            yield workers
+    finally:
+        tables.close()
+
+
+def share_pair(ref, test, Fs=48000):
+    # A (reference, test) pair in one segment: arrays on the 16-bit scale, or WAV paths
+    # decoded here (their rate replaces Fs)
+    if isinstance(ref, (str, os.PathLike)):
+        ref, Fs = audio_PEAQ.load(ref)
+    if isinstance(test, (str, os.PathLike)):
+        test, rate = audio_PEAQ.load(test)
+        if rate != Fs:
+            raise ValueError(f'reference at {Fs} Hz and test at {rate} Hz')
+    return Shared({'ref': ref, 'test': test}, {'Fs': int(Fs)})
+
+
+def _score(ref, test, Fs=48000):
+    peaq = numpy_PEAQ.PEAQ(AMAX)
+    peaq.process(ref, test, Fs=Fs)
+    peaq.avg_get()
+    return dict((name, float(getattr(peaq, name))) for name in export_PEAQ.AVG_MOVS)
+
+
+def score(handle):
+    # Pool task: averaged MOVs and ODG (export_PEAQ.AVG_MOVS) of the pair in a shared
+    # segment with arrays 'ref', 'test' and optionally the scalar 'Fs' (see share_pair;
+    # other rates than 48 kHz are resampled)
+    pair = attach(handle)
+    try:
+        return _score(pair['ref'], pair['test'], pair.get('Fs', 48000))
+    finally:
+        del pair
+        detach(handle)
+
+
+def score_pairs(pairs, processes=None, window=None):
+    # Scores (ref, test) pairs of 48 kHz arrays or WAV paths in a pool, each pair handed
+    # over in shared memory; returns the results in the order of the pairs. pairs can be
+    # any iterable: at most window pairs (default two per worker) are decoded and in
+    # shared memory at a time, each segment is closed when its result arrives.
+    window = window or 2 * (processes or os.cpu_count() or 1)
+    results = []
+    pending = collections.deque()
+    with pool(processes) as workers:
+        try:
+            for ref, test in pairs:
+                if len(pending) >= window:
+                    results.append(_result(*pending.popleft()))
+                segment = share_pair(ref, test)
+                pending.append((segment, workers.apply_async(score, (segment.handle,))))
+            while pending:
+                results.append(_result(*pending.popleft()))
+        finally:
+            for segment, _ in pending:
+                segment.close()
+    return results
+
+
+def _result(segment, task):
+    try:
+        return task.get()
+    finally:
+        segment.close()
+
+
+def tables_shared(Fs=48000, NF=2048):
+    # Whether the PQEval tables of this process are views of an attached segment
+    table = numpy_PEAQ._tables.get((int(Fs), int(NF)))
+    if table is None:
+        return False
+    for shm in _attached.values():
+        buf = np.frombuffer(shm.buf, np.uint8)
+        shared = np.shares_memory(table['U'], buf)
+        del buf
+        if shared:
+            return True
+    return False
+
+
+def private_mb():
+    # Memory of this process not shared with others (Linux), None elsewhere
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            kb = sum(int(line.split()[1]) for line in f if line.startswith(('Private_Clean', 'Private_Dirty')))
+        return kb / 1024.
+    except OSError:
+        return None
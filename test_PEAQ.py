@@ -1,7 +1,5 @@
-import torch
-import torchaudio
+import audio_PEAQ
 import numpy_PEAQ
-import torch_PEAQ
 
 
 def print_as_frame(metrics, i):
@@ -15,12 +13,8 @@ def print_as_frame(metrics, i):
 
 
 def load(name):
-    audio, rate = torchaudio.load(name, normalize=False)
-
-    if audio.dtype == torch.float32:
-        audio = audio * 32768.
-    audio = audio.squeeze().numpy()
-    return audio, rate
+    # numpy only WAV reader, the numpy version runs without importing torch
+    return audio_PEAQ.load(name)
 
 
 def main():
@@ -37,6 +31,7 @@ def main():
 
 
     # pytorch version
+    import torch_PEAQ
     torchpeaq = torch_PEAQ.PEAQ(32768, Fs=rate)
     torchpeaq.process(ref, test)
     metrics_as_frame = torchpeaq.get()
@@ -0,0 +1,61 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import align_PEAQ
+import numpy_PEAQ
+import parity_PEAQ
+
+
+def _delayed(x, d, n=None):
+    # x delayed by d samples (d < 0: advanced), zero padded / cut to n samples
+    n = x.shape[-1] if n is None else n
+    y = np.zeros(x.shape[:-1] + (n,))
+    if d >= 0:
+        m = min(n - d, x.shape[-1])
+        y[..., d:d + m] = x[..., :m]
+    else:
+        m = min(n, x.shape[-1] + d)
+        y[..., :m] = x[..., -d:-d + m]
+    return y
+
+
+@pytest.mark.parametrize('d', [0, 1, 37, -250, 4801, -12345])
+def test_delay_is_found(d):
+    rng = np.random.RandomState(0)
+    ref = parity_PEAQ.music(rng, parity_PEAQ.FS)
+    # Coding noise, a gain and a different length
+    test = 0.9 * _delayed(ref, d, len(ref) + 700) + 3e-3 * parity_PEAQ.AMAX * rng.standard_normal(len(ref) + 700)
+    assert align_PEAQ.delay(ref, test) == d
+
+
+def test_shift_is_views():
+    rng = np.random.RandomState(1)
+    ref = rng.standard_normal((2, 20000))
+    for d, n in [(300, 21000), (-300, 19000)]:
+        test = _delayed(ref, d, n)
+        r, t, delay = align_PEAQ.align(ref, test)
+        assert delay == d
+        assert r.shape == t.shape == (2, min(20000, n - d) - max(-d, 0))
+        assert np.shares_memory(r, ref) and np.shares_memory(t, test)
+        np.testing.assert_array_equal(r, t)
+
+    # Searched up to max_delay only
+    assert align_PEAQ.delay(ref, _delayed(ref, 3000), max_delay=0.01) != 3000
+
+
+def test_process_aligns():
+    ref, test = parity_PEAQ.signals(0.3)['clipped']
+    runs = []
+    for args, kwargs in [((ref, _delayed(test, 480, len(test) + 1000)), {'align': True}),
+                         ((ref, test), {})]:
+        peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(*args, **kwargs)
+            peaq.avg_get()
+        runs.append(peaq)
+    assert (runs[0].delay, runs[1].delay) == (480, None)
+    for attr in ('NMRavg', 'EHS', 'ODG'):
+        np.testing.assert_array_equal(getattr(runs[0], attr), getattr(runs[1], attr), err_msg=attr)
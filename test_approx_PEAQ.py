@@ -0,0 +1,44 @@
+import contextlib
+import io
+
+import numpy as np
+
+import approx_PEAQ
+import numpy_PEAQ
+import parity_PEAQ
+
+
+def test_blocks_are_stratified():
+    first = approx_PEAQ.starts(10000, 0.1, block=64, warmup=24)
+    # 64 + (K - 1) * 88 frames within the budget of 1000
+    assert len(first) == 11 and first[0] == 0
+    assert (np.diff(first) >= 64).all() and first[-1] <= 10000 - 64
+    # One block in each tenth of the frames after the first block
+    edges = np.linspace(64, 10000, 11).astype(int)
+    assert ((first[1:] >= edges[:-1]) & (first[1:] + 64 <= edges[1:])).all()
+    np.testing.assert_array_equal(approx_PEAQ.starts(10000, 0.1, seed=1)[0], 0)
+    assert (approx_PEAQ.starts(10000, 0.1, seed=1) != first).any()
+    # A budget covering the signal is not sampled
+    assert approx_PEAQ.starts(10000, 1.) is None
+    assert approx_PEAQ.starts(60, 0.1, block=64) is None
+    np.testing.assert_array_equal(approx_PEAQ.starts(200, 0.1, block=64, warmup=24), [0])
+
+
+def test_approximate():
+    ref, test = parity_PEAQ.signals(1.5)['clipped']
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    with contextlib.redirect_stdout(io.StringIO()):
+        peaq.process(ref, test)
+        peaq.avg_get()
+
+    exact = approx_PEAQ.approximate(ref, test, budget=1.)
+    assert exact['ODG'] == peaq.ODG and exact['ODG_ci'] == (peaq.ODG, peaq.ODG)
+    assert exact['fraction'] == 1 and exact['blocks'] == [0]
+
+    approx = approx_PEAQ.approximate(ref, test, budget=0.6, block=8, warmup=8, bootstrap=50)
+    assert len(approx['blocks']) == 3 and approx['fraction'] == (8 + 2 * 16) / exact['frames']
+    low, high = approx['ODG_ci']
+    assert low <= approx['ODG'] <= high
+    assert abs(approx['ODG'] - peaq.ODG) < 0.1
+    # Two blocks, no interval
+    assert np.isnan(approx_PEAQ.approximate(ref, test, budget=0.3, block=8, warmup=8)['ODG_ci']).all()
@@ -0,0 +1,74 @@
+import asyncio
+import time
+import wave
+
+import numpy as np
+import pytest
+
+import parity_PEAQ
+
+torch = pytest.importorskip('torch')
+import async_PEAQ  # noqa: E402
+import torch_PEAQ  # noqa: E402
+
+
+def _expected(ref, test):
+    out = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)(torch.from_numpy(ref), torch.from_numpy(test))
+    return float(out['ODG'])
+
+
+def test_score_and_stream(tmp_path):
+    cases = parity_PEAQ.signals(0.6)
+    path = str(tmp_path / 'ref.wav')
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(parity_PEAQ.FS)
+        w.writeframes(np.round(cases['tones'][0]).astype('<i2').tobytes())
+
+    async def pairs():
+        for name in ('tones', 'clipped', 'gated'):
+            yield cases[name]
+
+    async def main():
+        scorer = async_PEAQ.AsyncScorer(workers=2, max_pending=2, block=8)
+        ref = np.round(cases['tones'][0])
+        result = await scorer.score(path, cases['tones'][1])
+        assert result['ODG'] == pytest.approx(_expected(ref, cases['tones'][1]), abs=1e-12)
+        results = [r async for r in scorer.score_stream(pairs())]
+        assert scorer.queue_depth == 0
+        scorer.close()
+        return results
+
+    results = asyncio.run(main())
+    for name, result in zip(('tones', 'clipped', 'gated'), results):
+        assert result['ODG'] == pytest.approx(_expected(*cases[name]), abs=1e-12)
+
+
+def test_cancel_and_backpressure():
+    ref, test = parity_PEAQ.signals(20.)['tones']
+
+    async def main():
+        scorer = async_PEAQ.AsyncScorer(workers=1, max_pending=1, block=4)
+        start = time.perf_counter()
+        await scorer.score(ref[:48000], test[:48000])
+        one_second = time.perf_counter() - start
+
+        tasks = [asyncio.ensure_future(scorer.score(ref, test)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        # One admitted, two waiting for a slot
+        assert scorer.queue_depth == 3
+        start = time.perf_counter()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # The running computation stopped at a block boundary instead of finishing 20 s of audio
+        assert time.perf_counter() - start < 5 * one_second
+        assert scorer.counts['cancelled'] == 3
+        assert scorer.queue_depth == 0
+
+        result = await scorer.score(ref[:48000], test[:48000])
+        scorer.close()
+        return result
+
+    assert np.isfinite(asyncio.run(main())['ODG'])
@@ -0,0 +1,19 @@
+import io
+import wave
+
+import numpy as np
+
+import audio_PEAQ
+
+
+def test_wav_decode_matches_pcm():
+    x = (np.arange(-300, 300, dtype=np.int16) * 50).reshape(-1, 2)
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(x.tobytes())
+    audio, rate = audio_PEAQ.decode(buf.getvalue())
+    assert rate == 44100
+    np.testing.assert_array_equal(audio, x.T.astype(np.float64))
@@ -0,0 +1,120 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+import bench_PEAQ
+
+
+def test_synthetic_is_chunk_deterministic():
+    ref, test = bench_PEAQ.synthetic('music', 12.5, seed=3)
+    assert ref.shape == test.shape == (int(12.5 * bench_PEAQ.FS),)
+    # Full chunks don't depend on the total length
+    ref2, test2 = bench_PEAQ.synthetic('music', bench_PEAQ.CHUNK, seed=3)
+    np.testing.assert_array_equal(ref[:len(ref2)], ref2)
+    np.testing.assert_array_equal(test[:len(test2)], test2)
+
+
+def test_measure_reports_stages(tmp_path):
+    report = bench_PEAQ.run(['numpy'], ['sparse'], [0.1], [1], isolate=False, stream=None)
+    result, = report['results']
+    assert result['frames'] == 4
+    assert result['rtf'] > 0
+    assert result['stages']['DFT']['calls'] == 2 * result['frames']
+    assert result['stages']['NMR']['calls'] == 1
+    assert 'git_commit' in report['environment']
+
+    path = tmp_path / 'bench.json'
+    path.write_text(json.dumps(report))
+    assert json.loads(path.read_text())['results'][0]['backend'] == 'numpy'
+
+
+def test_startup_fills_table_cache(tmp_path):
+    cold, warm = bench_PEAQ.startup('numpy', 0.1, cache=str(tmp_path))
+    assert (cold['cache'], warm['cache']) == ('cold', 'warm')
+    assert len(list(tmp_path.glob('PQEval_*.npz'))) == 1
+    assert warm['setup_s'] < cold['setup_s']
+    assert warm['odg'] == cold['odg']
+    assert cold['wall_s'] > cold['import_s'] + cold['setup_s'] + cold['first_score_s']
+
+
+def test_scaling():
+    pytest.importorskip('torch')
+    report = bench_PEAQ.run_scaling(['chunked64'], ['music'], [0.2], [1, 2], threads=1, stream=None)
+    one, two = report['scaling']
+    assert (one['evaluators'], two['evaluators']) == (1, 2)
+    assert len(two['worker_s']) == 2 and two['threads'] == 1
+    assert one['speedup'] == 1
+    assert two['throughput'] == pytest.approx(0.4 / two['wall_s'])
+    # Different seeds, different pairs
+    assert two['odg'][0] == one['odg'][0] != two['odg'][1]
+
+
+def test_resampling():
+    report = bench_PEAQ.run_resampling(['numpy'], ['music'], [0.1], [44100], stream=None)
+    result, = report['resampling']
+    assert result['rate'] == 44100
+    assert 0 < result['resample_share'] < 1
+    assert result['resample_rtf'] == pytest.approx(result['resample_s'] / 0.1)
+    assert np.isfinite(result['odg'])
+
+
+def test_channels():
+    result, = bench_PEAQ.run_channels(['numpy_fast'], ['music'], [0.5], stream=None)['channels']
+    assert result['stereo_s'] > 0 and result['mono_s'] > 0
+    assert result['ratio'] == pytest.approx(result['stereo_s'] / result['mono_s'])
+    assert np.isfinite(result['odg'])
+
+
+def test_approximation():
+    result, = bench_PEAQ.run_approximation(['music'], [1.], [0.5], stream=None)['approximation']
+    # Shorter than one block: scored exactly
+    assert result['budget'] == 0.5 and result['blocks'] == 1 and result['fraction'] == 1
+    assert result['error'] == 0 and result['covered']
+
+
+def test_sharing():
+    pickled, shared = bench_PEAQ.run_sharing(['music'], [0.2], [2], stream=None)['sharing']
+    assert (pickled['mode'], shared['mode']) == ('pickle', 'shared')
+    assert shared['tables_shared'] and not pickled['tables_shared']
+    assert shared['task_bytes'] < 1000 < pickled['task_bytes']
+    assert shared['odg'] == pickled['odg']
+
+
+def test_live():
+    result, = bench_PEAQ.run_live(['numpy_fast'], ['music'], [0.5], [512], stream=None)['live']
+    assert result['frames'] == 23 and result['chunk'] == 512
+    assert 0 < result['p50_ms'] <= result['p99_ms'] <= result['p100_ms'] and result['rtf'] > 0
+
+
+def test_rescoring():
+    result, = bench_PEAQ.run_rescoring(['numpy_fast'], ['music'], [3.], [0.5], stream=None)['rescoring']
+    assert result['frames'] == 140 and 0 < result['span'][0] < result['span'][1] <= 140
+    assert result['odg'] == pytest.approx(result['full_odg'], rel=1e-9)
+
+
+def test_querying():
+    result, = bench_PEAQ.run_querying([20000], stream=None)['querying']
+    assert result['pairs'] == 3 and result['parts'] == 1
+    assert result['pair_time_rows'] > 0 and result['scan_ms'] > 0
+
+
+def test_compare():
+    base = {'environment': {}, 'live': [{'backend': 'numpy_fast', 'config': 'music', 'seconds': 10.,
+                                         'chunk': 512, 'p50_ms': 2., 'p99_ms': 4., 'rtf': 0.1}]}
+    new = {'environment': {}, 'live': [dict(base['live'][0], p50_ms=1., rtf=0.)]}
+    out = io.StringIO()
+    bench_PEAQ.compare(base, new, out)
+    header, row = out.getvalue().splitlines()
+    assert header.split() == ['backend', 'config', 'seconds', 'chunk', 'p50_ms', 'p99_ms', 'rtf']
+    assert row.split() == ['numpy_fast', 'music', '10', '512', '0.50x', '1.00x', '0.00x']
+
+    # Reports of the same kind only, every kind has its points and measurements
+    with pytest.raises(ValueError, match='live report with a rescoring'):
+        bench_PEAQ.compare(base, {'environment': {}, 'rescoring': []})
+    with pytest.raises(ValueError, match='not a bench_PEAQ report'):
+        bench_PEAQ.compare({'environment': {}}, base)
+    for name in ('results', 'scaling', 'startup', 'resampling', 'approximation', 'sharing', 'live', 'rescoring',
+                 'querying', 'channels'):
+        assert name in bench_PEAQ.COMPARED
@@ -0,0 +1,167 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import export_PEAQ
+import numpy_PEAQ
+import parity_PEAQ
+
+
+def _result(rng, frames):
+    out = dict((name, rng.rand(frames) * 100) for name in export_PEAQ.FRAME_MOVS)
+    out.update((name, rng.rand()) for name in export_PEAQ.AVG_MOVS)
+    return out
+
+
+def test_write_and_read_back(tmp_path):
+    ref, test = parity_PEAQ.signals(0.2)['clipped']
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    with contextlib.redirect_stdout(io.StringIO()):
+        peaq.process(ref, test)
+        peaq.avg_get()
+
+    rng = np.random.RandomState(0)
+    results = [('fake%d' % i, _result(rng, 3 + i)) for i in range(5)]
+    # Two writers appending to the same directory, as parallel workers would
+    a = export_PEAQ.Writer(str(tmp_path), dtype=np.float64, batch=2)
+    b = export_PEAQ.Writer(str(tmp_path), dtype=np.float64)
+    a.add('clipped', peaq)
+    for i, (name, result) in enumerate(results):
+        (a if i % 2 else b).add(name, result)
+    a.close()
+    b.close()
+    assert a.parts == 2 and b.parts == 1
+
+    reader = export_PEAQ.Reader(str(tmp_path))
+    pairs = reader.pairs()
+    assert sorted(pairs['pair']) == sorted(['clipped'] + [name for name, _ in results])
+    i = list(pairs['pair']).index('clipped')
+    assert pairs['frames'][i] == peaq.Np
+    assert pairs['ODG'][i] == peaq.ODG
+    np.testing.assert_array_equal(reader.pair_frames('clipped')['NMRmax'], peaq.NMRmax)
+    assert isinstance(reader.pair_frames('fake3')['EHS'], np.memmap)
+    np.testing.assert_array_equal(reader.pair_frames('fake3')['PD_q'], results[3][1]['PD_q'])
+
+    # Frame table rows point into the pair table
+    frames = reader.frames(['pair', 'frame', 'BWRef'])
+    assert len(frames['pair']) == pairs['frames'].sum()
+    rows = frames['pair'] == list(pairs['pair']).index('fake4')
+    np.testing.assert_array_equal(frames['frame'][rows], np.arange(7))
+    np.testing.assert_array_equal(frames['BWRef'][rows], results[4][1]['BWRef'])
+    with pytest.raises(KeyError):
+        reader.pair_frames('missing')
+
+
+def test_downcast_and_compress(tmp_path):
+    rng = np.random.RandomState(1)
+    result = _result(rng, 1000)
+    for compress in (False, True):
+        path = str(tmp_path / str(compress))
+        with export_PEAQ.Writer(path, dtype=np.float16, compress=compress) as w:
+            w.add('x', result)
+        frames = export_PEAQ.Reader(path).pair_frames('x')
+        assert frames['NLoud_NL'].dtype == np.float16
+        np.testing.assert_allclose(frames['NLoud_NL'], result['NLoud_NL'], rtol=1e-3)
+        assert export_PEAQ.Reader(path).pairs()['ODG'][0] == result['ODG']
+    assert len(list((tmp_path / 'True').glob('part-*.npz'))) == 1
+
+    # Batched outputs, one pair per item
+    batch = dict((name, np.stack([result[name], 2 * np.asarray(result[name])])) for name in result)
+    with export_PEAQ.Writer(str(tmp_path / 'batch')) as w:
+        w.add_batch(['a', 'b'], batch)
+    reader = export_PEAQ.Reader(str(tmp_path / 'batch'))
+    np.testing.assert_allclose(reader.pair_frames('b')['EHS'], 2 * result['EHS'], rtol=1e-6)
+    np.testing.assert_array_equal(reader.pairs()['ODG'], [result['ODG'], 2 * result['ODG']])
+
+    with pytest.raises(ValueError):
+        export_PEAQ.Writer(str(tmp_path), dtype=np.int16)
+    with pytest.raises(ValueError):
+        export_PEAQ.Writer(str(tmp_path)).add('bad', dict(result, EHS=np.zeros(3)))
+    # Per-frame MOVs of a multichannel pair, (channels, frames)
+    stereo = dict((name, np.stack([x, x]) if name in export_PEAQ.FRAME_MOVS else x) for name, x in result.items())
+    with pytest.raises(ValueError, match=r'shape \(2, 1000\), only mono pairs'):
+        export_PEAQ.Writer(str(tmp_path)).add('stereo', stereo)
+
+
+def _brute(reader, where, pairs=None, time=None):
+    frames = reader.frames()
+    names = reader.pairs(['pair'])['pair']
+    keep = np.ones(len(frames['pair']), dtype=bool)
+    for name, (low, high) in where.items():
+        keep &= (frames[name] >= (-np.inf if low is None else low)) & (frames[name] <= (np.inf if high is None else high))
+    if pairs is not None:
+        keep &= np.isin(names[frames['pair']], pairs)
+    if time is not None:
+        t = frames['frame'] * export_PEAQ.FRAME_SECONDS
+        keep &= (t >= time[0]) & (t <= time[1])
+    return frames['pair'][keep], frames['frame'][keep]
+
+
+def test_query(tmp_path):
+    rng = np.random.RandomState(2)
+    results = []
+    for i in range(12):
+        result = _result(rng, rng.randint(1, 3 * export_PEAQ.CHUNK))
+        # Slowly varying, the min/max of a chunk excludes most values
+        result['MDiff_Wt'] = 50 + 50 * np.sin(np.arange(len(result['EHS'])) / 2000. + i)
+        results.append(('p%d' % i, result))
+    for compress in (False, True):
+        path = str(tmp_path / str(compress))
+        a = export_PEAQ.Writer(path, compress=compress, batch=5)
+        b = export_PEAQ.Writer(path, compress=compress, batch=3)
+        for i, (name, result) in enumerate(results):
+            (a if i % 3 else b).add(name, result)
+        a.close()
+        b.close()
+        reader = export_PEAQ.Reader(path)
+
+        for where, pairs, time in [({'NMRmax': (90, None)}, None, None),
+                                   ({'NMRmax': (None, 5.), 'PD_p': (20, 60)}, None, None),
+                                   ({'MDiff_Wt': (99.5, 100)}, None, None),
+                                   ({'MDiff_Wt': (99.5, 100), 'EHS': (50, None)}, None, None),
+                                   ({'EHS': (10, 20)}, ['p3', 'p7', 'missing'], None),
+                                   ({'NLoud_NL': (1, 99)}, None, (20., 30.)),
+                                   ({}, ['p5'], (0, 1.))]:
+            found = reader.query(where, pairs, time, columns=['BWRef'])
+            pair, frame = _brute(reader, where, pairs, time)
+            np.testing.assert_array_equal(found['pair'], pair)
+            np.testing.assert_array_equal(found['frame'], frame)
+            np.testing.assert_array_equal(found['time'], frame * export_PEAQ.FRAME_SECONDS)
+            names = reader.pairs(['pair'])['pair']
+            for p, f, x in zip(found['pair'][:20], found['frame'][:20], found['BWRef'][:20]):
+                assert x == np.float32(dict(results)[names[p]]['BWRef'][f])
+        assert reader.query({'EHS': (200, None)})['EHS'].shape == (0,)
+
+
+def test_query_unindexed_parts_and_compact(tmp_path):
+    rng = np.random.RandomState(3)
+    results = [('p%d' % i, _result(rng, 100 + 50 * i)) for i in range(6)]
+    path = str(tmp_path)
+    with export_PEAQ.Writer(path, batch=2) as w:
+        for name, result in results:
+            w.add(name, result)
+    # Parts of an earlier version had no indexes
+    old = tmp_path / export_PEAQ.Reader(path).names[0]
+    for column in old.glob('*.npy'):
+        if column.name.split('.')[0] in ('index', 'sorted', 'chunks'):
+            column.unlink()
+    # A pair scored twice
+    with export_PEAQ.Writer(path) as w:
+        w.add('p1', results[1][1])
+    where = {'NMRavg': (10, 30), 'PD_q': (None, 50)}
+    before = _brute(export_PEAQ.Reader(path), where)
+    found = export_PEAQ.Reader(path).query(where)
+    np.testing.assert_array_equal(found['frame'], before[1])
+
+    assert export_PEAQ.compact(path, frames=400) == 3
+    reader = export_PEAQ.Reader(path)
+    assert len(reader) == 3 and 'index.NMRavg' in reader.part(0)
+    pairs = reader.pairs()
+    assert sorted(pairs['pair']) == [name for name, _ in results]
+    np.testing.assert_array_equal(pairs['frames'].sum(), sum(100 + 50 * i for i in range(6)))
+    np.testing.assert_array_equal(reader.pair_frames('p4')['EHS'], results[4][1]['EHS'].astype(np.float32))
+    found = reader.query(where)
+    np.testing.assert_array_equal(found['frame'], _brute(reader, where)[1])
+    assert len(found['frame']) < len(before[1])
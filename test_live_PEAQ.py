@@ -0,0 +1,80 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import approx_PEAQ
+import export_PEAQ
+import live_PEAQ
+import numpy_PEAQ
+import parity_PEAQ
+
+
+def _exact(ref, test, fast_math, Fs=None):
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX, fast_math=fast_math)
+    with contextlib.redirect_stdout(io.StringIO()):
+        peaq.process(ref, test, Fs=Fs)
+        peaq.avg_get()
+    return peaq
+
+
+@pytest.mark.parametrize('fast_math', [False, True])
+def test_monitor_matches_process(fast_math):
+    # Chunks of random sizes, the last hop incomplete
+    ref, test = parity_PEAQ.signals(1.)['gated']
+    ref, test = ref[:-300], test[:-300]
+    peaq = _exact(ref, test, fast_math)
+    monitor = live_PEAQ.Monitor(fast_math=fast_math)
+    frames = []
+    rng = np.random.RandomState(0)
+    start = 0
+    while start < len(ref):
+        n = rng.randint(1, 3000)
+        frames += monitor.push(ref[start:start + n], test[start:start + n])
+        start += n
+    frames += monitor.flush()
+
+    assert [frame['frame'] for frame in frames] == list(range(peaq.Np))
+    for name in export_PEAQ.FRAME_MOVS:
+        np.testing.assert_allclose([frame[name] for frame in frames], getattr(peaq, name), rtol=1e-12, err_msg=name)
+    averages = monitor.averages()
+    for name in export_PEAQ.AVG_MOVS:
+        assert averages[name] == pytest.approx(float(getattr(peaq, name)), rel=1e-9, nan_ok=True), name
+    assert frames[-1]['ODG'] == averages['ODG']
+
+    stats = monitor.stats()
+    assert stats['frames'] == peaq.Np and stats['rtf'] > 0
+    assert stats['p50_ms'] <= stats['p99_ms'] <= stats['p100_ms']
+    assert monitor.flush() == []
+    with pytest.raises(ValueError):
+        monitor.push(ref[:10], test[:10])
+    # (channels, n) chunks are not flattened into one signal
+    with pytest.raises(ValueError, match='mono chunks'):
+        live_PEAQ.Monitor(parity_PEAQ.AMAX).push(np.zeros((2, 512)), np.zeros((2, 512)))
+
+
+def test_running_odg_is_progressive():
+    # The running values after k frames are those of avg_get on the first k frames
+    ref, test = parity_PEAQ.signals(1.)['clipped']
+    peaq = _exact(ref, test, True)
+    monitor = live_PEAQ.Monitor()
+    frames = []
+    for start in range(0, len(ref), 1024):
+        frames += monitor.push(ref[start:start + 1024], test[start:start + 1024])
+    for k in (1, 10, 27, 40):
+        first = dict((name, getattr(peaq, name)[:k]) for name in export_PEAQ.FRAME_MOVS)
+        with np.errstate(all='ignore'):
+            expected = approx_PEAQ.average(first)
+        for name in export_PEAQ.AVG_MOVS:
+            assert frames[k - 1][name] == pytest.approx(expected[name], rel=1e-9, nan_ok=True), (k, name)
+
+
+def test_monitor_resamples():
+    ref, test = parity_PEAQ.signals(0.5)['clipped']
+    ref, test = ref[::2], test[::2]
+    monitor = live_PEAQ.Monitor(Fs=24000)
+    for start in range(0, len(ref), 700):
+        monitor.push(ref[start:start + 700], test[start:start + 700])
+    monitor.flush()
+    assert monitor.averages()['ODG'] == pytest.approx(_exact(ref, test, True, Fs=24000).ODG, rel=1e-9)
@@ -0,0 +1,250 @@
+import contextlib
+import io
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import numpy_PEAQ
+import parity_PEAQ
+
+
+def _run(ref, test, **kwargs):
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        peaq.process(ref, test)
+        peaq.avg_get()
+    return peaq
+
+
+def test_multichannel():
+    cases = parity_PEAQ.signals(0.75)
+    ref = np.stack([cases['clipped'][0], cases['gated'][0]])
+    test = np.stack([cases['clipped'][1], cases['gated'][1]])
+    stereo = _run(ref, test)
+    left, right = _run(ref[0], test[0]), _run(ref[1], test[1])
+
+    # The channels go through the frame loop together, per channel as in mono
+    for name in ('loud_NRef', 'loud_NTest', 'MDiff_Mt1B', 'MDiff_Mt2B', 'MDiff_Wt', 'NLoud_NL',
+                 'BWRef', 'BWTest', 'NMRavg', 'NMRmax', 'EHS', 'EhsR', 'EhsT', 'EbNMat'):
+        x = getattr(stereo, name)
+        assert x.shape == (2,) + getattr(left, name).shape, name
+        np.testing.assert_allclose(x, [getattr(left, name), getattr(right, name)], rtol=1e-12, err_msg=name)
+    # p and q are the maxima over the channels per band, then combined over the bands
+    bands = [left.PQE.PQmovPD(peaq.EhsR, peaq.EhsT) for peaq in (left, right)]
+    p, q = np.maximum(bands[0][0], bands[1][0]), np.maximum(bands[0][1], bands[1][1])
+    Pc, Qc = 1 - np.prod(1 - p, -1), np.sum(q, -1)
+    np.testing.assert_allclose(stereo.PD_p, [Pc, Pc], rtol=1e-12)
+    np.testing.assert_allclose(stereo.PD_q, [Qc, Qc], rtol=1e-12)
+    assert not np.allclose(np.maximum(left.PD_q, right.PD_q), Qc)
+    assert (stereo.ADBB, stereo.MFPDB) == pytest.approx(stereo.PQ_avgPD(Pc, Qc), abs=1e-12)
+
+    # The other MOVs are averaged over the channels, after the earliest loudness delay
+    for name in ('avgBWRef', 'totalNMRB', 'WinModDiff1B', 'AvgModDiff1B', 'EHSB', 'relDistFramesB'):
+        assert getattr(stereo, name) == pytest.approx((getattr(left, name) + getattr(right, name)) / 2, rel=1e-12)
+    Nloud = min(left.PQloudTest(left.loud_NRef, left.loud_NTest), right.PQloudTest(right.loud_NRef, right.loud_NTest))
+    Ndel = max(Nloud + 3, 24)
+    rms = [np.sqrt(np.mean(peaq.NLoud_NL[Ndel:] ** 2)) for peaq in (left, right)]
+    assert stereo.RmsNoiseLoudB == pytest.approx(np.mean(rms), rel=1e-12)
+
+    # Identical channels score like mono
+    dual = _run(np.stack([ref[0], ref[0]]), np.stack([test[0], test[0]]))
+    assert dual.ODG == pytest.approx(left.ODG, abs=1e-12)
+    with pytest.raises(ValueError):
+        _run(ref, test[0])
+
+
+def test_full_scale_and_verbose(capsys):
+    # A full-scale sample (-32768 of 16-bit PCM) is the peak level Amax
+    ref, test = parity_PEAQ.signals(0.3)['clipped']
+    ref = ref.copy()
+    ref[100] = -parity_PEAQ.AMAX
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    peaq.process(ref, test)
+    peaq.avg_get()
+    assert np.isfinite(peaq.ODG)
+    assert capsys.readouterr().out == ''
+
+    peaq.process(ref * 0.5, test, verbose=True)
+    out = capsys.readouterr().out
+    assert 'Signals scaled' in out and 'Processing Audio' in out
+
+
+def test_silent_frame_skipping_is_exact():
+    ref, test = parity_PEAQ.signals(0.3)['gated']
+    runs = []
+    for skip in (False, True):
+        peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX, skip_silent=skip)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(ref, test)
+            peaq.avg_get()
+        runs.append(peaq)
+    silent, quiet = runs[1].PQ_frameClasses(ref, test)
+    assert silent.any() and quiet.any()
+    for attr in ('EbNMat', 'EhsR', 'EhsT', 'MDiff_Mt1B', 'NLoud_NL', 'BWRef', 'BWTest', 'PD_p', 'EHS', 'NMRavg', 'ODG'):
+        np.testing.assert_array_equal(getattr(runs[1], attr), getattr(runs[0], attr), err_msg=attr)
+
+
+def test_bandwidth_all_frames_matches_per_frame():
+    X2R = np.random.RandomState(3).rand(50, 1025)
+    X2T = np.random.RandomState(4).rand(50, 1025)
+    X2R[:, 600:] *= 1e-3
+    X2T[:, 400:] *= 1e-4
+    # No reference bin above the threshold: BWRef = 1 and an empty test range
+    X2R[7, :921] = 0
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    BWRef, BWTest = peaq.computeBW(X2R, X2T)
+    assert (BWRef[7], BWTest[7]) == (1, 1)
+    for i in range(len(X2R)):
+        assert (BWRef[i], BWTest[i]) == peaq.computeBW(X2R[i], X2T[i])
+
+
+def test_nmr_all_frames():
+    rng = np.random.RandomState(5)
+    EbN, Ehs = rng.rand(20, 109), rng.rand(20, 109) + 0.1
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    peaq.PQE = numpy_PEAQ.PQEval(parity_PEAQ.AMAX)
+    NMRavg, NMRmax = peaq.computeNMR(EbN, Ehs)
+    # Masking offset: 3 dB up to 12 Bark (band 48), then 0.25 dB per Bark
+    mdB = np.array([3. if k <= 48 else 0.25 * k / 4 for k in range(109)])
+    NMR = EbN * 10 ** (mdB / 10) / Ehs
+    np.testing.assert_allclose(NMRavg, NMR.mean(-1), rtol=1e-12)
+    np.testing.assert_allclose(NMRmax, NMR.max(-1), rtol=1e-12)
+    assert peaq.PQmovNMRB(EbN[3], Ehs[3])['NMRavg'] == pytest.approx(NMRavg[3], rel=1e-12)
+
+
+def test_mov_blocks_match_single_frames():
+    ref, test = parity_PEAQ.signals(0.3)['clipped']
+    runs = []
+    for block in (1, 4, 256):
+        peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX, block=block)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(ref, test)
+        runs.append(peaq)
+    for peaq in runs[1:]:
+        for attr in ('loud_NRef', 'loud_NTest', 'MDiff_Mt1B', 'MDiff_Mt2B', 'MDiff_Wt', 'NLoud_NL', 'PD_p', 'PD_q'):
+            np.testing.assert_allclose(getattr(peaq, attr), getattr(runs[0], attr), rtol=1e-12, err_msg=attr)
+
+
+def test_frame_loop_allocates_no_arrays(monkeypatch):
+    # At every reference DFT, i.e. once per pass of the frame loop: the array data (numpy's
+    # tracemalloc domain, not Python objects, whose freelists keep the trace of their first
+    # allocation) allocated on lines of numpy_PEAQ.py and still held, and the peak of all
+    # traced memory since the previous frame, which catches temporaries freed within the
+    # frame. Tracing starts at the first frame; the filters keep the test's bookkeeping and
+    # other threads out of the held memory.
+    ref, test = parity_PEAQ.signals(0.5)['clipped']
+    dft = numpy_PEAQ.PQEval.PQDFTFrame
+    only = [tracemalloc.Filter(True, numpy_PEAQ.__file__), tracemalloc.DomainFilter(False, 0)]
+    calls = np.zeros(1, dtype=np.int64)
+    start = np.zeros(1, dtype=np.int64)
+    held = np.zeros(100, dtype=np.int64)
+    transient = np.zeros(100, dtype=np.int64)
+
+    def PQDFTFrame(self, x, out=None):
+        if calls[0] == 0:
+            tracemalloc.start()
+        if calls[0] % 2 == 0:
+            transient[calls[0] // 2] = tracemalloc.get_traced_memory()[1] - start[0]
+            held[calls[0] // 2] = sum(trace.size for trace in tracemalloc.take_snapshot().filter_traces(only).traces)
+            start[0] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        calls[0] += 1
+        return dft(self, x, out)
+
+    monkeypatch.setattr(numpy_PEAQ.PQEval, 'PQDFTFrame', PQDFTFrame)
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(ref, test)
+    finally:
+        tracemalloc.stop()
+    assert (peaq.EHS > 0).all()
+
+    # After the first frame (workspace set up on first use) nothing is kept, in any frame
+    current = np.diff(held[1:calls[0] // 2])
+    assert len(current) > 10
+    assert (current == 0).all(), current
+    # Nor allocated for a while: a frame's Python objects (views, ufunc arguments, the
+    # np.fft wrapper) take about 1.6 kB, a band pattern is 872 B, a spectrum 8200 B. The
+    # window of the last frame is padded.
+    peak = transient[2:calls[0] // 2 - 1]
+    assert len(peak) > 10
+    assert (peak < 2048).all(), peak
+
+
+def test_fast_math_kernels():
+    x = np.exp(np.random.RandomState(6).uniform(-30, 30, 10000))
+    for p in (0.23, 0.3, 1.71332):
+        np.testing.assert_allclose(numpy_PEAQ._pow32(x, p), x ** p, rtol=numpy_PEAQ.FAST_MATH_RTOL)
+    exact = numpy_PEAQ.PQEval(parity_PEAQ.AMAX)
+    fast = numpy_PEAQ.PQEval(parity_PEAQ.AMAX, fast_math=True)
+    E = np.random.RandomState(7).rand(2, 109) * 10 ** np.linspace(0, 8, 109)
+    Es = np.stack([exact.PQ_SpreadCB(e, exact.Bs) for e in E])
+    np.testing.assert_allclose(fast.PQ_SpreadCBfast(E), Es, rtol=numpy_PEAQ.FAST_MATH_RTOL)
+
+
+def test_fast_math_odg():
+    for name in ('clipped', 'gated'):
+        ref, test = parity_PEAQ.signals(0.5)[name]
+        runs = []
+        for fast_math in (False, True):
+            peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX, fast_math=fast_math)
+            with contextlib.redirect_stdout(io.StringIO()):
+                peaq.process(ref, test)
+                peaq.avg_get()
+            runs.append(peaq)
+        assert runs[1].PQE.fast_math
+        for attr in ('loud_NRef', 'MDiff_Mt1B', 'NLoud_NL', 'PD_q'):
+            np.testing.assert_allclose(getattr(runs[1], attr), getattr(runs[0], attr), rtol=1e-3, atol=1e-6, err_msg=attr)
+        np.testing.assert_allclose(runs[1].PD_p, runs[0].PD_p, rtol=5e-3, err_msg='PD_p')
+        assert abs(runs[1].ODG - runs[0].ODG) < numpy_PEAQ.FAST_MATH_ODG_TOL
+
+    # A barely audible difference: most frames have detection probabilities below 1e-6, which
+    # the combination over the bands (1 - prod(1 - p)) keeps
+    ref, _ = parity_PEAQ.signals(0.5)['clipped']
+    test = ref + 1e-4 * parity_PEAQ.AMAX * np.random.RandomState(8).standard_normal(len(ref))
+    PD_p = []
+    for fast_math in (False, True):
+        peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX, fast_math=fast_math)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(ref, test)
+        PD_p.append(peaq.PD_p)
+    assert (PD_p[0] < 1e-6).mean() > 0.5 and (PD_p[0] > 0).all()
+    np.testing.assert_allclose(PD_p[1], PD_p[0], rtol=5e-3, err_msg='PD_p')
+
+
+def test_cached_tables(tmp_path, monkeypatch):
+    monkeypatch.setenv('PEAQ_CACHE', str(tmp_path))
+    monkeypatch.setattr(numpy_PEAQ, '_tables', {})
+    computed = numpy_PEAQ.PQEval(parity_PEAQ.AMAX, cache=False)
+    built = []
+    PQtables = numpy_PEAQ.PQEval.PQtables
+
+    def counted(self):
+        built.append(self)
+        return PQtables(self)
+
+    monkeypatch.setattr(numpy_PEAQ.PQEval, 'PQtables', counted)
+    first = numpy_PEAQ.PQEval(parity_PEAQ.AMAX)
+    path, = tmp_path.glob('PQEval_*.npz')
+    # Computed once on a miss
+    assert len(built) == 1
+
+    # A new process reads the file
+    monkeypatch.setattr(numpy_PEAQ, '_tables', {})
+    loaded = numpy_PEAQ.PQEval(parity_PEAQ.AMAX)
+    for name in numpy_PEAQ.TABLES:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(computed, name), err_msg=name)
+        assert type(getattr(loaded, name)) is type(getattr(computed, name)), name
+    assert not loaded.U.flags.writeable
+    # Same process: the tables are shared, the level dependent window is not
+    assert numpy_PEAQ.PQEval(1).U is loaded.U
+    np.testing.assert_allclose(numpy_PEAQ.PQEval(1).hw, parity_PEAQ.AMAX * first.hw)
+
+    # A damaged file is computed again and replaced
+    path.write_bytes(b'garbage')
+    monkeypatch.setattr(numpy_PEAQ, '_tables', {})
+    np.testing.assert_array_equal(numpy_PEAQ.PQEval(parity_PEAQ.AMAX).U, computed.U)
+    with np.load(path) as f:
+        np.testing.assert_array_equal(f['U'], computed.U)
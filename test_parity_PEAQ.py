@@ -0,0 +1,65 @@
+import io
+import time
+
+import numpy as np
+import pytest
+
+import parity_PEAQ
+
+
+def _stages(value):
+    return dict((stage, [(attr, np.full(4, value)) for attr in attrs]) for stage, attrs in parity_PEAQ.STAGES
+                if stage not in parity_PEAQ.OPTIONAL_STAGES)
+
+
+def test_compare_reports_first_divergence():
+    tolerances = parity_PEAQ.TOLERANCES['float64']
+    ref = _stages(1.)
+    test = _stages(1.)
+    assert parity_PEAQ.first_divergence(parity_PEAQ.compare(ref, test, tolerances)) is None
+
+    test['NL'] = [('NLoud_NL', np.array([1., 1., 1.001, 1.]))]
+    test['EHS'] = [('EHS', np.array([1., 2., 1., 1.]))]
+    stage, attr, err = parity_PEAQ.first_divergence(parity_PEAQ.compare(ref, test, tolerances))
+    assert (stage, attr) == ('NL', 'NLoud_NL')
+    assert err == pytest.approx(1e-3)
+
+    # NaN in both (EHS of an all-silent signal) is a match, NaN in one or a missing MOV is not
+    ref['EHSB'] = test['EHSB'] = [('EHSB', np.array(np.nan))]
+    test['WinModDiff1B'] = [('WinModDiff1B', np.array(np.nan))]
+    ref['RmsNoiseLoudB'] = [('RmsNoiseLoudB', np.array(np.nan))]
+    del test['ODG']
+    rows = dict((row[0], row[2:]) for row in parity_PEAQ.compare(ref, test, tolerances))
+    assert rows['EHSB'] == (0., True)
+    assert rows['WinModDiff1B'] == rows['RmsNoiseLoudB'] == rows['ODG'] == (np.inf, False)
+
+
+def test_signals_are_deterministic():
+    a = parity_PEAQ.signals(0.1)
+    b = parity_PEAQ.signals(0.1)
+    assert sorted(a) == ['bandlimited', 'clipped', 'gated', 'tones']
+    for name in a:
+        np.testing.assert_array_equal(a[name][0], b[name][0])
+        np.testing.assert_array_equal(a[name][1], b[name][1])
+
+
+def test_torch_matches_numpy():
+    pytest.importorskip('torch')
+    pytest.importorskip('tqdm')
+    # Long enough for every averaged MOV (Ndel = 24 frames, then the 4-frame window)
+    ref, test = parity_PEAQ.signals(0.75)['gated']
+    cases = {'gated': (ref, test, parity_PEAQ.FS)}
+    reference = parity_PEAQ.collect(parity_PEAQ._quiet(parity_PEAQ._run_numpy, ref, test, parity_PEAQ.FS))
+    for mov in ('WinModDiff1B', 'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB'):
+        (_, x), = reference[mov]
+        assert np.isfinite(x) and x != 0, mov
+    out = io.StringIO()
+    assert parity_PEAQ.check(cases, ['numpy', 'torch64', 'torch32'], stream=out), out.getvalue()
+
+
+def test_default_run_within_budget(capsys):
+    # The default run is the gate for changes, it has to stay fast enough to be run
+    start = time.time()
+    assert parity_PEAQ.main([]) == 0, capsys.readouterr().out
+    elapsed = time.time() - start
+    assert elapsed < parity_PEAQ.BUDGET, capsys.readouterr().out
@@ -0,0 +1,123 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import wave
+
+import numpy as np
+
+import export_PEAQ
+import parity_PEAQ
+import queue_PEAQ
+
+
+def _wav(path, x):
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(parity_PEAQ.FS)
+        w.writeframes(np.round(np.clip(x, -32768, 32767)).astype('<i2').tobytes())
+    return str(path)
+
+
+def _corpus(tmp_path, n):
+    pairs = []
+    for i, (name, (ref, test)) in enumerate(sorted(parity_PEAQ.signals(0.3).items())[:n]):
+        pairs.append((_wav(tmp_path / ('%s_ref.wav' % name), ref), _wav(tmp_path / ('%s_test.wav' % name), test)))
+    return pairs
+
+
+def test_nodes_share_the_queue(tmp_path):
+    pairs = _corpus(tmp_path, 4)
+    path = str(tmp_path / 'queue')
+    assert queue_PEAQ.submit(path, pairs) == ['00000000', '00000001', '00000002', '00000003']
+    assert queue_PEAQ.status(path)['pending'] == 4
+
+    # Three node processes on this box
+    cmd = [sys.executable, queue_PEAQ.__file__, 'work', path, '--fast-math', '--frames']
+    nodes = [subprocess.Popen(cmd + ['--node', 'node%d' % i], cwd=os.path.dirname(queue_PEAQ.__file__),
+                              stderr=subprocess.DEVNULL) for i in range(3)]
+    assert [node.wait(120) for node in nodes] == [0, 0, 0]
+    assert queue_PEAQ.status(path) == {'jobs': 4, 'done': 4, 'running': 0, 'abandoned': 0, 'pending': 0}
+
+    rows = queue_PEAQ.merge(path)
+    assert [row['id'] for row in rows] == ['00000000', '00000001', '00000002', '00000003']
+    assert os.path.exists(os.path.join(path, 'results.csv'))
+    store = export_PEAQ.Reader(os.path.join(path, 'frames'))
+    # One part per job, compacted into one
+    assert len(store) == 1
+    for (ref, test), row in zip(pairs, rows):
+        assert row['test'] == os.path.abspath(test) and row['node'].startswith('node')
+        result = queue_PEAQ._score(ref, test, fast_math=True, frames=True)
+        assert row['ODG'] == result['ODG']
+        np.testing.assert_array_equal(store.pair_frames(row['id'])['NMRmax'], result['NMRmax'].astype(np.float32))
+    found = store.query({'NMRmax': (10 ** 0.15, None)}, pairs=['00000001'])
+    assert len(found['frame']) == np.sum(store.pair_frames('00000001')['NMRmax'] >= np.float32(10 ** 0.15))
+    # Each job scored once
+    shards = os.listdir(os.path.join(path, 'results'))
+    assert sum(len(open(os.path.join(path, 'results', s)).readlines()) for s in shards) == 4
+
+
+def test_abandoned_jobs_are_recovered(tmp_path):
+    pairs = _corpus(tmp_path, 3)
+    path = str(tmp_path / 'queue')
+    queue_PEAQ.submit(path, pairs)
+    locks = os.path.join(path, 'locks')
+    # A node of this host that is gone
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    with open(os.path.join(locks, '00000000.lock'), 'w') as f:
+        json.dump({'node': 'crashed', 'host': socket.gethostname(), 'pid': dead.pid}, f)
+    # A node of another host whose heartbeat stopped
+    with open(os.path.join(locks, '00000001.lock'), 'w') as f:
+        json.dump({'node': 'silent', 'host': 'elsewhere', 'pid': 1}, f)
+    os.utime(os.path.join(locks, '00000001.lock'), (time.time() - 120, time.time() - 120))
+    # A live node of another host
+    with open(os.path.join(locks, '00000002.lock'), 'w') as f:
+        json.dump({'node': 'busy', 'host': 'elsewhere', 'pid': 1}, f)
+    assert queue_PEAQ.status(path) == {'jobs': 3, 'done': 0, 'running': 1, 'abandoned': 2, 'pending': 0}
+
+    assert queue_PEAQ.work(path, 'rescuer', timeout=60., fast_math=True, max_jobs=2) == 2
+    assert queue_PEAQ.status(path)['done'] == 2
+    assert not queue_PEAQ.Lock(path, '00000002', 'rescuer').acquire()
+
+    # The busy node finishes too, and a crashed node had already written a duplicate
+    assert queue_PEAQ.work(path, 'late', timeout=0.5, poll=0.1, fast_math=True) == 1
+    with open(os.path.join(path, 'results', 'rescuer.jsonl')) as f:
+        duplicate = f.readline()
+    with open(os.path.join(path, 'results', 'crashed.jsonl'), 'w') as f:
+        f.write(duplicate + '{"id": "0000')
+    rows = queue_PEAQ.merge(path)
+    assert [row['id'] for row in rows] == ['00000000', '00000001', '00000002']
+    assert [row['node'] for row in rows] == ['rescuer', 'rescuer', 'late']
+    assert os.listdir(locks) == []
+
+
+def test_failed_jobs_are_recorded(tmp_path):
+    path = str(tmp_path / 'queue')
+    missing = str(tmp_path / 'missing.wav')
+    queue_PEAQ.submit(path, [(missing, missing)])
+    assert queue_PEAQ.work(path, 'node') == 1
+    row, = queue_PEAQ.merge(path)
+    assert row['error'].startswith('FileNotFoundError') and 'ODG' not in row
+
+
+def test_stereo_frames_keep_averages(tmp_path):
+    # Per-frame MOVs of multichannel pairs are not stored, the job keeps its averages
+    ref, test = parity_PEAQ.signals(0.3)['clipped']
+    paths = []
+    for name, x in (('ref', ref), ('test', test)):
+        with wave.open(str(tmp_path / (name + '.wav')), 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(parity_PEAQ.FS)
+            w.writeframes(np.round(np.clip(np.stack([x, x], 1), -32768, 32767)).astype('<i2').tobytes())
+        paths.append(str(tmp_path / (name + '.wav')))
+    path = str(tmp_path / 'queue')
+    queue_PEAQ.submit(path, [tuple(paths)])
+    assert queue_PEAQ.work(path, 'node', fast_math=True, frames=True) == 1
+    row, = queue_PEAQ.merge(path)
+    assert 'error' not in row and np.isfinite(row['ODG'])
+    assert row['frames_error'].startswith('ValueError') and 'only mono pairs' in row['frames_error']
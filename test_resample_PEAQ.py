@@ -0,0 +1,53 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import numpy_PEAQ
+import parity_PEAQ
+import resample_PEAQ
+
+
+@pytest.mark.parametrize('rate', [44100, 32000, 16000, 96000])
+def test_sine_is_resampled(rate):
+    t = np.arange(rate // 2) / rate
+    y = resample_PEAQ.resample(np.sin(2 * np.pi * 997. * t), rate)
+    assert len(y) == parity_PEAQ.FS // 2
+    # Time aligned, away from the zero padded ends
+    n = np.arange(len(y)) / parity_PEAQ.FS
+    np.testing.assert_allclose(y[500:-500], np.sin(2 * np.pi * 997. * n[500:-500]), atol=1e-5)
+
+
+def test_blocks_match_whole_signal():
+    rng = np.random.RandomState(0)
+    x = rng.standard_normal((2, 3, 10000))
+    whole = resample_PEAQ.resample(x, 44100)
+    assert whole.shape == (2, 3, 10885)
+
+    rs = resample_PEAQ.Resampler(44100)
+    out, start = [], 0
+    for n in [1, 0, 7, 300, 2000, 5000, 2692]:
+        out.append(rs.process(x[..., start:start + n]))
+        start += n
+    out.append(rs.flush())
+    np.testing.assert_allclose(np.concatenate(out, -1), whole, rtol=0, atol=1e-12)
+
+    # Output blocks of given sizes, cut at the end of the signal
+    out = list(resample_PEAQ.blocks(x, 44100, [4096, 4096, 4096, 4096], chunk=1000))
+    assert [y.shape[-1] for y in out] == [4096, 4096, 2693, 0]
+    np.testing.assert_allclose(np.concatenate(out, -1), whole, rtol=0, atol=1e-12)
+
+
+def test_numpy_process_resamples():
+    ref, test = parity_PEAQ.signals(0.3)['clipped']
+    ref, test = (resample_PEAQ.resample(x, parity_PEAQ.FS, 32000) for x in (ref, test))
+    runs = []
+    for args in [(ref, test, 32000), (resample_PEAQ.resample(ref, 32000), resample_PEAQ.resample(test, 32000))]:
+        peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(*args)
+            peaq.avg_get()
+        runs.append(peaq)
+    for attr in ('NMRavg', 'EHS', 'ODG'):
+        np.testing.assert_array_equal(getattr(runs[0], attr), getattr(runs[1], attr), err_msg=attr)
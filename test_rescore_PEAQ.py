@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import parity_PEAQ
+import rescore_PEAQ
+
+
+def _edit(test, start, stop):
+    edited = test.copy()
+    edited[start:stop] = 0.5 * edited[start:stop] + 200 * np.sin(np.arange(stop - start))
+    return edited
+
+
+def test_rescore_matches_full_run():
+    ref, test = parity_PEAQ.signals(1.)['clipped']
+    rec = rescore_PEAQ.record(ref, test, every=16)
+    new = _edit(test, 10000, 12000)
+    result = rescore_PEAQ.rescore(rec, ref, new, 10000, 12000, verify=True)
+    assert result['edited'] == (8, 12) and result['span'][0] == 8
+    assert result['error'] < 1e-9
+
+
+def test_rescore_stops_when_settled(tmp_path):
+    ref, test = parity_PEAQ.signals(6.)['gated']
+    path = tmp_path / 'pair.npz'
+    rescore_PEAQ.record(ref, test, every=32, fast_math=True).save(path)
+    rec = rescore_PEAQ.load(path)
+    assert rec.fast_math and rec.every == 32 and rec.Np == 281
+
+    # Nothing edited
+    before = rec.averages()
+    result = rescore_PEAQ.rescore(rec, ref, test, 5000, 5000)
+    assert result['span'] == (3, 3) and result['ODG'] == before['ODG']
+
+    new = _edit(test, 48000, 60000)
+    result = rescore_PEAQ.rescore(rec, ref, new, 48000, 60000, verify=True)
+    first, end = result['span']
+    assert first == 45 and end % 32 == 0 and 59 <= end < rec.Np
+    assert result['error'] < 1e-9
+    full = rescore_PEAQ.record(ref, new, every=32, fast_math=True)
+    for name in rec.states:
+        np.testing.assert_allclose(rec.states[name], full.states[name], rtol=1e-9, atol=1e-300, err_msg=name)
+
+    with pytest.raises(ValueError):
+        rescore_PEAQ.rescore(rec, ref[:-1], new[:-1], 0, 10)
@@ -0,0 +1,99 @@
+import base64
+import concurrent.futures
+import threading
+import urllib.error
+import wave
+
+import numpy as np
+import pytest
+
+import parity_PEAQ
+import server_PEAQ
+
+torch = pytest.importorskip('torch')
+import torch_PEAQ  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def url():
+    scorer = server_PEAQ.Scorer('module64', workers=1, max_batch=4, batch_window=0.5)
+    server = server_PEAQ.serve(scorer, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://%s:%d' % server.server_address
+    server.shutdown()
+    server.server_close()
+    scorer.close()
+
+
+def _pcm(x):
+    return base64.b64encode(np.round(x).astype('<i2').tobytes()).decode()
+
+
+def test_score_pcm_and_files(url, tmp_path):
+    cases = parity_PEAQ.signals(0.6)
+    names = ['tones', 'clipped', 'gated']
+    payloads = [{'reference_pcm': _pcm(cases[name][0]), 'test_pcm': _pcm(cases[name][1])} for name in names]
+    with concurrent.futures.ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda p: server_PEAQ.request(url + '/score', p), payloads))
+
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)
+    for name, result in zip(names, results):
+        ref, test = [torch.from_numpy(np.round(x).astype(np.int16).astype(np.float64)) for x in cases[name]]
+        assert result['ODG'] == pytest.approx(float(model(ref, test)['ODG']), abs=1e-9)
+        assert result['latency']['total_s'] >= result['latency']['compute_s']
+    # Requests that arrive together are scored in one batch
+    assert max(result['latency']['batch'] for result in results) > 1
+
+    paths = []
+    for name, x in zip(('ref.wav', 'test.wav'), cases['tones']):
+        paths.append(str(tmp_path / name))
+        with wave.open(paths[-1], 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(parity_PEAQ.FS)
+            w.writeframes(np.round(x).astype('<i2').tobytes())
+    result = server_PEAQ.request(url + '/score', {'reference': paths[0], 'test': paths[1]})
+    assert result['ODG'] == pytest.approx(results[0]['ODG'], abs=1e-12)
+
+    # Stereo as interleaved PCM, scored with the channel combination of the model
+    ref, test = [np.round(np.stack([cases['tones'][i], cases['clipped'][i]])) for i in (0, 1)]
+    stereo = {'reference_pcm': _pcm(ref.T.ravel()), 'test_pcm': _pcm(test.T.ravel()), 'channels': 2}
+    result = server_PEAQ.request(url + '/score', stereo)
+    expected = model(torch.from_numpy(ref), torch.from_numpy(test), multichannel=True)
+    assert result['ODG'] == pytest.approx(float(expected['ODG']), abs=1e-9)
+
+    metrics = server_PEAQ.request(url + '/metrics')
+    assert metrics['scored'] == 5
+    assert metrics['pending'] == 0
+    assert metrics['total_s']['max'] >= metrics['total_s']['p50']
+
+
+def test_batch_with_different_test_lengths(url):
+    ref, test = parity_PEAQ.signals(1.)['tones']
+    # Same reference, tests shorter and longer than it: padded and cut as for a single request
+    payloads = [{'reference_pcm': _pcm(ref), 'test_pcm': _pcm(test[:n])} for n in (48000, 47900, 48000)]
+    payloads[2]['test_pcm'] = _pcm(np.concatenate([test, test[:500]]))
+    with concurrent.futures.ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda p: server_PEAQ.request(url + '/score', p), payloads))
+    assert max(result['latency']['batch'] for result in results) > 1
+
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)
+    ref = torch.from_numpy(np.round(ref).astype(np.int16).astype(np.float64))
+    for result, n in zip(results, (48000, 47900, 48000)):
+        x = torch.from_numpy(np.round(test[:n]).astype(np.int16).astype(np.float64))
+        assert result['ODG'] == pytest.approx(float(model(ref, x)['ODG']), abs=1e-9)
+
+
+def test_bad_requests(url):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        server_PEAQ.request(url + '/score', {'reference_pcm': _pcm(np.zeros(4800))})
+    assert e.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as e:
+        server_PEAQ.request(url + '/score', {'reference_pcm': '', 'test_pcm': '', 'rate': 44100})
+    assert e.value.code == 400
+
+    scorer = server_PEAQ.Scorer('module64', workers=1, max_pending=0)
+    with pytest.raises(server_PEAQ.Busy):
+        scorer.submit(np.zeros(4800), np.zeros(4800))
+    scorer.close()
@@ -0,0 +1,80 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import numpy_PEAQ
+import parity_PEAQ
+import shared_PEAQ
+
+
+def test_attach_gives_read_only_views():
+    x = np.arange(10.)
+    y = np.arange(6, dtype=np.int16).reshape(2, 3)
+    with shared_PEAQ.Shared({'x': x, 'y': y}, {'Fs': 44100}) as shared:
+        out = shared_PEAQ.attach(shared.handle)
+        assert out['Fs'] == 44100
+        np.testing.assert_array_equal(out['x'], x)
+        np.testing.assert_array_equal(out['y'], y)
+        assert out['y'].dtype == np.int16 and not out['x'].flags.writeable
+        del out
+        shared_PEAQ.detach(shared.handle)
+    # The owner removed the segment
+    with pytest.raises(FileNotFoundError):
+        shared_PEAQ.attach(shared.handle)
+
+
+def test_shared_tables(monkeypatch):
+    with shared_PEAQ.share_tables() as tables:
+        monkeypatch.setattr(numpy_PEAQ, '_tables', {})
+        assert not shared_PEAQ.tables_shared()
+        shared_PEAQ.use_tables(tables.handle)
+        assert shared_PEAQ.tables_shared()
+        pqe = numpy_PEAQ.PQEval(parity_PEAQ.AMAX)
+        np.testing.assert_array_equal(pqe.U, numpy_PEAQ.PQEval(1, cache=False).U)
+        assert isinstance(pqe.Nc, int)
+        del pqe
+        monkeypatch.setattr(numpy_PEAQ, '_tables', {})
+        shared_PEAQ.detach(tables.handle)
+
+
+def test_score_pairs():
+    pairs = [parity_PEAQ.signals(0.3)[name] for name in ('clipped', 'gated')]
+    results = shared_PEAQ.score_pairs(pairs, processes=2)
+    for (ref, test), result in zip(pairs, results):
+        peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+        with contextlib.redirect_stdout(io.StringIO()):
+            peaq.process(ref, test)
+            peaq.avg_get()
+        assert result['ODG'] == peaq.ODG
+
+    with shared_PEAQ.pool(2) as workers:
+        assert workers.apply(shared_PEAQ.tables_shared)
+
+
+def test_score_pairs_window(monkeypatch):
+    # A generator of pairs is consumed as results arrive, at most window segments exist
+    signals = parity_PEAQ.signals(0.1)
+    names = ['clipped', 'gated', 'tones', 'clipped', 'gated']
+    share = shared_PEAQ.share_pair
+    live = set()
+    most = []
+
+    def share_pair(ref, test):
+        segment = share(ref, test)
+        close = segment.close
+
+        def closing():
+            live.discard(segment)
+            close()
+        segment.close = closing
+        live.add(segment)
+        most.append(len(live))
+        return segment
+
+    monkeypatch.setattr(shared_PEAQ, 'share_pair', share_pair)
+    results = shared_PEAQ.score_pairs((signals[name] for name in names), processes=1, window=2)
+    assert len(most) == 5 and max(most) == 2 and not live
+    odg = [result['ODG'] for result in results]
+    assert odg[0] == odg[3] and odg[1] == odg[4] and len(set(odg)) == 3
@@ -0,0 +1,215 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+import numpy_PEAQ
+import parity_PEAQ
+import resample_PEAQ
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('tqdm')
+import torch_PEAQ  # noqa: E402
+
+
+def test_linear_scan_matches_recursion():
+    rng = np.random.RandomState(0)
+    x = torch.from_numpy(rng.standard_normal((2, 100, 5)))
+    a = torch.from_numpy(rng.uniform(0, 1, 5))
+    y0 = torch.from_numpy(rng.standard_normal((2, 5)))
+
+    y = torch_PEAQ.linear_scan(x, a, y0, K=7)
+    state = y0
+    for n in range(x.shape[-2]):
+        state = a * state + x[:, n]
+        torch.testing.assert_close(y[:, n], state)
+
+
+def test_module_matches_numpy():
+    ref, test = parity_PEAQ.signals(0.3)['gated']
+    out = io.StringIO()
+    assert parity_PEAQ.check({'gated': (ref, test, parity_PEAQ.FS)}, ['numpy', 'module64', 'scripted64'],
+                             all_cases=True, stream=out), out.getvalue()
+
+
+def test_module_batches():
+    cases = parity_PEAQ.signals(0.3)
+    ref = torch.from_numpy(np.stack([cases['tones'][0], cases['clipped'][0]]))
+    test = torch.from_numpy(np.stack([cases['tones'][1], cases['clipped'][1]]))
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)
+    batched = model(ref, test)
+    for i in range(2):
+        single = model(ref[i], test[i])
+        for key in ('NLoud_NL', 'EHS', 'ODG'):
+            torch.testing.assert_close(batched[key][i], single[key])
+
+
+def test_chunked_evaluate():
+    ref, test = parity_PEAQ.signals(0.5)['gated']
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)
+    full = model(torch.from_numpy(ref), torch.from_numpy(test[:-700]))
+    threads = torch.get_num_threads()
+    chunked = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX, threads=1)
+    # numpy inputs, converted block by block; the shorter test is zero padded as in forward()
+    out = chunked.evaluate(ref, test[:-700], block=5)
+    assert torch.get_num_threads() == threads
+    for key in ('NLoud_NL', 'EHS', 'BWTest', 'RmsNoiseLoudB', 'ODG'):
+        torch.testing.assert_close(out[key], full[key])
+    # A longer test is cut to the reference
+    torch.testing.assert_close(chunked.evaluate(ref[:-700], test, block=7)['ODG'],
+                               model(torch.from_numpy(ref[:-700]), torch.from_numpy(test[:-700]))['ODG'])
+
+    with torch_PEAQ.num_threads(1):
+        assert torch.get_num_threads() == 1
+    assert torch.get_num_threads() == threads
+
+
+def test_resampled_evaluate():
+    ref, test = parity_PEAQ.signals(0.5)['clipped']
+    ref, test = (resample_PEAQ.resample(x, parity_PEAQ.FS, 44100) for x in (ref, test))
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)
+    # Converted block by block as the frames are needed, same as converting first
+    out = model.evaluate(ref, test[:-300], block=4, Fs=44100)
+    full = model(torch.from_numpy(resample_PEAQ.resample(ref, 44100)),
+                 torch.from_numpy(resample_PEAQ.resample(test[:-300], 44100)))
+    for key in ('loud_NRef', 'NMRavg', 'PD_p', 'EHS', 'ODG'):
+        torch.testing.assert_close(out[key], full[key])
+
+
+def test_aligned_evaluate():
+    ref, test = parity_PEAQ.signals(0.5)['gated']
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX)
+    delayed = np.concatenate([np.zeros(123), test])
+    out = model.evaluate(ref, delayed, block=8, align=True)
+    assert int(out['delay']) == 123
+    torch.testing.assert_close(out['ODG'], model(torch.from_numpy(ref), torch.from_numpy(test))['ODG'])
+
+
+def test_full_scale(capsys):
+    # A full-scale sample is the peak level Amax, nothing is printed unless verbose
+    ref, test = parity_PEAQ.signals(0.3)['clipped']
+    ref = ref.copy()
+    ref[100] = -parity_PEAQ.AMAX
+    peaq = torch_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    peaq.process(ref, test)
+    peaq.avg_get()
+    assert np.isfinite(float(peaq.ODG))
+    assert capsys.readouterr().out == ''
+
+
+def test_linear_scan_gradcheck():
+    rng = np.random.RandomState(1)
+    x = torch.from_numpy(rng.standard_normal((40, 3))).requires_grad_(True)
+    a = torch.from_numpy(rng.uniform(0.2, 0.9, 3)).requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda x, a: torch_PEAQ.linear_scan(x, a, K=4), (x, a))
+
+
+def test_loss_gradcheck():
+    # Gradient w.r.t. a few parameters of a toy "codec": gain, noise level, one-tap filter
+    ref, test = parity_PEAQ.signals(0.75)['gated']
+    ref = torch.from_numpy(ref) / parity_PEAQ.AMAX
+    noise = torch.from_numpy(test) / parity_PEAQ.AMAX - ref
+    loss = torch_PEAQ.PEAQLoss({'ODG': -1., 'totalNMRB': 0.1, 'ADBB': 1.}, dtype=torch.float64)
+
+    def codec(theta):
+        x = theta[0] * ref + theta[1] * noise
+        return loss(ref, x + theta[2] * torch.nn.functional.pad(x[:-1], (1, 0)))
+
+    theta = torch.tensor([1., 1., 0.05], dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(codec, (theta,), eps=1e-6, atol=1e-5, rtol=1e-3)
+
+
+def test_loss_gradients_are_finite():
+    # Identical signals and digital silence are where sqrt/log gradients blow up
+    cases = parity_PEAQ.signals(0.75)
+    ref = torch.from_numpy(np.stack([cases['tones'][0], cases['gated'][0]])).float() / parity_PEAQ.AMAX
+    for test in (ref.clone(), ref + 1e-3 * torch.randn_like(ref)):
+        test.requires_grad_(True)
+        torch_PEAQ.PEAQLoss()(ref, test).backward()
+        assert torch.isfinite(test.grad).all()
+        assert test.grad.abs().sum() > 0
+
+    with pytest.raises(ValueError):
+        torch_PEAQ.PEAQLoss({'NMR': 1.})
+
+
+def test_multichannel_combination():
+    # Channels with detection probabilities below 1 in most frames
+    cases = parity_PEAQ.signals(0.75)
+    ref = torch.from_numpy(np.stack([cases['clipped'][0], cases['gated'][0]]))
+    test = torch.from_numpy(np.stack([cases['clipped'][1], cases['gated'][1]]))
+    model = torch_PEAQ.PEAQModule(parity_PEAQ.AMAX, intermediate=True)
+    stereo = model(ref, test, multichannel=True)
+    left, right = model(ref[0], test[0]), model(ref[1], test[1])
+
+    # Per-channel averages are averaged over the channels
+    for key in ('avgBWRef', 'totalNMRB', 'AvgModDiff1B', 'EHSB', 'relDistFramesB'):
+        torch.testing.assert_close(stereo[key], (left[key] + right[key]) / 2)
+
+    # Detection probability: p and q are the maxima over the channels per band, then
+    # combined over the bands (BS.1387 / Kabal's PQmovPD)
+    bands = [model.mov_pd(torch.stack([out['EhsR'], out['EhsT']])) for out in (left, right)]
+    p = torch.maximum(bands[0][0], bands[1][0])
+    q = torch.maximum(bands[0][1], bands[1][1])
+    Pc, Qc = 1 - torch.prod(1 - p, -1), torch.sum(q, -1)
+    torch.testing.assert_close(stereo['PD_p'], Pc.expand(2, -1))
+    torch.testing.assert_close(stereo['PD_q'], Qc.expand(2, -1))
+    # Combining the per-channel totals instead gives other values here
+    assert not torch.allclose(torch.maximum(left['PD_p'], right['PD_p']), Pc)
+    assert not torch.allclose(torch.maximum(left['PD_q'], right['PD_q']), Qc)
+    ADBB, MFPDB = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX).PQ_avgPD(Pc.numpy(), Qc.numpy())
+    assert float(stereo['ADBB']) == pytest.approx(ADBB, abs=1e-12)
+    assert float(stereo['MFPDB']) == pytest.approx(MFPDB, abs=1e-12)
+
+    # The numpy model combines the channels the same way
+    peaq = numpy_PEAQ.PEAQ(parity_PEAQ.AMAX)
+    with contextlib.redirect_stdout(io.StringIO()):
+        peaq.process(ref.numpy(), test.numpy())
+        peaq.avg_get()
+    np.testing.assert_allclose(peaq.PD_q, stereo['PD_q'].numpy(), rtol=1e-9)
+    for key in ('ADBB', 'MFPDB', 'RmsNoiseLoudB', 'EHSB', 'ODG'):
+        assert getattr(peaq, key) == pytest.approx(float(stereo[key]), rel=1e-6, abs=1e-9), key
+
+    # Identical channels score like mono
+    dual = model(ref[:1].repeat(2, 1), test[:1].repeat(2, 1), multichannel=True)
+    torch.testing.assert_close(dual['ODG'], left['ODG'])
+
+
+def test_filter_bank():
+    fb = torch_PEAQ.PEAQFilterBank(parity_PEAQ.AMAX)
+    # The strided matrix product is full rate filtering, subsampled by 32
+    x = np.random.RandomState(2).standard_normal(4800)
+    re, im = fb.filter_bank(torch.from_numpy(x), 150)
+    h = fb.H.flip(0).t().numpy()
+    for k in (0, 17, 39):
+        np.testing.assert_allclose(re[:, k].numpy(), np.convolve(x, h[k])[:4800:32], atol=1e-9)
+        np.testing.assert_allclose(im[:, k].numpy(), np.convolve(x, h[k + 40])[:4800:32], atol=1e-9)
+
+    # A full scale sine at a band centre is at 92 dB, less the outer and middle ear weighting
+    k = 20
+    fc = float(fb.fc[k])
+    n = np.arange(9600)
+    re, im = fb.filter_bank(torch.from_numpy(parity_PEAQ.AMAX * np.cos(2 * np.pi * fc * n / parity_PEAQ.FS)), 300)
+    fkHz = fc / 1000
+    AdB = -2.184 * fkHz ** (-0.8) + 6.5 * np.exp(-0.6 * (fkHz - 3.3) ** 2) - 0.001 * fkHz ** 3.6
+    level = 10 * np.log10((re[100:, k] ** 2 + im[100:, k] ** 2).numpy())
+    np.testing.assert_allclose(level, 92 + AdB, atol=0.05)
+
+
+def test_advanced_version():
+    cases = parity_PEAQ.signals(1.5)
+    ref = torch.from_numpy(np.stack([cases['tones'][0], cases['bandlimited'][0]]))
+    test = torch.from_numpy(np.stack([cases['tones'][1], cases['bandlimited'][1]]))
+    model = torch_PEAQ.PEAQAdvancedModule(parity_PEAQ.AMAX)
+    out = model(ref, test)
+    same = model(ref, ref)
+    for name in ('RmsModDiffA', 'RmsNoiseLoudAsymA', 'AvgLinDistA', 'EHSB'):
+        torch.testing.assert_close(same[name], torch.zeros_like(same[name]), atol=1e-3, rtol=0)
+    assert (out['ODG'] < same['ODG']).all()
+
+    single = model(ref[1], test[1])
+    for name in torch_PEAQ.ADVANCED_MOV_NAMES + ['ODG']:
+        torch.testing.assert_close(out[name][1], single[name])
+    out32 = torch_PEAQ.PEAQAdvancedModule(parity_PEAQ.AMAX, dtype=torch.float32)(ref, test)
+    np.testing.assert_allclose(out32['ODG'].numpy(), out['ODG'].numpy(), atol=1e-2)
@@ -1,18 +1,29 @@
+import cmath
+import contextlib
+import math
+from typing import Dict, List, Optional, Tuple
+
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from tqdm import tqdm
+
+import align_PEAQ
+import numpy_PEAQ
+import resample_PEAQ
 
 
 '''
 Original code: https://github.com/stephencwelch/Perceptual-Coding-In-Python/tree/master/PEAQPython
 '''
 class PQEval(object):
-    def __init__(self, Amax = 1, Fs= 48000, NF= 2048, device=None, dtype=None):
+    def __init__(self, Amax = 1, Fs= 48000, NF= 2048, device=None, dtype=None, cache=True):
         #Amax is maximum signal amplitude, Fs is sampling frequency
         #Setup parameters and precompute quantities we'll need.
+        # cache = take Bs and U from the numpy_PEAQ table cache instead of the loops below
         if device is None:
-            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
         self.dtype = dtype
         self.Fs = Fs * torch.ones((), device=self.device, dtype=torch.int)
         self.NF = NF * torch.ones((), device=self.device, dtype=torch.int)
@@ -39,8 +50,17 @@ class PQEval(object):
         #Internal Noise:
         self.EIN = self.PQIntNoise(self.fc)
 
+        #Loudness thresholds and excitation index:
+        self.Et = self.PQ_enThresh(self.fc)
+        self.sIdx = self.PQ_exIndex(self.fc)
+        self.Ets = 1.07664 * (self.Et / (self.sIdx * 1e4)) ** 0.23
+
         #Precompute normalization for frequency spreading:
-        self.Bs = self.PQ_SpreadCB(torch.ones(self.Nc, device=self.device, dtype=self.dtype), torch.ones(self.Nc, device=self.device, dtype=self.dtype))
+        if cache:
+            table = numpy_PEAQ.tables(int(Fs), int(NF))
+            self.Bs = torch.tensor(table['Bs'], dtype=torch.float64).to(self.device).type(self.dtype)
+        else:
+            self.Bs = self.PQ_SpreadCB(torch.ones(self.Nc, device=self.device, dtype=self.dtype), torch.ones(self.Nc, device=self.device, dtype=self.dtype))
 
         # Allocate storage
         self.Eb = torch.zeros((2, self.Nc), device=self.device, dtype=self.dtype)
@@ -50,15 +70,18 @@ class PQEval(object):
         self.Es = torch.zeros((2, self.Nc), device=self.device, dtype=self.dtype)
 
         #Precompute for PQ Group:
-        self.df = float(self.Fs) / self.NF
+        self.df = float(self.Fs) / float(self.NF) * torch.ones((), device=self.device, dtype=self.dtype)
         self.Emin = 1e-12 * torch.ones((), device=self.device, dtype=self.dtype)
         
-        self.U = torch.zeros((torch.div(self.NF, 2, rounding_mode='floor')+1, self.Nc), device=self.device, dtype=self.dtype)
+        if cache:
+            self.U = torch.tensor(table['U'], dtype=torch.float64).to(self.device).type(self.dtype)
+        else:
+            self.U = torch.zeros((torch.div(self.NF, 2, rounding_mode='floor')+1, self.Nc), device=self.device, dtype=self.dtype)
 
-        for k in range(torch.div(self.NF, 2, rounding_mode='floor')+1):
-            for i in range(self.Nc):
-                temp = (torch.amin(torch.stack([self.fu[i], (k+0.5)*self.df])) - torch.amax(torch.stack([self.fl[i], (k-0.5)*self.df]))) / self.df
-                self.U[k, i] = torch.amax(torch.stack([torch.zeros_like(temp), temp]))
+            for k in range(torch.div(self.NF, 2, rounding_mode='floor')+1):
+                for i in range(self.Nc):
+                    temp = (torch.amin(torch.stack([self.fu[i], (k+0.5)*self.df])) - torch.amax(torch.stack([self.fl[i], (k-0.5)*self.df]))) / self.df
+                    self.U[k, i] = torch.amax(torch.stack([torch.zeros_like(temp), temp]))
 
         # check FLAG, False means first operation
         self.check_PQmodPatt = False
@@ -173,7 +196,7 @@ class PQEval(object):
 
     def PQ_timeSpread(self, Es, Ef):
         Nadv = torch.div(self.NF, 2, rounding_mode='floor')
-        Fss = float(self.Fs)/Nadv
+        Fss = float(self.Fs)/float(Nadv)
         tau_100 = 0.030
         tau_min = 0.008
         alpha, _ = self.PQtConst(tau_100, tau_min, self.fc, Fss)
@@ -278,7 +301,7 @@ class PQEval(object):
         # NW  - Window length samples
 
         #Distance to the nearest DFT bin
-        df = 1./NF
+        df = 1./float(NF)
         k = torch.floor(fcN/df)
         
         dfN = torch.amin(torch.stack([(k+1)*df - fcN, fcN -k*df]))
@@ -328,7 +351,7 @@ class PQEval(object):
             9132.688, 9465.574, 9810.536, 10168.013, 10538.460, \
             10922.351, 11320.175, 11732.438, 12159.670, 12602.412, \
             13061.229, 13536.710, 14029.458, 14540.103, 15069.295, \
-            15617.710, 16186.049, 16775.035, 17385.420]).to(self.device).type(self.dtype)
+            15617.710, 16186.049, 16775.035, 17385.420], dtype=torch.float64).to(self.device).type(self.dtype)
         fc = torch.tensor([91.708, 115.216, 138.870, 162.702, 186.742, \
             211.019, 235.566, 260.413, 285.593, 311.136, \
             337.077, 363.448, 390.282, 417.614, 445.479, \
@@ -350,7 +373,7 @@ class PQEval(object):
             9297.648, 9636.520, 9987.683, 10351.586, 10728.695, \
             11119.490, 11524.470, 11944.149, 12379.066, 12829.775, \
             13294.850, 13780.887, 14282.503, 14802.338, 15341.057, \
-            15899.345, 16477.914, 17077.504, 17690.045]).to(self.device).type(self.dtype)
+            15899.345, 16477.914, 17077.504, 17690.045], dtype=torch.float64).to(self.device).type(self.dtype)
         fu = torch.tensor([103.445, 127.023, 150.762, 174.694, 198.849, \
             223.257, 247.950, 272.959, 298.317, 324.055, \
             350.207, 376.805, 403.884, 431.478, 459.622, \
@@ -372,13 +395,13 @@ class PQEval(object):
             9465.574, 9810.536, 10168.013, 10538.460, 10922.351, \
             11320.175, 11732.438, 12159.670, 12602.412, 13061.229, \
             13536.710, 14029.458, 14540.103, 15069.295, 15617.710, \
-            16186.049, 16775.035, 17385.420, 18000.000]).to(self.device).type(self.dtype)
+            16186.049, 16775.035, 17385.420, 18000.000], dtype=torch.float64).to(self.device).type(self.dtype)
         
         return Nc, fc, fl, fu, dz
 
     def PQmodPatt(self):
         Nadv = torch.div(self.NF, 2, rounding_mode='floor')
-        Fss = float(self.Fs)/Nadv
+        Fss = float(self.Fs)/float(Nadv)
         tau_100 = 0.050
         tau_min = 0.008
         alpha, beta = self.PQtConst(tau_100, tau_min, self.fc, Fss)
@@ -399,19 +422,14 @@ class PQEval(object):
         return M, ERavg
 
     def PQloud(self, Ehs, mod='FFT'):
+        # Ehs: (..., Nc), e.g. (2, frames, Nc) for both signals of a block of frames
         if mod != 'FFT':
             raise ValueError(f'Only FFT mod support, you choose {mod}')
 
-        c = 1.07664
         e = 0.23
-        E0 = 1e4
-        self.Et = self.PQ_enThresh(self.fc)
-        s = self.PQ_exIndex(self.fc)
-        Ets = c * (self.Et / (s * E0)) ** e
-
-        
-        sN = torch.sum(torch.maximum(Ets * ((1 - s + s * Ehs / self.Et) ** e - 1), torch.zeros_like(Ets)))
-        Ntot = (24 / self.Nc) * sN
+        s = self.sIdx
+        sN = torch.sum(torch.clamp(self.Ets * ((1 - s + s * Ehs / self.Et) ** e - 1), min=0), -1)
+        Ntot = (24 / float(self.Nc)) * sN
         return Ntot
 
     @staticmethod
@@ -423,6 +441,7 @@ class PQEval(object):
         return 10**((-2 - 2.05 * torch.arctan(fc / 4000) - 0.75 * torch.arctan((fc / 1600) ** 2)) / 10)
 
     def PQmovModDiffB(self, M, ERavg):
+        # M: (2, ..., Nc) reference and test, ERavg: (..., Nc)
         e = 0.3
         Ete = self.EIN ** e
         negWt2B = 0.1
@@ -435,11 +454,11 @@ class PQEval(object):
         num2B = torch.where(cond, negWt2B * num1B, num1B)
         MD1B = num1B / (offset1B + M[0])
         MD2B = num2B / (offset2B + M[0])
-        s1B = torch.sum(MD1B)
-        s2B = torch.sum(MD2B)
-        Wt = torch.sum(ERavg / (ERavg + levWt * Ete))
+        s1B = torch.sum(MD1B, -1)
+        s2B = torch.sum(MD2B, -1)
+        Wt = torch.sum(ERavg / (ERavg + levWt * Ete), -1)
 
-        return (100 / self.Nc) * s1B, (100 / self.Nc) * s2B, Wt
+        return (100 / float(self.Nc)) * s1B, (100 / float(self.Nc)) * s2B, Wt
 
     def PQmovPD(self, EhsR, EhsT):
         c = [-0.198719, 0.0550197, -0.00102438, 5.05622e-6, 9.01033e-11]
@@ -466,13 +485,25 @@ class PQEval(object):
 
 
 class PEAQ(object):
-    def __init__(self, Amax = 1, Fs = 48000, NF = 2048, device=None, dtype=torch.float64):
+    def __init__(self, Amax = 1, Fs = 48000, NF = 2048, device=None, dtype=torch.float64, skip_silent=True,
+                 keep_spectra=True, block=256, threads=None, interop_threads=None):
         # Amax = maximum signal amplitude
         # Fs = sampling frequency
         # NF = Length of analysis window
+        # skip_silent = reuse the fixed results of silent frames (see PQ_frameClasses)
+        # keep_spectra = store the DFT spectra and compute the bandwidths for all frames at once (as numpy_PEAQ)
+        # block = frames per call of the loudness, modulation difference, noise loudness and PD kernels
+        # threads, interop_threads = torch thread counts process() runs with (see num_threads)
+
+        self.block = block
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.skip_silent = skip_silent
+        self.keep_spectra = keep_spectra
 
         if device is None:
-            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
         self.dtype = dtype
 
         self.NF = NF * torch.ones((), dtype=torch.int, device=self.device)
@@ -488,8 +519,21 @@ class PEAQ(object):
         self.Rn = torch.zeros((self.Nc), device=self.device, dtype=self.dtype)
         self.Rd = torch.zeros((self.Nc), device=self.device, dtype=self.dtype)
         self.PC = torch.zeros((2, self.Nc), device=self.device, dtype=self.dtype)
-
-    def process(self, referenceSignal, testSignal):
+        # Masking offsets of the NMR, built at the first computeNMR call
+        self.gm = None
+        # Delay of the test signal found by process(align=True)
+        self.delay = None
+
+    def process(self, referenceSignal, testSignal, align=False, verbose=False):
+        # align = score the aligned overlap of the signals, the delay is kept in self.delay (align_PEAQ)
+        # verbose = print the signal levels and progress
+        self.delay = None
+        if align:
+            referenceSignal, testSignal, self.delay = align_PEAQ.align(referenceSignal, testSignal, self.Fs)
+        with num_threads(self.threads, self.interop_threads):
+            self.PQprocess(referenceSignal, testSignal, verbose)
+
+    def PQprocess(self, referenceSignal, testSignal, verbose=False):
         #Preform basic procssing (Section 2 in Kabal.)
         # sigR = reference signal	
         # sigT = test signal
@@ -505,24 +549,28 @@ class PEAQ(object):
         self.Np = (torch.floor(len(sigR)/self.Nadv)).type(torch.int)
         
         #Scale audio:
-        if torch.amax(abs(sigR)) != self.Amax:
-            # sigRS = self.Amax*sigR/float(torch.amax(abs(sigR)))
-            # sigTS = self.Amax*sigT/float(torch.amax(abs(sigT)))
-            sigRS = sigR
-            sigTS = sigT
+        # sigRS = self.Amax*sigR/float(torch.amax(abs(sigR)))
+        # sigTS = self.Amax*sigT/float(torch.amax(abs(sigT)))
+        sigRS = sigR
+        sigTS = sigT
+        if verbose and torch.amax(abs(sigR)) != self.Amax:
             print ('Signals scaled, max reference value = ' + str(torch.amax(abs(sigRS))) + ',')
             print ('and max test value = ' + str(torch.amax(abs(sigTS))) +'.')
 
         #Instantiate Object to process single frames of data:
-        self.PQE = PQEval(Amax = self.Amax, Fs = self.Fs, NF = self.NF, dtype=self.dtype)
+        self.PQE = PQEval(Amax = self.Amax, Fs = self.Fs, NF = self.NF, device=self.device, dtype=self.dtype)
 
-        print('Processing Audio...')
+        if verbose:
+            print('Processing Audio...')
         
         #Create empty matrices:
         X2 = torch.zeros((2, torch.div(self.NF, 2, rounding_mode='floor')+1), device=self.device, dtype=self.dtype)
 
-        self.X2MatR = torch.zeros((self.Np, torch.div(self.NF, 2, rounding_mode='floor')+1), device=self.device, dtype=self.dtype)
-        self.X2MatT = torch.zeros((self.Np, torch.div(self.NF, 2, rounding_mode='floor')+1), device=self.device, dtype=self.dtype)
+        if self.keep_spectra:
+            self.X2MatR = torch.zeros((self.Np, torch.div(self.NF, 2, rounding_mode='floor')+1), device=self.device, dtype=self.dtype)
+            self.X2MatT = torch.zeros((self.Np, torch.div(self.NF, 2, rounding_mode='floor')+1), device=self.device, dtype=self.dtype)
+        else:
+            self.X2MatR = self.X2MatT = None
 
         self.EbNMat = torch.zeros((self.Np, self.Nc), device=self.device, dtype=self.dtype)
         self.EsMatR = torch.zeros((self.Np, self.Nc), device=self.device, dtype=self.dtype)
@@ -555,6 +603,18 @@ class PEAQ(object):
 
         startS = 0
 
+        silent, quiet = self.PQ_frameClasses(sigRS, sigTS)
+        # DFT / excitation of a silent frame, computed at the first one
+        zero = {}
+
+        # Modulation patterns and adapted excitations of the current block of frames
+        block = self.block
+        Mb = torch.zeros((2, block, self.Nc), device=self.device, dtype=self.dtype)
+        ERavgb = torch.zeros((block, self.Nc), device=self.device, dtype=self.dtype)
+        EPb = torch.zeros((2, block, self.Nc), device=self.device, dtype=self.dtype)
+
+        # Progress bar, imported here so that importing the module doesn't need tqdm
+        from tqdm import tqdm
         for i in tqdm(torch.arange(self.Np)):
             xR = sigRS[startS:self.NF+startS]
             xT = sigTS[startS:self.NF+startS]
@@ -568,14 +628,23 @@ class PEAQ(object):
             self.xMatR[i, :] = xR
             self.xMatT[i, :] = xT
             
-            #Process Frame: 
-            X2[0,:] = self.PQE.PQDFTFrame(xR)
-            X2[1,:] = self.PQE.PQDFTFrame(xT)
-            self.X2MatR[i,:] = X2[0,:]
-            self.X2MatT[i,:] = X2[1,:]
-            
-            # Critical band grouping and frequency spreading
-            self.EbN, self.Es = self.PQE.PQ_excitCB(X2)
+            if silent[i] and 'Es' in zero:
+                # Zero spectra (X2Mat rows stay zero); PQmodPatt reads the excitation from PQE
+                X2[:] = 0
+                self.PQE.Es[:] = zero['Es']
+                self.EbN, self.Es = zero['EbN'], self.PQE.Es
+            else:
+                #Process Frame: 
+                X2[0,:] = self.PQE.PQDFTFrame(xR)
+                X2[1,:] = self.PQE.PQDFTFrame(xT)
+                if self.keep_spectra:
+                    self.X2MatR[i,:] = X2[0,:]
+                    self.X2MatT[i,:] = X2[1,:]
+
+                # Critical band grouping and frequency spreading
+                self.EbN, self.Es = self.PQE.PQ_excitCB(X2)
+                if silent[i]:
+                    zero['EbN'], zero['Es'] = self.EbN.clone(), self.Es.clone()
             
             self.EbNMat[i,:] = self.EbN
             self.EsMatR[i,:] = self.Es[0,:]
@@ -585,30 +654,61 @@ class PEAQ(object):
             self.EhsR[i,:], previousFrameR = self.PQE.PQ_timeSpread(self.EsMatR[i,:], previousFrameR)
             self.EhsT[i,:], previousFrameT = self.PQE.PQ_timeSpread(self.EsMatT[i,:], previousFrameT)
 
-            EP = self.PQadapt(self.EhsR[i], self.EhsT[i], 'FFT')
-            M, ERavg = self.PQE.PQmodPatt()
-            self.loud_NRef[i] = self.PQE.PQloud(self.EhsR[i,:])
-            self.loud_NTest[i] = self.PQE.PQloud(self.EhsT[i,:])
+            # Recursive stages, their outputs are kept for the block MOVs
+            j = int(i) % block
+            EPb[:,j] = self.PQadapt(self.EhsR[i], self.EhsT[i], 'FFT')
+            Mb[:,j], ERavgb[j] = self.PQE.PQmodPatt()
+            if j == block - 1 or int(i) == self.Np - 1:
+                self.PQ_movBlock(int(i) - j, Mb[:,:j+1], ERavgb[:j+1], EPb[:,:j+1])
+
+            if not self.keep_spectra:
+                self.BWRef[i], self.BWTest[i] = self.computeBW(X2[0], X2[1])
 
-            self.MDiff_Mt1B[i], self.MDiff_Mt2B[i], self.MDiff_Wt[i] = self.PQE.PQmovModDiffB(M, ERavg)
+            self.EHS[i] = -1 if quiet[i] else self.PQmovEHS(xR, xT, X2)
+        if self.keep_spectra:
+            self.BWRef[:], self.BWTest[:] = self.computeBW(self.X2MatR, self.X2MatT)
+        self.NMRavg, self.NMRmax = self.computeNMR(self.EbNMat, self.EhsR)
 
-            self.NLoud_NL[i] = self.PQmovNLoudB(M, EP)
+    def PQ_movBlock(self, start, M, ERavg, EP):
+        # Per-frame MOVs of frames start.. from their (2, frames, Nc) patterns (as numpy_PEAQ)
+        frames = slice(start, start + M.shape[1])
+        Ehs = torch.stack([self.EhsR[frames], self.EhsT[frames]])
+        self.loud_NRef[frames], self.loud_NTest[frames] = self.PQE.PQloud(Ehs)
 
-            self.BWRef[i], self.BWTest[i] = self.computeBW(self.X2MatR[i], self.X2MatT[i])
+        self.MDiff_Mt1B[frames], self.MDiff_Mt2B[frames], self.MDiff_Wt[frames] = self.PQE.PQmovModDiffB(M, ERavg)
 
-            PD_p, PD_q = self.PQE.PQmovPD(self.EhsR[i,:], self.EhsT[i,:])
-            self.PD_p[i], self.PD_q[i] = self.PQ_ChanPD(PD_p, PD_q)
+        self.NLoud_NL[frames] = self.PQmovNLoudB(M, EP)
 
-            self.EHS[i] = self.PQmovEHS(xR, xT, X2)
-        self.NMRavg, self.NMRmax = self.computeNMR(self.EbNMat, self.EhsR)
+        PD_p, PD_q = self.PQE.PQmovPD(Ehs[0], Ehs[1])
+        self.PD_p[frames], self.PD_q[frames] = self.PQ_ChanPD(PD_p, PD_q)
+
+    def PQ_frameClasses(self, sigR, sigT):
+        # Classifies all frames at once, before the frame loop (as numpy_PEAQ).
+        # silent - reference and test frames are digital silence: the DFT, excitation and
+        #          bandwidth results are those of a zero frame, the recursive stages still run
+        # quiet  - the second halves of both frames are below the EHS energy threshold, EHS = -1
+        # Returned as lists of bools, indexed in the frame loop.
+        Np = int(self.Np)
+        if not self.skip_silent:
+            return [False] * Np, [False] * Np
+        EnThr = 8000
+        Nadv = int(self.Nadv)
+        N = (Np + 1) * Nadv
+        silent = torch.ones(Np, dtype=torch.bool, device=self.device)
+        quiet = torch.ones(Np, dtype=torch.bool, device=self.device)
+        for x in (sigR, sigT):
+            # Frame i consists of the half frames i and i+1
+            x = x[:N].to(torch.float64)
+            h = F.pad(x, (0, N - x.shape[-1])).reshape(Np + 1, Nadv)
+            zero = ~torch.any(h != 0, -1)
+            silent &= zero[:-1] & zero[1:]
+            quiet &= torch.einsum('ij,ij->i', h[1:], h[1:]) < 0.999 * EnThr
+        return silent.tolist(), quiet.tolist()
 
     def PQ_ChanPD(self, p, q):
-        Pr = 1
-        Qc = 0
-        for m in range(self.Nc):
-            Pr *= 1 - p[m]
-            Qc += q[m]
-        Pc = 1 - Pr
+        # p, q: (..., Nc)
+        Pc = 1 - torch.prod(1 - p, -1)
+        Qc = torch.sum(q, -1)
         return Pc, Qc
 
     def get(self):
@@ -624,7 +724,7 @@ class PEAQ(object):
         if Mod != 'FFT':
             raise ValueError(f'Mod only supports FFT, but {Mod}')
         
-        Fss = self.Fs / self.Nadv
+        Fss = float(self.Fs) / float(self.Nadv)
         t100 = 0.050
         tmin = 0.008
         a, b = self.PQE.PQtConst(t100, tmin, self.PQE.fc, Fss)
@@ -796,6 +896,7 @@ class PEAQ(object):
         return ADBB, MFPDB
 
     def PQmovNLoudB(self, M, EP):
+        # M, EP: (2, ..., Nc) reference and test
         alpha = 1.5
         TF0 = 0.15
         S0 = 0.5
@@ -809,13 +910,12 @@ class PEAQ(object):
         tmp = test * EP[1] - sref * EP[0]
         a = torch.maximum(tmp, torch.zeros_like(tmp))
         b = self.PQE.EIN + sref * EP[0] * beta
-        s = torch.sum((self.PQE.EIN / test) ** e * ((1 + a / b) ** e - 1))
-        NL = (24 / self.Nc) * s
-        if NL < NLmin:
-            return 0
-        return NL
+        s = torch.sum((self.PQE.EIN / test) ** e * ((1 + a / b) ** e - 1), -1)
+        NL = (24 / float(self.Nc)) * s
+        return torch.where(NL < NLmin, torch.zeros_like(NL), NL)
 
     def computeBW(self, X2MatR, X2MatT):
+        # X2MatR, X2MatT: (..., NF/2+1) spectra of one frame or of all frames at once
         fx = 21586
         kx = torch.round(self.NF * float(fx)/self.Fs).type(torch.int) # 921
         fl = 8109
@@ -830,59 +930,38 @@ class PEAQ(object):
         cond = X2MatR[...,kl+1:kx] >= XthR[...,None]
         BWRef = (torch.arange(kl + 1, cond.shape[-1] + kl + 1, device=self.device, dtype=self.dtype)[None] * cond).max(-1)[0] + 1
 
+        # The test bandwidth is searched below BWRef-1 <= kx-1, masked per frame instead
+        # of sliced. An empty range (BWRef = 1) gives BWTest = 1.
         XthT = FT * Xth
-        cond = X2MatT[...,:int(BWRef-1)] >= XthT[...,None]
-        BWTest = (torch.arange(cond.shape[-1], device=self.device, dtype=self.dtype)[None] * cond).max(-1)[0] + 1
+        k = torch.arange(int(kx), device=self.device, dtype=self.dtype)
+        cond = (X2MatT[...,:kx] >= XthT[...,None]) & (k < BWRef[...,None] - 1)
+        BWTest = (k * cond).max(-1)[0] + 1
         return BWRef, BWTest
 
     def computeNMR(self, EbNMat, EhsR):
         #Kabal Section
         #Compute NRM for whole time series.
+        # EbNMat, EhsR: (Np, Nc), all frames in one division and reduction
 
-        NMRavg = torch.zeros(self.Np, device=self.device, dtype=self.dtype)
-        NMRmax = torch.zeros(self.Np, device=self.device, dtype=self.dtype)
-
-        for i in range(int(self.Np)):
-            NMR = self.PQmovNMRB(EbNMat[i,:], EhsR[i,:])
-            NMRavg[i] = NMR['NMRavg']
-            NMRmax[i] = NMR['NMRmax']
+        NMRm = EbNMat / (self.PQ_MaskOffset() * EhsR)
+        NMRavg = torch.mean(NMRm, -1)
+        NMRmax = torch.clamp(torch.amax(NMRm, -1), min=0)
 
         return NMRavg, NMRmax
 
     def PQmovNMRB(self, EbN, Ehs):
-        NMR = dict()
-        
-        Nc, fc, fl, fu, dz = self.PQE.PQCB()
-        gm = self.PQ_MaskOffset(dz, Nc)
-        
-        NMRmax = 0
-        NMRm = 0
-        s = 0
-
-        R_NM = torch.zeros(Nc, device=self.device, dtype=self.dtype)
-        
-        for k in range(Nc):
-            NMRm = EbN[k] / (gm[k] * Ehs[k])
-            R_NM[k] = NMRm # Remove later!
-            s = s + NMRm
-            
-            if (NMRm > NMRmax):
-                NMRmax = NMRm
-                
-        NMR['NMRmax'] = NMRmax
-        NMR['NMRavg'] = float(s)/Nc
-        
-        return NMR
-
-    def PQ_MaskOffset(self, dz, Nc):
-        gm = torch.zeros(Nc, device=self.device, dtype=self.dtype)
-        for k in range(Nc):
-            if (k <= 12./dz):
-                mdB = 3
-            else:
-                mdB = 0.25*k*dz  
-            gm[k] = 10**(-1*float(mdB)/10) 
-        return gm
+        # NMR of a single frame
+        NMRavg, NMRmax = self.computeNMR(EbN, Ehs)
+        return {'NMRmax': NMRmax, 'NMRavg': float(NMRavg)}
+
+    def PQ_MaskOffset(self):
+        # Masking offset per band, 3 dB up to 12 Bark then 0.25 dB/Bark
+        if self.gm is None:
+            Nc, fc, fl, fu, dz = self.PQE.PQCB()
+            k = torch.arange(Nc, device=self.device, dtype=self.dtype)
+            mdB = torch.where(k <= 12./dz, torch.full_like(k, 3.), 0.25*k*dz)
+            self.gm = 10**(-mdB/10)
+        return self.gm
 
     def PQmovEHS(self, xR, xT, X2):
         NF = self.NF
@@ -921,13 +1000,8 @@ class PEAQ(object):
         M = M.type(torch.int)
         NL = NL.type(torch.int)
 
-        C = torch.zeros(NL, device=self.device, dtype=self.dtype)
-        for i in range(NL):
-            s = 0
-            for j in range(M):
-                s += D[...,j] * D[...,i+j]
-            C[i] = s
-        return C
+        # C[i] = D[:M] . D[i:i+M], all lags at once
+        return torch.matmul(D.unfold(-1, M, 1)[:NL], D[:M])
 
     @staticmethod
     def PQ_log2(x):
@@ -944,7 +1018,7 @@ class PEAQ(object):
         Cn = torch.zeros((NL,), device=self.device, dtype=self.dtype)
 
         s0 = C[0]
-        sj = s0
+        sj = s0.clone()
         Cn[0] = 1
         for i in range(1, NL):
             sj += (D[i+M-1] ** 2 - D[i-1] ** 2)
@@ -1035,3 +1109,991 @@ class PEAQ(object):
             s = s / sW
         return s
 
+
+
+# Averaged MOVs in the order the Basic version neural network takes them
+MOV_NAMES = ['avgBWRef', 'avgBWTest', 'totalNMRB', 'WinModDiff1B', 'ADBB', 'EHSB',
+             'AvgModDiff1B', 'AvgModDiff2B', 'RmsNoiseLoudB', 'MFPDB', 'relDistFramesB']
+
+
+@contextlib.contextmanager
+def num_threads(threads=None, interop=None):
+    # torch intra-op threads for the enclosed code, restored afterwards (None = unchanged).
+    # interop is the inter-op thread count, which torch lets a process set only before its
+    # first inter-op parallel work (RuntimeError afterwards). Both are process wide: evaluators
+    # sharing a CPU scale best in separate processes with threads = cores // evaluators
+    # (bench_PEAQ.py --scaling), not as threads of one process.
+    if interop is not None and torch.get_num_interop_threads() != interop:
+        torch.set_num_interop_threads(interop)
+    saved = torch.get_num_threads()
+    if threads is not None:
+        torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(saved)
+
+
+def linear_scan(x, a, y0: Optional[torch.Tensor] = None, K: int = 32):
+    # First order recursion y[n] = a * y[n-1] + x[n] along the frame axis (-2),
+    # with one coefficient per band (a is broadcast over the last axis).
+    # Every smoothing filter in the model has this form, so instead of a loop over
+    # frames we scan blocks of K frames with a (K, K) matrix, then scan the block
+    # end values the same way (coefficient a**K) until one block is left, and
+    # propagate the carries back down. y0 is the state before the first frame.
+    if y0 is not None:
+        x = torch.cat([x[..., :1, :] + a * y0.unsqueeze(-2), x[..., 1:, :]], -2)
+
+    n = torch.arange(K, device=x.device)
+    i = n[:, None] - n[None, :]
+    locals_: List[torch.Tensor] = []
+    coefs: List[torch.Tensor] = []
+    lengths: List[int] = []
+    ak = a * torch.ones(x.shape[-1:], device=x.device, dtype=x.dtype)
+    cur = x
+    while cur.shape[-2] > 1:
+        N = cur.shape[-2]
+        nb = (N + K - 1) // K
+        blocks = F.pad(cur, (0, 0, 0, nb * K - N)).reshape(list(cur.shape[:-2]) + [nb, K, cur.shape[-1]])
+        # Powers ak^1 ... ak^K by repeated products (pow of an underflowed complex
+        # coefficient gives NaN)
+        P = torch.cumprod(ak.expand([K] + list(ak.shape)), 0)
+        P0 = torch.cat([torch.ones_like(ak).unsqueeze(0), P[:-1]])
+        T = torch.where((i >= 0)[..., None], P0[i.clamp(min=0)], torch.zeros_like(ak))
+        local = torch.einsum('ijc,...bjc->...bic', T, blocks)
+        locals_.append(local)
+        coefs.append(P)
+        lengths.append(N)
+        cur = local[..., K - 1, :]
+        ak = P[-1]
+
+    y = cur
+    for l in range(len(locals_) - 1, -1, -1):
+        local = locals_[l]
+        prev = F.pad(y[..., :-1, :], (0, 0, 1, 0))
+        y = local + coefs[l] * prev.unsqueeze(-2)
+        y = y.reshape(list(y.shape[:-3]) + [-1, y.shape[-1]])[..., :lengths[l], :]
+    return y
+
+
+class PEAQModule(nn.Module):
+    '''
+    PEAQ Basic version as a single torch module: the same model as PQEval/PEAQ, but
+    evaluated on all frames at once, without data-dependent Python control flow,
+    so it can be run eagerly, scripted with torch.jit.script or compiled with
+    torch.compile. The tables are registered buffers, so .to(device/dtype) moves them.
+
+    forward(ref, test) takes signals of shape (..., N) on the Amax scale and returns
+    a dict with the per-frame MOVs and the averaged MOVs under the attribute names
+    used by PEAQ (MDiff_Mt1B, BWRef, ..., avgBWRef, ..., ODG), plus the distortion index DI.
+    Leading dimensions are batch dimensions; test is padded/cut to the length of ref.
+
+    The graph is differentiable. With smooth=True the thresholds that are piecewise
+    constant in the standard (PD truncation, distorted-frame counts) are replaced by
+    soft versions so they pass gradients; the bandwidth MOVs stay piecewise constant.
+
+    dz is the critical band resolution in Bark: 1/4 for the Basic version (the tabulated
+    109 bands), 1/2 for the FFT ear model of the Advanced version (55 bands).
+
+    threads / interop_threads are the torch thread counts blocks() and evaluate() run with
+    (see num_threads), None leaves the process setting; forward() always uses the latter.
+    '''
+    def __init__(self, Amax = 1, Fs = 48000, NF = 2048, dtype=torch.float64, intermediate=False, smooth=False,
+                 dz=0.25, threads: Optional[int] = None, interop_threads: Optional[int] = None):
+        super().__init__()
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.Fs = int(Fs)
+        self.NF = int(NF)
+        self.Nadv = self.NF // 2
+        self.Fss = float(self.Fs) / float(self.Nadv)
+        self.intermediate = intermediate
+        self.smooth = smooth
+        self.mov_names: List[str] = list(MOV_NAMES)
+
+        # Tables are computed in float64 and cast once at the end
+        f64 = torch.float64
+        if dz == 0.25:
+            cb = PQEval.PQCB(_Tables(f64))
+            Nc, fc, fl, fu = int(cb[0]), cb[1], cb[2], cb[3]
+        else:
+            Nc, fc, fl, fu = _critical_bands(dz)
+        self.Nc = Nc
+        self.dz = dz
+        K = self.NF // 2 + 1
+
+        # Scaled Hann window (PQ_GL, PQ_gp)
+        fcN = 1019.5 / self.Fs
+        W = self.NF - 1
+        df = 1. / self.NF
+        k = math.floor(fcN / df)
+        dfW = min((k + 1) * df - fcN, fcN - k * df) * W
+        gp = math.sin(math.pi * dfW) / (math.pi * dfW * (1 - dfW ** 2))
+        GL = 10 ** (92 / 20.) / (gp * Amax / 4 * W)
+        self.register_buffer('hw', GL * self._hann(self.NF))
+
+        # Outer and middle ear weighting
+        f = torch.linspace(0, self.Fs // 2, K, dtype=f64)
+        fkHz = f[1:] / 1000
+        AdB = -2.184 * fkHz ** (-0.8) + 6.5 * torch.exp(-0.6 * (fkHz - 3.3) ** 2) - 0.001 * fkHz ** (3.6)
+        self.register_buffer('W2', torch.cat([torch.zeros(1, dtype=f64), 10 ** (AdB / 10)]))
+
+        # Grouping into critical bands
+        dfHz = float(self.Fs) / float(self.NF)
+        kk = torch.arange(K, dtype=f64)[:, None]
+        U = (torch.minimum(fu[None], (kk + 0.5) * dfHz) - torch.maximum(fl[None], (kk - 0.5) * dfHz)) / dfHz
+        self.register_buffer('U', U.clamp(min=0))
+        self.register_buffer('EIN', 10 ** (1.456 * (fc / 1000.) ** (-0.8) / 10.))
+
+        # Frequency spreading: lower slope is level independent, upper slope is not
+        e = 0.4
+        aL = 10 ** (2.7 * dz)
+        l = torch.arange(Nc, dtype=f64)
+        self.register_buffer('aUC', 10 ** ((-2.4 - 23 / fc) * dz))
+        self.register_buffer('gIL', (1 - aL ** (-(l + 1))) / (1 - aL ** (-1)))
+        self.register_buffer('nU', Nc - l)
+        d = l[:, None] - l[None, :]
+        self.register_buffer('lowS', torch.where(d >= 0, (aL ** (-e)) ** d.clamp(min=0), torch.zeros_like(d)))
+        self.register_buffer('Bs', torch.ones(Nc, dtype=f64))
+        self.Bs = self.spread(torch.ones(Nc, dtype=f64))
+
+        # Time constants
+        self.register_buffer('a30', self._tConst(0.030, 0.008, fc))
+        self.register_buffer('a50', self._tConst(0.050, 0.008, fc))
+
+        # Loudness
+        Et = PQEval.PQ_enThresh(fc)
+        s = PQEval.PQ_exIndex(fc)
+        self.register_buffer('Et', Et)
+        self.register_buffer('sIdx', s)
+        self.register_buffer('Ets', 1.07664 * (Et / (s * 1e4)) ** 0.23)
+        self.register_buffer('Ete', self.EIN ** 0.3)
+
+        # Pattern adaptation: average over the bands m-3 ... m+4
+        iL = (l - 3).clamp(min=0)
+        iU = (l + 4).clamp(max=Nc - 1)
+        inside = (l[None] >= iL[:, None]) & (l[None] <= iU[:, None])
+        self.register_buffer('adaptAvg', inside.to(f64) / (iU - iL + 1)[:, None])
+
+        # NMR mask offset
+        self.register_buffer('gm', 10 ** (-torch.where(l <= 12. / dz, 3 * torch.ones_like(l), 0.25 * l * dz) / 10))
+
+        # Bandwidth
+        self.kx = int(round(self.NF * 21586. / self.Fs))
+        self.kl = int(round(self.NF * 8109. / self.Fs))
+
+        # Harmonic structure of the error
+        self.NL = 2 ** PEAQ_log2(self.NF * 9000. / self.Fs)
+        self.M = self.NL
+        self.register_buffer('Hw', (1 / self.M) * (8 / 3) ** 0.5 * self._hann(self.M))
+
+        # Averaging
+        self.Ndel = max(0, int(math.ceil(0.5 * self.Fss)))
+        self.Lwin = int(math.floor(0.1 * self.Fss))
+        self.N50ms = int(math.ceil(0.05 * self.Fss))
+
+        # Neural network
+        amin, amax, wx, wxb, wy, wyb, bmin, bmax = PEAQ.NNetPar('Basic')
+        for name, value in zip(['amin', 'amax', 'wx', 'wxb', 'wy', 'wyb', 'bmin', 'bmax'],
+                               [amin, amax, wx, wxb, wy, wyb, bmin, bmax]):
+            self.register_buffer(name, torch.tensor(value, dtype=f64))
+
+        self.to(dtype)
+
+    @staticmethod
+    def _hann(N):
+        n = torch.arange(0, N, dtype=torch.float64)
+        return 0.5 * (1 - torch.cos(2 * torch.pi * n / (N - 1)))
+
+    def _tConst(self, tau_100, tau_min, fc):
+        tau = tau_min + (100. / fc) * (tau_100 - tau_min)
+        return torch.exp(-1. / self.Fss / tau)
+
+    def frames(self, x, Np: int):
+        # (..., N) -> (..., Np, NF), frames past the end of x zero padded
+        x = F.pad(x, (0, (Np + 1) * self.Nadv - x.shape[-1]))
+        return x.unfold(-1, self.NF, self.Nadv)
+
+    def spectra(self, x):
+        X = torch.fft.rfft(self.hw * x, self.NF)
+        return X.real ** 2 + X.imag ** 2
+
+    def excitation(self, X2):
+        # X2: (2, ..., Np, NF/2+1), reference first
+        Xw2 = self.W2 * X2
+        XwN2 = Xw2[0] - 2 * _safe_sqrt(Xw2[0] * Xw2[1]) + Xw2[1]
+        Emin = 1e-12
+        Eb = torch.matmul(Xw2, self.U).clamp(min=Emin)
+        EbN = torch.matmul(XwN2, self.U).clamp(min=Emin)
+        Es = self.spread(Eb + self.EIN)
+        return EbN, Es
+
+    def spread(self, E):
+        e = 0.4
+        aUCE = self.aUC * E ** (0.2 * self.dz)
+        gIU = (1 - aUCE ** self.nU) / (1 - aUCE)
+        En = E / (self.gIL + gIU - 1)
+        aUCEe = aUCE ** e
+        Ene = En ** e
+
+        # Lower spreading: Es[i] = sum_{l >= i} aLe^(l-i) Ene[l]
+        Es = torch.matmul(Ene, self.lowS)
+        # Upper spreading: Es[l] += sum_{i < l} aUCEe[i]^(l-i) Ene[i], one diagonal at a time
+        r = Ene
+        for d in range(1, self.Nc):
+            r = r * aUCEe
+            Es = Es + F.pad(r[..., :self.Nc - d], (d, 0))
+        return Es ** (1 / e) / self.Bs
+
+    # The recursive stages take the filter states before their first frame from state
+    # (missing = zeros, the start of the signal) and leave the states after their last
+    # frame in new, so a signal can be processed in blocks of frames.
+
+    def time_spread(self, Es, state: Dict[str, torch.Tensor], new: Dict[str, torch.Tensor]):
+        Ef = linear_scan((1 - self.a30) * Es, self.a30, state.get('Ef'))
+        new['Ef'] = Ef[..., -1, :]
+        return torch.maximum(Ef, Es)
+
+    def adapt(self, Ehs, state: Dict[str, torch.Tensor], new: Dict[str, torch.Tensor]):
+        a = self.a50
+        b = 1 - a
+        P = linear_scan(b * Ehs, a, state.get('P'))
+        sn = torch.sum(torch.sqrt(P[0] * P[1]), -1, keepdim=True)
+        sd = torch.sum(P[1], -1, keepdim=True)
+        CL = (sn / sd) ** 2
+        cond = CL > 1
+        EPR = torch.where(cond, Ehs[0] / CL, Ehs[0])
+        EPT = torch.where(cond, Ehs[1], Ehs[1] * CL)
+
+        Rn = linear_scan(EPT * EPR, a, state.get('Rn'))
+        Rd = linear_scan(EPR ** 2, a, state.get('Rd'))
+        cond = Rn >= Rd
+        one = torch.ones_like(Rn)
+        R = torch.stack([torch.where(cond, one, Rn / Rd), torch.where(cond, Rd / Rn, one)])
+        PC = linear_scan(b * torch.matmul(R, self.adaptAvg.t()), a, state.get('PC'))
+        new['P'], new['Rn'], new['Rd'], new['PC'] = P[..., -1, :], Rn[..., -1, :], Rd[..., -1, :], PC[..., -1, :]
+        return torch.stack([EPR, EPT]) * PC
+
+    def mod_patt(self, Es, state: Dict[str, torch.Tensor], new: Dict[str, torch.Tensor]):
+        a = self.a50
+        b = 1 - a
+        e = 0.3
+        Ee = Es ** e
+        Ee0 = state.get('Ee')
+        if Ee0 is None:
+            Ee0 = torch.zeros_like(Ee[..., 0, :])
+        dEe = torch.abs(Ee - torch.cat([Ee0.unsqueeze(-2), Ee[..., :-1, :]], -2))
+        DE = linear_scan(b * self.Fss * dEe, a, state.get('DE'))
+        Eavg = linear_scan(b * Ee, a, state.get('Eavg'))
+        new['Ee'], new['DE'], new['Eavg'] = Ee[..., -1, :], DE[..., -1, :], Eavg[..., -1, :]
+        M = DE / (1 + Eavg / e)
+        return M, Eavg[0]
+
+    def loudness(self, Ehs):
+        e = 0.23
+        s = self.sIdx
+        sN = torch.sum(torch.clamp(self.Ets * ((1 - s + s * Ehs / self.Et) ** e - 1), min=0), -1)
+        return (24 / float(self.Nc)) * sN
+
+    def mov_mod_diff(self, M, ERavg):
+        num1B = torch.abs(M[0] - M[1])
+        num2B = torch.where(M[0] > M[1], 0.1 * num1B, num1B)
+        s1B = torch.sum(num1B / (1.0 + M[0]), -1)
+        s2B = torch.sum(num2B / (0.01 + M[0]), -1)
+        Wt = torch.sum(ERavg / (ERavg + 100 * self.Ete), -1)
+        return (100 / float(self.Nc)) * s1B, (100 / float(self.Nc)) * s2B, Wt
+
+    def mov_nloud(self, M, EP):
+        e = 0.23
+        sref = 0.15 * M[0] + 0.5
+        stest = 0.15 * M[1] + 0.5
+        beta = torch.exp(-1.5 * (EP[1] - EP[0]) / EP[0])
+        a = torch.clamp(stest * EP[1] - sref * EP[0], min=0)
+        b = self.EIN + sref * EP[0] * beta
+        s = torch.sum((self.EIN / stest) ** e * ((1 + a / b) ** e - 1), -1)
+        return torch.clamp((24 / float(self.Nc)) * s, min=0)
+
+    def mov_bw(self, X2):
+        FR = 10 ** (10 / 10.)
+        FT = 10 ** (5 / 10.)
+        kx, kl = self.kx, self.kl
+        Xth = torch.amax(X2[1][..., kx:self.NF // 2], -1, keepdim=True)
+        k = torch.arange(kx, device=X2.device).to(X2.dtype)
+        cond = X2[0][..., kl + 1:kx] >= FR * Xth
+        BWRef = torch.amax(k[kl + 1:] * cond, -1) + 1
+        cond = (X2[1][..., :kx - 1] >= FT * Xth) & (k[:kx - 1] < (BWRef - 1).unsqueeze(-1))
+        BWTest = torch.amax(k[:kx - 1] * cond, -1) + 1
+        return BWRef, BWTest
+
+    def mov_pd(self, Ehs):
+        # Detection probability p and steps above threshold q per band (..., Np, Nc),
+        # combined over the bands in pd_frames
+        c = [-0.198719, 0.0550197, -0.00102438, 5.05622e-6, 9.01033e-11]
+        d1 = 5.95072
+        d2 = 6.39468
+        g = 1.71332
+        EdBR = 10 * torch.log10(Ehs[0])
+        EdBT = 10 * torch.log10(Ehs[1])
+        edB = EdBR - EdBT
+        cond = edB > 0
+        L = torch.where(cond, 0.3 * EdBR + 0.7 * EdBT, EdBT)
+        b = torch.where(cond, 4 * torch.ones_like(L), 6 * torch.ones_like(L))
+        pos = L > 0
+        Lp = torch.where(pos, L, torch.ones_like(L))
+        s = torch.where(pos, d1 * (d2 / Lp) ** g + c[0] + L * (c[1] + L * (c[2] + L * (c[3] + L * c[4]))),
+                        1e30 * torch.ones_like(L))
+        p = 1 - 0.5 ** ((edB / s) ** b)
+        if self.smooth:
+            q = torch.abs(edB) / s
+        else:
+            q = torch.abs(torch.trunc(edB)) / s
+        return p, q
+
+    def pd_frames(self, p, q, multichannel: bool = False):
+        # Per-frame PD_p, PD_q from the per-band p, q of mov_pd. multichannel: axis -3 is the
+        # channel axis; as in BS.1387 / Kabal's PQmovPD, p and q are the maxima over the
+        # channels per band before the bands are combined, the result is repeated per channel
+        shape = p.shape[:-1]
+        if multichannel:
+            p = torch.amax(p, -3, keepdim=True)
+            q = torch.amax(q, -3, keepdim=True)
+        Pc = 1 - torch.prod(1 - p, -1)
+        Qc = torch.sum(q, -1)
+        return Pc.expand(shape), Qc.expand(shape)
+
+    def mov_nmr(self, EbN, EhsR):
+        NMRm = EbN / (self.gm * EhsR)
+        NMRavg = torch.sum(NMRm, -1) / float(self.Nc)
+        NMRmax = torch.clamp(torch.amax(NMRm, -1), min=0)
+        return NMRavg, NMRmax
+
+    def mov_ehs(self, x, X2):
+        # x: (2, ..., Np, NF) unwindowed frames, X2: (2, ..., Np, NF/2+1)
+        NL, M = self.NL, self.M
+        En = torch.sum(x[..., self.Nadv:] ** 2, -1)
+        silent = (En[0] < 8000) & (En[1] < 8000)
+
+        X2c = X2[..., :NL + M - 1].clamp(min=1e-30)
+        D = torch.log(X2c[1]) - torch.log(X2c[0])
+        Nfft = 2 * (NL + M)
+        C = torch.fft.irfft(torch.conj(torch.fft.rfft(D[..., :M], Nfft)) * torch.fft.rfft(D, Nfft), Nfft)[..., :NL]
+
+        # Normalized correlation, the energy term updated as a running sum
+        s0 = C[..., :1]
+        sj = torch.cumsum(torch.cat([s0, D[..., M:M + NL - 1] ** 2 - D[..., :NL - 1] ** 2], -1), -1)
+        d = s0 * sj
+        pos = d > 0
+        Cn = torch.where(pos, C / torch.sqrt(torch.where(pos, d, torch.ones_like(d))), torch.ones_like(d))
+        Cn = torch.cat([torch.ones_like(s0), Cn[..., 1:]], -1)
+        Cnm = (1 / NL) * torch.sum(Cn, -1, keepdim=True)
+
+        X = torch.fft.rfft(self.Hw * (Cn - Cnm), NL)
+        c2 = X.real ** 2 + X.imag ** 2
+        peak = torch.where(c2[..., 1:] > c2[..., :1], c2[..., 1:], torch.zeros_like(c2[..., 1:]))
+        EHS = torch.clamp(torch.amax(peak, -1), min=0)
+        return torch.where(silent, -torch.ones_like(EHS), EHS)
+
+    def features(self, ref, test, Np: int, state: Optional[Dict[str, torch.Tensor]] = None,
+                 multichannel: bool = False) -> Tuple[Dict[str, torch.Tensor], Dict[str, torch.Tensor]]:
+        # Per frame model outputs for Np frames starting at the first sample, frames on the
+        # last axis, and the filter states after the last frame. multichannel: axis -2 of the
+        # signals is the channel axis, the PD is combined over the channels (pd_frames)
+        if state is None:
+            state = {}
+        new: Dict[str, torch.Tensor] = {}
+        x = self.frames(torch.stack([ref, test]), Np)
+        X2 = self.spectra(x)
+        EbN, Es = self.excitation(X2)
+        Ehs = self.time_spread(Es, state, new)
+        EP = self.adapt(Ehs, state, new)
+        M, ERavg = self.mod_patt(Es, state, new)
+        Ntot = self.loudness(Ehs)
+        Mt1B, Mt2B, Wt = self.mov_mod_diff(M, ERavg)
+        BWRef, BWTest = self.mov_bw(X2)
+        p, q = self.mov_pd(Ehs)
+        PD_p, PD_q = self.pd_frames(p, q, multichannel)
+        NMRavg, NMRmax = self.mov_nmr(EbN, Ehs[0])
+
+        out: Dict[str, torch.Tensor] = {
+            'loud_NRef': Ntot[0], 'loud_NTest': Ntot[1],
+            'MDiff_Mt1B': Mt1B, 'MDiff_Mt2B': Mt2B, 'MDiff_Wt': Wt,
+            'NLoud_NL': self.mov_nloud(M, EP),
+            'BWRef': BWRef, 'BWTest': BWTest,
+            'NMRavg': NMRavg, 'NMRmax': NMRmax,
+            'PD_p': PD_p, 'PD_q': PD_q,
+            'EHS': self.mov_ehs(x, X2)}
+        if self.intermediate:
+            out['X2MatR'], out['X2MatT'] = X2[0], X2[1]
+            out['EbNMat'] = EbN
+            out['EsMatR'], out['EsMatT'] = Es[0], Es[1]
+            out['EhsR'], out['EhsT'] = Ehs[0], Ehs[1]
+        return out, new
+
+    def average(self, out: Dict[str, torch.Tensor], multichannel: bool = False) -> Dict[str, torch.Tensor]:
+        # Time averaging of the per-frame MOVs (PEAQ.avg_get) and the neural network.
+        # multichannel: axis -2 of the per-frame MOVs is the channel axis (from features with
+        # multichannel=True); as in BS.1387 / Kabal the detection probability is combined per
+        # band over the channels (pd_frames, the same for every channel), the loudness delay
+        # is the earliest over channels and the other MOVs are averaged per channel, then over
+        # the channels.
+        BWRef, BWTest = out['BWRef'], out['BWTest']
+        Np = BWRef.shape[-1]
+        avg: Dict[str, torch.Tensor] = {}
+        avg['avgBWRef'] = _pos_mean(BWRef)
+        avg['avgBWTest'] = _pos_mean(BWTest)
+
+        avg['totalNMRB'] = 10 * torch.log10(torch.mean(out['NMRavg'], -1))
+        if self.smooth:
+            # Fraction of frames more than 1.5 dB over the mask, with a 0.5 dB soft edge
+            NMRdB = 10 * torch.log10(out['NMRmax'].clamp(min=1e-30))
+            avg['relDistFramesB'] = torch.mean(torch.sigmoid((NMRdB - 1.5) / 0.5), -1)
+        else:
+            avg['relDistFramesB'] = torch.mean((out['NMRmax'] > 10 ** (1.5 / 10)).to(BWRef.dtype), -1)
+
+        Mt1B = out['MDiff_Mt1B'][..., self.Ndel:]
+        Mt2B = out['MDiff_Mt2B'][..., self.Ndel:]
+        Wt = out['MDiff_Wt'][..., self.Ndel:]
+        N = Mt1B.shape[-1]
+        L = self.Lwin
+        if N >= L:
+            t = _safe_sqrt(Mt1B).unfold(-1, L, 1).sum(-1)
+            avg['WinModDiff1B'] = _safe_sqrt(torch.sum((t / L) ** 4, -1) / (N - L + 1))
+        else:
+            avg['WinModDiff1B'] = torch.zeros_like(BWRef[..., 0])
+        if N > 0:
+            sW = torch.sum(Wt, -1)
+            avg['AvgModDiff1B'] = torch.sum(Wt * Mt1B, -1) / sW
+            avg['AvgModDiff2B'] = torch.sum(Wt * Mt2B, -1) / sW
+        else:
+            avg['AvgModDiff1B'] = torch.zeros_like(BWRef[..., 0])
+            avg['AvgModDiff2B'] = torch.zeros_like(BWRef[..., 0])
+
+        p, q = out['PD_p'], out['PD_q']
+        if multichannel:
+            p = p[..., 0, :]
+            q = q[..., 0, :]
+        Phc = linear_scan(0.1 * p.unsqueeze(-1), torch.full((1,), 0.9, device=p.device, dtype=p.dtype)).squeeze(-1)
+        avg['MFPDB'] = torch.clamp(torch.amax(Phc, -1), min=0)
+        det = p > 0.5
+        nd = torch.sum(det.to(p.dtype), -1)
+        if self.smooth:
+            # Detected frames weighted with a soft step around p = 0.5
+            w = torch.sigmoid((p - 0.5) / 0.05)
+            Qsum = torch.sum(w * q, -1)
+            ratio = torch.where(Qsum > 0, Qsum / torch.sum(w, -1), torch.ones_like(Qsum))
+        else:
+            Qsum = torch.sum(torch.where(det, q, torch.zeros_like(q)), -1)
+            ratio = torch.where(Qsum > 0, Qsum / nd.clamp(min=1), torch.ones_like(Qsum))
+        avg['ADBB'] = torch.where(nd == 0, torch.zeros_like(Qsum),
+                                  torch.where(Qsum > 0, torch.log10(ratio), -0.5 * torch.ones_like(Qsum)))
+
+        # Noise loudness only after both signals are audible (and at least 0.5 s in)
+        loud = (out['loud_NRef'] > 0.1) & (out['loud_NTest'] > 0.1)
+        first = torch.where(torch.any(loud, -1), torch.argmax(loud.to(torch.int64), -1), torch.full_like(loud[..., 0], Np, dtype=torch.int64))
+        if multichannel:
+            first = torch.amin(first, -1, keepdim=True)
+        start = torch.clamp(first + self.N50ms, min=self.Ndel)
+        keep = torch.arange(Np, device=p.device) >= start.unsqueeze(-1)
+        n = torch.sum(keep.to(p.dtype), -1)
+        NL = out['NLoud_NL']
+        s = torch.sum(torch.where(keep, NL ** 2, torch.zeros_like(NL)), -1)
+        avg['RmsNoiseLoudB'] = torch.where(n > 0, _safe_sqrt(s / n.clamp(min=1)), torch.zeros_like(s))
+
+        avg['EHSB'] = 1000 * _pos_mean(out['EHS'])
+        if multichannel:
+            for name in self.mov_names:
+                if name != 'ADBB' and name != 'MFPDB':
+                    avg[name] = torch.mean(avg[name], -1)
+
+        MOV = torch.stack([avg[name] for name in self.mov_names], -1)
+        avg['DI'], avg['ODG'] = self.nnet(MOV)
+        return avg
+
+    def nnet(self, MOV):
+        MOVx = (MOV - self.amin) / (self.amax - self.amin)
+        DI = self.wyb + torch.sum(self.wy * torch.sigmoid(self.wxb + torch.matmul(MOVx, self.wx)), -1)
+        ODG = self.bmin + (self.bmax - self.bmin) * torch.sigmoid(DI)
+        return DI, ODG
+
+    def forward(self, ref, test, multichannel: bool = False) -> Dict[str, torch.Tensor]:
+        # multichannel=True: signals are (..., channels, N), all channels are processed
+        # together as a batch and combined into one set of MOVs
+        dtype = self.hw.dtype
+        ref = ref.to(dtype)
+        test = F.pad(test.to(dtype), (0, ref.shape[-1] - test.shape[-1]))
+        out, _ = self.features(ref, test, ref.shape[-1] // self.Nadv, None, multichannel)
+        out.update(self.average(out, multichannel))
+        return out
+
+    @torch.jit.unused
+    def blocks(self, ref, test, block=256, Fs=None, multichannel=False):
+        # Generator over the per-frame outputs of consecutive blocks of frames, with the
+        # filter states carried from block to block. Memory is bounded by the block size
+        # and callers can stop between blocks; concat() + average() give forward()'s result.
+        # ref/test are tensors or numpy arrays and stay where they are: only the samples of
+        # the current block are converted and moved to the device of the model.
+        # Fs = sampling rate of ref/test if not the model's: the samples of each block are
+        # converted as they are needed (see resample_PEAQ), forward() of the resampled signals
+        # multichannel = axis -2 is the channel axis, as in forward()
+        N = ref.shape[-1]
+        if Fs is not None and int(Fs) != self.Fs:
+            N = resample_PEAQ.Resampler(Fs, self.Fs).output_length(N)
+        Np = N // self.Nadv
+        starts = range(0, Np, block)
+        sizes = [(min(block, Np - start) + 1) * self.Nadv for start in starts]
+        refs = self._segments(ref, sizes, Fs)
+        tests = self._segments(test, sizes, Fs)
+        state = None
+        for start in starts:
+            n = min(block, Np - start)
+            r = self._block_input(next(refs))
+            t = self._block_input(next(tests), r.shape[-1])
+            with num_threads(self.threads, self.interop_threads):
+                out, state = self.features(r, t, n, state, multichannel)
+            yield out
+
+    @torch.jit.unused
+    def _segments(self, x, sizes, Fs=None):
+        # Samples of consecutive blocks of the given sizes, each overlapping the previous one
+        # by one hop (the second half of the last frame of a block starts the next block)
+        if Fs is None or int(Fs) == self.Fs:
+            start = 0
+            for size in sizes:
+                yield x[..., start:start + size]
+                start += size - self.Nadv
+            return
+        if hasattr(x, 'detach'):
+            x = x.detach().cpu().numpy()
+        tail = None
+        sizes = [size - (self.Nadv if i else 0) for i, size in enumerate(sizes)]
+        for y in resample_PEAQ.blocks(x, Fs, sizes, self.Fs):
+            y = y if tail is None else np.concatenate([tail, y], -1)
+            tail = y[..., -self.Nadv:]
+            yield y
+
+    @torch.jit.unused
+    def _block_input(self, x, length=None):
+        # Samples of one block as a tensor of the model's device and dtype, cut or zero padded to length
+        if length is not None:
+            x = x[..., :length]
+        x = torch.as_tensor(x).to(device=self.hw.device, dtype=self.hw.dtype)
+        return x if length is None else F.pad(x, (0, length - x.shape[-1]))
+
+    @torch.jit.unused
+    def concat(self, outs):
+        # Join per-frame outputs of consecutive blocks along the frame axis
+        n = outs[0]['EHS'].dim()
+        return dict((key, torch.cat([out[key] for out in outs], -1 if value.dim() == n else -2))
+                    for key, value in outs[0].items())
+
+    @torch.jit.unused
+    def evaluate(self, ref, test, block=256, multichannel=False, Fs=None, align=False):
+        # forward() computed block by block, see blocks()
+        # align = score the aligned overlap of ref and test, out['delay'] is the delay of the
+        #         test in samples of the input (one for all channels / batch items, align_PEAQ)
+        delay = None
+        if align:
+            ref, test, delay = align_PEAQ.align(ref, test, self.Fs if Fs is None else Fs)
+        out = self.concat(list(self.blocks(ref, test, block, Fs, multichannel)))
+        if delay is not None:
+            out['delay'] = torch.tensor(delay)
+        with num_threads(self.threads, self.interop_threads):
+            out.update(self.average(out, multichannel))
+        return out
+
+
+class PEAQLoss(nn.Module):
+    '''
+    PEAQ as a training loss: weighted sum of averaged MOVs, DI and/or ODG of a batch of
+    (reference, decoded) pairs, averaged over the batch. Signals are float audio in
+    [-1, 1] of shape (..., N); they are scaled to the 16-bit range the model thresholds
+    assume. The default weights {'ODG': -1} maximize the predicted quality; weights such
+    as {'totalNMRB': 1., 'AvgModDiff1B': 0.01} target single distortions.
+    The first 0.5 s are left out of the modulation averages, so excerpts should be longer.
+    With multichannel=True the signals are (..., channels, N).
+    '''
+    def __init__(self, weights=None, Fs = 48000, dtype=torch.float32, smooth=True, scale=32768., multichannel=False):
+        super().__init__()
+        if weights is None:
+            weights = {'ODG': -1.}
+        for name in weights:
+            if name not in MOV_NAMES + ['DI', 'ODG']:
+                raise ValueError(f'Unknown MOV {name}, choose from {MOV_NAMES + ["DI", "ODG"]}')
+        self.names = list(weights)
+        self.scale = float(scale)
+        self.multichannel = multichannel
+        self.model = PEAQModule(Amax=scale, Fs=Fs, dtype=dtype, smooth=smooth)
+        self.register_buffer('weights', torch.tensor([weights[name] for name in self.names], dtype=dtype))
+
+    def forward(self, ref, test):
+        out = self.model(self.scale * ref, self.scale * test, self.multichannel)
+        movs = torch.stack([out[name] for name in self.names], -1)
+        return torch.mean(torch.sum(self.weights * movs, -1))
+
+
+# Averaged MOVs in the order the Advanced version neural network takes them
+ADVANCED_MOV_NAMES = ['RmsModDiffA', 'RmsNoiseLoudAsymA', 'SegmentalNMRB', 'EHSB', 'AvgLinDistA']
+
+# Lengths of the 40 filter bank filters (BS.1387). The centre frequencies are equally
+# spaced on the Bark scale from 50 Hz to 18 kHz, a filter spans about two band spacings.
+FB_LENGTHS = [1456, 1438, 1406, 1362, 1308, 1244, 1176, 1104, 1030, 956,
+              884, 814, 748, 686, 626, 570, 520, 472, 430, 390,
+              354, 320, 290, 262, 238, 214, 194, 176, 158, 144,
+              130, 118, 106, 96, 86, 78, 70, 64, 58, 52]
+
+
+class PEAQFilterBank(nn.Module):
+    '''
+    Filter bank ear model of the PEAQ Advanced version (BS.1387 section 2.2): DC
+    rejection filter, 40 complex (cos / sin) band filters subsampled by 32, outer and
+    middle ear weighting, level dependent frequency spreading, rectification, backward
+    masking subsampled by 6, internal noise and forward masking.
+
+    The filters are up to 1456 taps long at 48 kHz, but only every 32nd output sample
+    is kept. The bank is therefore one matrix product of the (overlapping, strided) input
+    windows ending at the kept samples with a (taps, 2 * 40) matrix of the real and
+    imaginary impulse responses, centred on a common delay. Input scaling and ear
+    weighting are linear and folded into that matrix; only the outputs that are used are
+    computed and all bands and signals of a batch go through the same product, in chunks
+    of `chunk` output samples to bound the memory of the window copies. The DC filter
+    is a cascade of first order recursions evaluated with linear_scan.
+
+    forward(x) takes signals (..., N) on the Amax scale at 48 kHz and returns the
+    excitation patterns after (E) and before (E2) forward masking, (..., N // 192, 40),
+    at 250 frames per second.
+    '''
+    def __init__(self, Amax = 1, Fs = 48000, dtype=torch.float64, chunk=1024):
+        super().__init__()
+        if Fs != 48000:
+            raise ValueError(f'The filter bank is specified for 48 kHz, not {Fs} Hz')
+        self.Fs = int(Fs)
+        self.Nc = len(FB_LENGTHS)
+        self.sub = 32
+        self.Fss = float(self.Fs) / (6 * self.sub)
+        self.chunk = chunk
+
+        f64 = torch.float64
+        zL = 7 * math.asinh(50. / 650)
+        zU = 7 * math.asinh(18000. / 650)
+        dz = (zU - zL) / (self.Nc - 1)
+        self.dz = dz
+        fc = 650 * torch.sinh((zL + dz * torch.arange(self.Nc, dtype=f64)) / 7)
+        self.register_buffer('fc', fc)
+
+        # DC rejection, two sections (1 - z^-1)^2 / (1 - b1 z^-1 + b2 z^-2), kept as the
+        # poles of each section (real for the first, a complex pair for the second)
+        self.poles = []
+        for b1, b2 in ((1.99517, 0.995174), (1.99799, 0.997998)):
+            r = cmath.sqrt(b1 ** 2 - 4 * b2)
+            self.poles.append(((b1 + r) / 2, (b1 - r) / 2))
+
+        # Filter bank with playback level (92 dB SPL full scale sine) and ear weighting
+        Nmax = max(FB_LENGTHS)
+        fkHz = fc / 1000
+        AdB = -2.184 * fkHz ** (-0.8) + 6.5 * torch.exp(-0.6 * (fkHz - 3.3) ** 2) - 0.001 * fkHz ** (3.6)
+        gain = 10 ** (92 / 20.) / Amax * 10 ** (AdB / 20)
+        h = torch.zeros((2, self.Nc, Nmax), dtype=f64)
+        for k, N in enumerate(FB_LENGTHS):
+            n = torch.arange(N, dtype=f64)
+            w = gain[k] * 4. / N * torch.sin(math.pi * n / N) ** 2
+            phi = 2 * math.pi * fc[k] * (n - N / 2.) / self.Fs
+            D = (Nmax - N) // 2
+            h[0, k, D:D + N] = w * torch.cos(phi)
+            h[1, k, D:D + N] = w * torch.sin(phi)
+        # Time reversed, so a window of the input (oldest sample first) multiplies directly
+        self.register_buffer('H', h.flip(-1).reshape(2 * self.Nc, Nmax).t().contiguous())
+
+        # Frequency spreading: 31 dB/Bark towards lower bands, the upper slope depends on
+        # the band level and is smoothed over time (100 ms)
+        l = torch.arange(self.Nc, dtype=f64)
+        d = l[:, None] - l[None, :]
+        aL = 10 ** (-31 * dz / 20)
+        self.register_buffer('lowS', torch.where(d >= 0, aL ** d.clamp(min=0), torch.zeros_like(d)))
+        self.register_buffer('aUs', torch.full((1,), math.exp(-self.sub / (self.Fs * 0.1)), dtype=f64))
+
+        # Backward masking: 12 tap cos^2 window, time reversed like H
+        i = torch.arange(12, dtype=f64)
+        self.register_buffer('bwin', ((0.9761 / 6) * torch.cos(math.pi * (i - 5) / 12) ** 2).flip(0))
+
+        # Internal noise and forward masking
+        self.register_buffer('EIN', 10 ** (0.4 * 0.364 * (fc / 1000.) ** (-0.8)))
+        tau = 0.004 + (100. / fc) * (0.020 - 0.004)
+        self.register_buffer('aF', torch.exp(-1. / self.Fss / tau))
+
+        self.to(dtype)
+
+    def dc_filter(self, x):
+        for p1, p2 in self.poles:
+            x = x - 2 * F.pad(x[..., :-1], (1, 0)) + F.pad(x[..., :-2], (2, 0))
+            y = x.unsqueeze(-1)
+            if p1.imag != 0:
+                y = y.to(torch.complex128 if x.dtype == torch.float64 else torch.complex64)
+            for p in (p1, p2):
+                a = torch.tensor([p if p.imag != 0 else p.real], dtype=y.dtype, device=y.device)
+                y = linear_scan(y, a, K=64)
+            x = (y.real if y.is_complex() else y).squeeze(-1)
+        return x
+
+    def filter_bank(self, x, M: int):
+        # Real and imaginary band outputs at samples 0, 32, ..., 32 (M-1), (..., M, 40)
+        Nmax = self.H.shape[0]
+        x = F.pad(x, (Nmax - 1, max(0, self.sub * (M - 1) + 1 - x.shape[-1])))
+        w = x.unfold(-1, Nmax, self.sub)[..., :M, :]
+        y = torch.cat([torch.matmul(w[..., s:s + self.chunk, :], self.H)
+                       for s in range(0, max(M, 1), self.chunk)], -2)
+        return y[..., :self.Nc], y[..., self.Nc:]
+
+    def spread(self, re, im):
+        # Spreading of the complex outputs; the upper slope in dB/Bark is
+        # 24 + 230 / fc - 0.2 L for a band at level L (not below 4)
+        L = 10 * torch.log10((re ** 2 + im ** 2).clamp(min=1e-30))
+        s = torch.clamp(24 + 230 / self.fc - 0.2 * L, min=4)
+        aU = linear_scan((1 - self.aUs) * 10 ** (-s * self.dz / 20), self.aUs)
+
+        A = torch.stack([re, im])
+        As = torch.matmul(A, self.lowS)
+        # Upper spreading: As[k] += sum_{j < k} aU[j]^(k-j) A[j], one diagonal at a time,
+        # with the bands on the first axis so the shifted slices are contiguous
+        A = A.movedim(-1, 0).contiguous()
+        aU = aU.movedim(-1, 0).unsqueeze(1).contiguous()
+        As = As.movedim(-1, 0).contiguous()
+        r = A
+        for d in range(1, self.Nc):
+            r = r[:self.Nc - d] * aU[:self.Nc - d]
+            As[d:] += r
+        As = As.movedim(0, -1)
+        return As[0], As[1]
+
+    def smear(self, E0):
+        # Backward masking of the rectified outputs, subsampled by 6: (..., 6 Nf, 40) -> (..., Nf, 40)
+        E0 = F.pad(E0, (0, 0, 11, 0))
+        return torch.matmul(E0.unfold(-2, 12, 6), self.bwin)
+
+    def forward(self, x):
+        Nf = x.shape[-1] // (6 * self.sub)
+        re, im = self.filter_bank(self.dc_filter(x), 6 * Nf)
+        re, im = self.spread(re, im)
+        E2 = self.smear(re ** 2 + im ** 2) + self.EIN
+        E = linear_scan((1 - self.aF) * E2, self.aF)
+        return E, E2
+
+
+class PEAQAdvancedModule(nn.Module):
+    '''
+    PEAQ Advanced version: the filter bank ear model (PEAQFilterBank) for the modulation
+    difference and noise loudness MOVs, the FFT ear model with 1/2 Bark bands
+    (PEAQModule with dz=0.5) for the segmental NMR and the harmonic structure of the
+    error, and the 5 input / 5 hidden node network of PEAQ.NNetPar('Advanced').
+
+    forward(ref, test) is called like PEAQModule's and returns the per-frame MOVs of the
+    filter bank model (250 frames/s: loud_NRef, loud_NTest, MDiff_A, MDiff_Wt, NLoud_NL,
+    NLoud_MC, LinDist) and of the FFT model (NMRavg, EHS), the averaged MOVs under
+    their BS.1387 names (RmsModDiffA, ...), DI and ODG.
+
+    Kabal's PQevalAudio, which the Basic version reproduces, has no Advanced version, so
+    there is no reference output in this repository; the model follows BS.1387.
+    '''
+    def __init__(self, Amax = 1, Fs = 48000, NF = 2048, dtype=torch.float64):
+        super().__init__()
+        f64 = torch.float64
+        self.fb = PEAQFilterBank(Amax, Fs, f64)
+        self.fft = PEAQModule(Amax, Fs, NF, f64, dz=0.5)
+        self.mov_names: List[str] = list(ADVANCED_MOV_NAMES)
+        self.Nc = self.fb.Nc
+        self.Fss = self.fb.Fss
+        fc = self.fb.fc
+        Nc = self.Nc
+
+        # Pattern processing of the filter bank outputs
+        tau = 0.008 + (100. / fc) * (0.050 - 0.008)
+        self.register_buffer('a50', torch.exp(-1. / self.Fss / tau))
+        # Pattern adaptation: average over the bands m-1 ... m+1
+        l = torch.arange(Nc, dtype=f64)
+        iL = (l - 1).clamp(min=0)
+        iU = (l + 1).clamp(max=Nc - 1)
+        inside = (l[None] >= iL[:, None]) & (l[None] <= iU[:, None])
+        self.register_buffer('adaptAvg', inside.to(f64) / (iU - iL + 1)[:, None])
+
+        # Loudness
+        Et = PQEval.PQ_enThresh(fc)
+        s = PQEval.PQ_exIndex(fc)
+        self.register_buffer('Et', Et)
+        self.register_buffer('sIdx', s)
+        self.register_buffer('Ets', 1.26539 * (Et / (s * 1e4)) ** 0.23)
+        self.register_buffer('EIN', self.fb.EIN.clone())
+        self.register_buffer('Ete', self.EIN ** 0.3)
+
+        # Averaging, in filter bank frames
+        self.Ndel = int(math.ceil(0.5 * self.Fss))
+        self.N50ms = int(math.ceil(0.05 * self.Fss))
+
+        amin, amax, wx, wxb, wy, wyb, bmin, bmax = PEAQ.NNetPar('Advanced')
+        for name, value in zip(['amin', 'amax', 'wx', 'wxb', 'wy', 'wyb', 'bmin', 'bmax'],
+                               [amin, amax, wx, wxb, wy, wyb, bmin, bmax]):
+            self.register_buffer(name, torch.tensor(value, dtype=f64))
+
+        self.to(dtype)
+
+    def adapt(self, E):
+        # Level and pattern adaptation (PQadapt) of E: (2, ..., Nf, Nc)
+        a = self.a50
+        b = 1 - a
+        P = linear_scan(b * E, a)
+        CL = (torch.sum(torch.sqrt(P[0] * P[1]), -1, keepdim=True) / torch.sum(P[1], -1, keepdim=True)) ** 2
+        cond = CL > 1
+        EPR = torch.where(cond, E[0] / CL, E[0])
+        EPT = torch.where(cond, E[1], E[1] * CL)
+
+        Rn = linear_scan(EPT * EPR, a)
+        Rd = linear_scan(EPR ** 2, a)
+        cond = Rn >= Rd
+        one = torch.ones_like(Rn)
+        R = torch.stack([torch.where(cond, one, Rn / Rd), torch.where(cond, Rd / Rn, one)])
+        PC = linear_scan(b * torch.matmul(R, self.adaptAvg.t()), a)
+        return torch.stack([EPR, EPT]) * PC
+
+    def mod_patt(self, E2):
+        a = self.a50
+        b = 1 - a
+        e = 0.3
+        Ee = E2 ** e
+        dEe = torch.abs(Ee - F.pad(Ee[..., :-1, :], (0, 0, 1, 0)))
+        DE = linear_scan(b * self.Fss * dEe, a)
+        Eavg = linear_scan(b * Ee, a)
+        M = DE / (1 + Eavg / e)
+        return M, Eavg[0]
+
+    def loudness(self, E):
+        e = 0.23
+        s = self.sIdx
+        sN = torch.sum(torch.clamp(self.Ets * ((1 - s + s * E / self.Et) ** e - 1), min=0), -1)
+        return (24 / float(self.Nc)) * sN
+
+    def mov_mod_diff(self, M, ERavg):
+        # negWt = 1, offset = 1, levWt = 1
+        s = torch.sum(torch.abs(M[0] - M[1]) / (1 + M[0]), -1)
+        Wt = torch.sum(ERavg / (ERavg + self.Ete), -1)
+        return (100 / float(self.Nc)) * s, Wt
+
+    def noise_loud(self, Mref, Mtest, Eref, Etest, alpha: float, TF0: float, S0: float, NLmin: float):
+        # Partial loudness of Etest masked by Eref (PQmovNLoudB with the parameters as arguments)
+        e = 0.23
+        sref = TF0 * Mref + S0
+        stest = TF0 * Mtest + S0
+        beta = torch.exp(-alpha * (Etest - Eref) / Eref)
+        a = torch.clamp(stest * Etest - sref * Eref, min=0)
+        b = self.EIN + sref * Eref * beta
+        NL = (24 / float(self.Nc)) * torch.sum((self.EIN / stest) ** e * ((1 + a / b) ** e - 1), -1)
+        return torch.where(NL < NLmin, torch.zeros_like(NL), NL)
+
+    def features(self, ref, test) -> Dict[str, torch.Tensor]:
+        x = torch.stack([ref, test])
+        fft = self.fft
+        frames = fft.frames(x, ref.shape[-1] // fft.Nadv)
+        X2 = fft.spectra(frames)
+        EbN, Es = fft.excitation(X2)
+        Ehs = fft.time_spread(Es, {}, {})
+        NMRavg, _ = fft.mov_nmr(EbN, Ehs[0])
+
+        E, E2 = self.fb(x)
+        EP = self.adapt(E)
+        M, ERavg = self.mod_patt(E2)
+        Ntot = self.loudness(E)
+        MDiff, Wt = self.mov_mod_diff(M, ERavg)
+        return {'loud_NRef': Ntot[0], 'loud_NTest': Ntot[1],
+                'MDiff_A': MDiff, 'MDiff_Wt': Wt,
+                'NLoud_NL': self.noise_loud(M[0], M[1], EP[0], EP[1], 2.5, 0.3, 1., 0.1),
+                # Missing components: reference and test swapped
+                'NLoud_MC': self.noise_loud(M[1], M[0], EP[1], EP[0], 1.5, 0.15, 1., 0.),
+                # Linear distortions: the reference masked by its spectrally adapted version
+                'LinDist': self.noise_loud(M[0], M[0], EP[0], E[0], 1.5, 0.15, 1., 0.),
+                'NMRavg': NMRavg,
+                'EHS': fft.mov_ehs(frames, X2)}
+
+    def average(self, out: Dict[str, torch.Tensor], multichannel: bool = False) -> Dict[str, torch.Tensor]:
+        # Time averaging and the neural network; multichannel as in PEAQModule.average
+        MDiff = out['MDiff_A'][..., self.Ndel:]
+        Wt = out['MDiff_Wt'][..., self.Ndel:]
+        zero = torch.zeros_like(out['MDiff_A'][..., 0])
+        avg: Dict[str, torch.Tensor] = {}
+        if MDiff.shape[-1] > 0:
+            # RMS weighted with the levels of the reference
+            avg['RmsModDiffA'] = math.sqrt(self.Nc) * _safe_sqrt(torch.sum((Wt * MDiff) ** 2, -1) / torch.sum(Wt ** 2, -1))
+        else:
+            avg['RmsModDiffA'] = zero
+
+        # Noise loudness MOVs only after both signals are audible (and at least 0.5 s in)
+        Nf = out['loud_NRef'].shape[-1]
+        loud = (out['loud_NRef'] > 0.1) & (out['loud_NTest'] > 0.1)
+        first = torch.where(torch.any(loud, -1), torch.argmax(loud.to(torch.int64), -1), torch.full_like(loud[..., 0], Nf, dtype=torch.int64))
+        if multichannel:
+            first = torch.amin(first, -1, keepdim=True)
+        start = torch.clamp(first + self.N50ms, min=self.Ndel)
+        keep = torch.arange(Nf, device=zero.device) >= start.unsqueeze(-1)
+        n = torch.sum(keep.to(zero.dtype), -1)
+        sums = dict((name, torch.sum(torch.where(keep, out[name] ** p, torch.zeros_like(out[name])), -1) / n.clamp(min=1))
+                    for name, p in (('NLoud_NL', 2), ('NLoud_MC', 2), ('LinDist', 1)))
+        avg['RmsNoiseLoudAsymA'] = torch.where(n > 0, _safe_sqrt(sums['NLoud_NL']) + 0.5 * _safe_sqrt(sums['NLoud_MC']), zero)
+        avg['AvgLinDistA'] = torch.where(n > 0, sums['LinDist'], zero)
+
+        avg['SegmentalNMRB'] = torch.mean(10 * torch.log10(out['NMRavg']), -1)
+        avg['EHSB'] = 1000 * _pos_mean(out['EHS'])
+        if multichannel:
+            for name in self.mov_names:
+                avg[name] = torch.mean(avg[name], -1)
+
+        MOV = torch.stack([avg[name] for name in self.mov_names], -1)
+        MOVx = (MOV - self.amin) / (self.amax - self.amin)
+        avg['DI'] = self.wyb + torch.sum(self.wy * torch.sigmoid(self.wxb + torch.matmul(MOVx, self.wx)), -1)
+        avg['ODG'] = self.bmin + (self.bmax - self.bmin) * torch.sigmoid(avg['DI'])
+        return avg
+
+    def forward(self, ref, test, multichannel: bool = False) -> Dict[str, torch.Tensor]:
+        dtype = self.EIN.dtype
+        ref = ref.to(dtype)
+        test = F.pad(test.to(dtype), (0, ref.shape[-1] - test.shape[-1]))
+        out = self.features(ref, test)
+        out.update(self.average(out, multichannel))
+        return out
+
+
+def _safe_sqrt(x):
+    # sqrt with a zero instead of an infinite gradient at 0 (identical signals, silent bins)
+    pos = x > 0
+    return torch.where(pos, torch.sqrt(torch.where(pos, x, torch.ones_like(x))), torch.zeros_like(x))
+
+
+def _pos_mean(x):
+    # Mean over the non-negative entries (PQ_LinPosAvg), NaN if there are none
+    pos = x >= 0
+    return torch.sum(torch.where(pos, x, torch.zeros_like(x)), -1) / torch.sum(pos.to(x.dtype), -1)
+
+
+def PEAQ_log2(x: float) -> int:
+    # Same as PEAQ.PQ_log2 on plain numbers
+    res = 0
+    m = 1
+    while m < x:
+        res += 1
+        m *= 2
+    return res - 1
+
+
+def _critical_bands(dz, fL=80., fU=18000.):
+    # Bands of width dz on the Bark scale from fL to fU, the last one cut at fU (PQCB
+    # tabulates these for dz = 1/4): number of bands, centre, lower and upper frequencies
+    zL = 7 * math.asinh(fL / 650)
+    zU = 7 * math.asinh(fU / 650)
+    Nc = int(math.ceil((zU - zL) / dz))
+    l = torch.arange(Nc, dtype=torch.float64)
+    zl = zL + l * dz
+    zu = torch.clamp(zL + (l + 1) * dz, max=zU)
+    zc = 0.5 * (zl + zu)
+    return Nc, 650 * torch.sinh(zc / 7), 650 * torch.sinh(zl / 7), 650 * torch.sinh(zu / 7)
+
+
+class _Tables(object):
+    # Minimal stand-in for PQEval when only its static tables are needed
+    def __init__(self, dtype):
+        self.device = torch.device('cpu')
+        self.dtype = dtype